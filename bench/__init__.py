@@ -0,0 +1,17 @@
+'''
+Load tests of the servers, run from the top directory of the repository:
+
+    python -m bench list
+    python -m bench run -o before.json
+    python -m bench run static-small gzip-on -d 5 -c 32 -o after.json
+    python -m bench compare before.json after.json
+
+Every scenario starts its server in a process of its own, on fixtures made
+in a temporary directory, and loads it from client processes for a warmup
+and then for the measured duration. Results are requests per second,
+latency percentiles, CPU time of the server per request and its memory.
+A result with errors, or with a median latency close to the 40ms of a
+delayed ACK, comes with a warning: its numbers are likely not the server's.
+compare tells which of them changed by more than a threshold, and exits
+with status 1 with --fail if any got worse.
+'''
@@ -0,0 +1,82 @@
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+from bench import runner, scenarios
+from servers import backends
+
+def list_scenarios(args):
+    for scenario in scenarios.scenarios:
+        print('{:<20}{}'.format(scenario.name, scenario.description))
+
+def run(args):
+    names = args.scenarios or [scenario.name for scenario in scenarios.scenarios]
+    unknown = [name for name in names if name not in scenarios.by_name]
+    if unknown:
+        sys.exit('Unknown scenario: {}'.format(', '.join(unknown)))
+    fixture_dir = args.fixtures or tempfile.mkdtemp(prefix='bench-')
+    print(runner.format_header())
+    def report(name, result):
+        print(runner.format_result(name, result), flush=True)
+    try:
+        scenarios.make_fixtures(fixture_dir)
+        results = runner.run_suite(
+            names, fixture_dir, args.repeat, report, duration=args.duration,
+            warmup=args.warmup, connections=args.connections,
+            clients=args.clients, backend=args.backend)
+    finally:
+        if not args.fixtures:
+            shutil.rmtree(fixture_dir, ignore_errors=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = runner.compare(base, new, args.threshold)
+    print(runner.format_comparison(rows))
+    if args.fail and any(row[-1] == 'worse' for row in rows):
+        sys.exit(1)
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m bench',
+                                     description='Load tests of the servers.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    command = commands.add_parser('list', help='list the scenarios')
+    command.set_defaults(function=list_scenarios)
+    command = commands.add_parser('run', help='run scenarios, all by default')
+    command.add_argument('scenarios', nargs='*')
+    command.add_argument('-d', '--duration', type=float, default=10,
+                         help='seconds measured (default: %(default)s)')
+    command.add_argument('-w', '--warmup', type=float, default=2,
+                         help='seconds before measuring (default: %(default)s)')
+    command.add_argument('-c', '--connections', type=int, default=16,
+                         help='concurrent connections (default: %(default)s)')
+    command.add_argument('--clients', type=int,
+                         help='client processes (default: half the CPUs)')
+    command.add_argument('-b', '--backend', choices=sorted(backends),
+                         help='concurrency backend of the servers')
+    command.add_argument('-r', '--repeat', type=int, default=1,
+                         help='runs of each scenario, the median is kept')
+    command.add_argument('-f', '--fixtures',
+                         help='directory of the fixtures, kept after the run')
+    command.add_argument('-o', '--output', help='JSON file of the results')
+    command.set_defaults(function=run)
+    command = commands.add_parser('compare', help='compare two runs')
+    command.add_argument('base')
+    command.add_argument('new')
+    command.add_argument('-t', '--threshold', type=float, default=0.05,
+                         help='relative change which counts (default: %(default)s)')
+    command.add_argument('--fail', action='store_true',
+                         help='exit with status 1 if anything got worse')
+    command.set_defaults(function=compare)
+    args = parser.parse_args(argv)
+    args.function(args)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
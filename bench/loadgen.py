@@ -0,0 +1,166 @@
+r'''
+Load generator: client processes, each driving many connections from an
+asyncio loop.
+
+A connection sends its requests in turn, one at a time, and waits for
+the whole response. With keep_alive it sends them all over one connection
+(reopened if the server closes it), otherwise every request opens a new
+connection, which is part of its latency. Only the requests which end
+between start and end count.
+
+>>> request_bytes('GET', '/a.txt', [('Range', 'bytes=0-9')], False)
+b'GET /a.txt HTTP/1.1\r\nHost: localhost\r\nRange: bytes=0-9\r\nConnection: close\r\n\r\n'
+>>> percentile([0.004, 0.001, 0.002, 0.003], 0.5)
+0.002
+>>> percentile([], 0.99) is None
+True
+'''
+
+import array
+import asyncio
+import math
+import time
+
+def request_bytes(method, path, headers=(), keep_alive=True):
+    '''Raw bytes of a request.'''
+    lines = ['{} {} HTTP/1.1'.format(method, path)]
+    if not any(key.lower() == 'host' for key, value in headers):
+        lines.append('Host: localhost')
+    lines.extend('{}: {}'.format(key, value) for key, value in headers)
+    if not keep_alive:
+        lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+def percentile(values, q):
+    '''Nearest-rank q percentile of values, None if there are none.'''
+    if not len(values):
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+async def read_response(reader, method):
+    '''Read a response, return (status, body size, whether the server
+    closes the connection).
+    '''
+    while True:
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.split(b'\r\n')
+        status = int(lines[0].split(None, 2)[1])
+        if not 100 <= status < 200:
+            break
+    length = None
+    chunked = close = False
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'content-length':
+            length = int(value)
+        elif name == b'transfer-encoding':
+            chunked = b'chunked' in value.lower()
+        elif name == b'connection':
+            close = b'close' in value.lower()
+    if method == 'HEAD' or status in (204, 304):
+        return status, 0, close
+    size = 0
+    if chunked:
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            chunk = int(line.split(b';')[0], 16)
+            if not chunk:
+                # trailers, up to an empty line
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                return status, size, close
+            size += chunk
+            await read_exactly(reader, chunk + 2)
+    if length is not None:
+        await read_exactly(reader, length)
+        return status, length, close
+    # the body ends with the connection
+    while True:
+        data = await reader.read(1 << 20)
+        if not data:
+            return status, size, True
+        size += len(data)
+
+async def read_exactly(reader, size):
+    '''Read and drop size bytes, in blocks.'''
+    while size:
+        data = await reader.read(min(size, 1 << 20))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', size)
+        size -= len(data)
+
+class ClientStats(object):
+    '''What the connections of a client process saw between start and end.'''
+    def __init__(self):
+        self.latencies = array.array('d')
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.errors += other.errors
+        self.bytes += other.bytes
+
+async def drive(host, port, requests, keep_alive, offset, start, end, stats):
+    '''Send requests over a connection until end.'''
+    reader = writer = None
+    index = offset
+    while time.monotonic() < end:
+        method, raw = requests[index % len(requests)]
+        index += 1
+        began = time.monotonic()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            writer.write(raw)
+            status, size, close = await read_response(reader, method)
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError):
+            if writer is not None:
+                writer.close()
+                reader = writer = None
+            if start <= time.monotonic() < end:
+                stats.errors += 1
+            # a server which refuses connections must not be hammered
+            await asyncio.sleep(0.01)
+            continue
+        ended = time.monotonic()
+        if start <= ended < end:
+            stats.latencies.append(ended - began)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes += size
+        if close or not keep_alive:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+
+async def run_connections(host, port, requests, keep_alive, connections,
+                          begin, start, end, stats):
+    await asyncio.sleep(max(begin - time.monotonic(), 0))
+    await asyncio.gather(*[
+        drive(host, port, requests, keep_alive, index, start, end, stats)
+        for index in range(connections)])
+
+def run_client(conn, host, port, requests, keep_alive, connections):
+    '''Main function of a client process. Once ready, it gets the times
+    (monotonic) to begin, start counting and end, and sends back its
+    ClientStats.
+    '''
+    conn.send('ready')
+    begin, start, end = conn.recv()
+    loop = asyncio.new_event_loop()
+    stats = ClientStats()
+    try:
+        loop.run_until_complete(run_connections(
+            host, port, requests, keep_alive, connections, begin, start, end,
+            stats))
+    finally:
+        loop.close()
+    conn.send(stats)
+    conn.close()
@@ -0,0 +1,327 @@
+'''
+Runs of scenarios: the server in a process of its own, the load from
+client processes, the results as plain data, and comparisons of runs.
+
+CPU time and memory are those of the server process only, the origin of
+the proxy scenarios runs in another one. Latencies are in seconds, from
+sending a request to the end of its response.
+
+>>> base = {'results': {'static-small': {'rps': 1000, 'p99': 0.002}}}
+>>> new = {'results': {'static-small': {'rps': 1200, 'p99': 0.002}}}
+>>> for row in compare(base, new):
+...     print(row)
+('static-small', 'rps', 1000, 1200, 0.2, 'better')
+('static-small', 'p99', 0.002, 0.002, 0.0, '')
+'''
+
+import datetime
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from bench import loadgen, scenarios
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# fresh interpreters, which do not inherit the sockets or memory of others
+context = multiprocessing.get_context('spawn')
+
+# fields of results compared by compare, and whether higher is better
+compared_fields = (('rps', True), ('p50', False), ('p99', False),
+                   ('p999', False), ('cpu_per_request', False),
+                   ('max_rss', False))
+
+# delays of delayed ACKs, which a response written in several pieces waits
+# for with Nagle's algorithm on: a latency there is likely not the server's
+delayed_ack = (0.035, 0.05)
+
+def current_rss():
+    '''Resident set size of this process in bytes, None if unknown.'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def peak_rss():
+    '''Peak resident set size of this process in bytes, None if unknown.
+    ru_maxrss of Linux is kept across exec, it would be that of the parent.
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes, but bytes on macOS
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def usage():
+    '''CPU seconds, RSS and peak RSS in bytes of this process.'''
+    if resource is None:
+        cpu = time.process_time()
+    else:
+        rusage = resource.getrusage(resource.RUSAGE_SELF)
+        cpu = rusage.ru_utime + rusage.ru_stime
+    return {'cpu': cpu, 'rss': current_rss(), 'max_rss': peak_rss()}
+
+def serve(conn, name, fixture_dir, backend):
+    '''Main function of a server process. It sends the port of the server,
+    then answers 'usage' with usage() until it gets anything else.
+    '''
+    # the request log is still written, to nowhere
+    sys.stderr = open(os.devnull, 'w')
+    scenario = scenarios.origin if name == 'origin' else scenarios.by_name[name]
+    server = scenario.make_server(fixture_dir, backend)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    conn.send(server.server_address[1])
+    while conn.recv() == 'usage':
+        conn.send(usage())
+    server.shutdown()
+    server.server_close()
+
+class ServerProcess(object):
+    def __init__(self, name, fixture_dir, backend=None, timeout=60):
+        self.conn, theirs = context.Pipe()
+        self.process = context.Process(
+            target=serve, args=(theirs, name, fixture_dir, backend),
+            daemon=True)
+        self.process.start()
+        theirs.close()
+        if not self.conn.poll(timeout):
+            self.stop()
+            raise RuntimeError('Server of {} did not start.'.format(name))
+        self.port = self.conn.recv()
+
+    def usage(self):
+        self.conn.send('usage')
+        return self.conn.recv()
+
+    def stop(self):
+        try:
+            self.conn.send('stop')
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+def sleep_until(deadline):
+    delay = deadline - time.monotonic()
+    if delay > 0:
+        time.sleep(delay)
+
+def default_clients(connections):
+    '''Client processes for connections: half the CPUs, the other half
+    being left to the server.
+    '''
+    return max(1, min(connections, (os.cpu_count() or 2) // 2))
+
+def run_scenario(scenario, fixture_dir, duration=10, warmup=2, connections=16,
+                 clients=None, backend=None):
+    '''Run a scenario, return its result.'''
+    origin = server = None
+    try:
+        if scenario.needs_origin():
+            origin = ServerProcess('origin', fixture_dir, backend)
+        server = ServerProcess(scenario.name, fixture_dir, backend)
+        requests = scenario.request_list(
+            origin and 'http://127.0.0.1:{}'.format(origin.port))
+        clients = clients or default_clients(connections)
+        processes = []
+        for index in range(clients):
+            share = connections // clients + (index < connections % clients)
+            if not share:
+                continue
+            ours, theirs = context.Pipe()
+            process = context.Process(
+                target=loadgen.run_client,
+                args=(theirs, '127.0.0.1', server.port, requests,
+                      scenario.keep_alive, share),
+                daemon=True)
+            process.start()
+            theirs.close()
+            processes.append((process, ours))
+        for process, conn in processes:
+            conn.recv()
+        begin = time.monotonic() + 0.1
+        start = begin + warmup
+        end = start + duration
+        for process, conn in processes:
+            conn.send((begin, start, end))
+        sleep_until(start)
+        before = server.usage()
+        sleep_until(end)
+        after = server.usage()
+        stats = loadgen.ClientStats()
+        for process, conn in processes:
+            stats.merge(conn.recv())
+            process.join()
+            conn.close()
+    finally:
+        if server is not None:
+            server.stop()
+        if origin is not None:
+            origin.stop()
+    latencies = sorted(stats.latencies)
+    count = len(latencies)
+    failed = sum(number for status, number in stats.statuses.items()
+                 if status >= 400)
+    return {
+        'description': scenario.description,
+        'server': scenario.server,
+        'keep_alive': scenario.keep_alive,
+        'connections': connections,
+        'requests': count,
+        'errors': stats.errors + failed,
+        'statuses': dict((str(status), number)
+                         for status, number in sorted(stats.statuses.items())),
+        'rps': count / duration,
+        'bytes_per_second': stats.bytes / duration,
+        'mean': sum(latencies) / count if count else None,
+        'p50': loadgen.percentile(latencies, 0.5),
+        'p99': loadgen.percentile(latencies, 0.99),
+        'p999': loadgen.percentile(latencies, 0.999),
+        'max': latencies[-1] if count else None,
+        'cpu_per_request': ((after['cpu'] - before['cpu']) / count
+                            if count else None),
+        'rss': after['rss'],
+        'max_rss': after['max_rss'],
+    }
+
+def result_warnings(result):
+    '''Reasons not to trust the numbers of a result.'''
+    warnings = []
+    if result['errors']:
+        warnings.append('{} errors'.format(result['errors']))
+    p50 = result['p50']
+    if p50 is not None and delayed_ack[0] <= p50 <= delayed_ack[1]:
+        warnings.append('p50 of {:.0f}ms, a delayed ACK stall?'.format(
+            p50 * 1000))
+    return warnings
+
+def median_result(results):
+    '''Result of the medians of the numbers of several runs of a scenario.'''
+    merged = dict(results[0])
+    for key, value in results[0].items():
+        values = [result[key] for result in results]
+        if (isinstance(value, (int, float)) and not isinstance(value, bool)
+                and None not in values):
+            merged[key] = statistics.median(values)
+    merged['runs'] = len(results)
+    return merged
+
+def git_commit():
+    '''Commit of the tree being measured, None outside of a git checkout.'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(scenarios.__file__)),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(names, fixture_dir, repeat=1, report=None, **options):
+    '''Run the scenarios named names, each repeat times. report is called
+    with the name and result of every scenario as it is done.
+    '''
+    results = {}
+    for name in names:
+        scenario = scenarios.by_name[name]
+        runs = [run_scenario(scenario, fixture_dir, **options)
+                for _ in range(repeat)]
+        results[name] = median_result(runs) if repeat > 1 else runs[0]
+        results[name]['warnings'] = result_warnings(results[name])
+        if report is not None:
+            report(name, results[name])
+    meta = dict(options)
+    if not meta.get('clients'):
+        meta['clients'] = default_clients(options.get('connections', 16))
+    meta.update({
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': '{} {}'.format(platform.python_implementation(),
+                                 platform.python_version()),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'repeat': repeat,
+    })
+    return {'meta': meta, 'results': results}
+
+def compare(base, new, threshold=0.05):
+    '''Rows (scenario, field, base value, new value, relative change,
+    verdict) for the scenarios of both runs. verdict is 'better' or
+    'worse' for changes larger than threshold, '' otherwise.
+    '''
+    rows = []
+    for name, old in base['results'].items():
+        result = new['results'].get(name)
+        if result is None:
+            continue
+        for field, higher_is_better in compared_fields:
+            before, after = old.get(field), result.get(field)
+            if before is None or after is None:
+                continue
+            change = (after - before) / before if before else None
+            verdict = ''
+            if change is not None and abs(change) > threshold:
+                verdict = 'better' if (change > 0) == higher_is_better else 'worse'
+            rows.append((name, field, before, after,
+                         None if change is None else round(change, 4), verdict))
+    return rows
+
+def format_value(field, value):
+    if value is None:
+        return '-'
+    if field in ('p50', 'p99', 'p999', 'mean', 'max'):
+        return '{:.3f}ms'.format(value * 1000)
+    if field == 'cpu_per_request':
+        return '{:.1f}us'.format(value * 1e6)
+    if field in ('rss', 'max_rss'):
+        return '{:.1f}MB'.format(value / (1 << 20))
+    if field == 'rps':
+        return '{:.0f}'.format(value)
+    return str(value)
+
+result_columns = ('rps', 'p50', 'p99', 'p999', 'cpu_per_request', 'rss',
+                  'max_rss', 'errors')
+
+def format_result(name, result):
+    '''A line of the table of results, and one per warning.'''
+    line = '{:<20}'.format(name) + ''.join(
+        '{:>13}'.format(format_value(field, result[field]))
+        for field in result_columns)
+    return '\n'.join([line] + ['{:<20}warning: {}'.format('', warning)
+                               for warning in result.get('warnings', ())])
+
+def format_header():
+    return '{:<20}'.format('scenario') + ''.join(
+        '{:>13}'.format(field.replace('cpu_per_request', 'cpu/request'))
+        for field in result_columns)
+
+def format_comparison(rows):
+    lines = ['{:<20}{:<17}{:>13}{:>13}{:>9}  {}'.format(
+        'scenario', 'field', 'base', 'new', 'change', '')]
+    for name, field, before, after, change, verdict in rows:
+        lines.append('{:<20}{:<17}{:>13}{:>13}{:>9}  {}'.format(
+            name, field, format_value(field, before), format_value(field, after),
+            '-' if change is None else '{:+.1%}'.format(change), verdict))
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,171 @@
+'''
+Scenarios of the benchmark, and the files and scripts they run on.
+
+A scenario names a server, how it is configured, and the requests which
+every connection sends in turn. '{origin}' in a path stands for the URL
+of a FileHTTPServer which serves the fixtures as the origin of a proxy.
+Fixtures are made from fixed content with a fixed modification time, so
+every run sees the same files.
+
+>>> scenario = by_name['proxy']
+>>> scenario.needs_origin()
+True
+>>> scenario.request_list('http://127.0.0.1:8000')[0][1].split(b'\\r\\n')[0]
+b'GET http://127.0.0.1:8000/small.txt HTTP/1.1'
+'''
+
+import os
+import random
+from http import HTTPStatus
+from filehttp import FileHTTPRequestHandler, FileHTTPServer
+from minhttp import MinHTTPRequestHandler, MinHTTPServer
+from proxyhttp import ProxyHTTPRequestHandler, ProxyHTTPServer
+from pythonhttp import PythonHTTPRequestHandler, PythonHTTPServer
+from servers import with_backend
+from bench.loadgen import request_bytes
+
+# 2020-01-01, old enough for the proxy to cache the fixtures by heuristic
+fixture_mtime = 1577836800
+
+hello_script = '''\
+def handle(handler):
+    body = b'Hello from a script!\\n'
+    handler.send_response(200)
+    handler.send_header('Content-Type', 'text/plain')
+    handler.send_header('Content-Length', str(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+'''
+
+words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing',
+         'elit', 'sed', 'do', 'eiusmod', 'tempor', 'incididunt', 'labore')
+
+def make_fixtures(directory):
+    '''Write the files the scenarios request into directory.'''
+    rng = random.Random(0)
+    def text(size):
+        lines = []
+        total = 0
+        while total < size:
+            line = ' '.join(rng.choice(words) for _ in range(12)) + '\n'
+            lines.append(line)
+            total += len(line)
+        return ''.join(lines)[:size]
+    files = {
+        'small.txt': text(1 << 10).encode(),
+        'page.html': ('<html><body><pre>\n' + text(64 << 10) +
+                      '</pre></body></html>\n').encode(),
+        'large.bin': rng.getrandbits(8 << 23).to_bytes(8 << 20, 'little'),
+        'hello.py': hello_script.encode(),
+    }
+    listing = os.path.join(directory, 'dir')
+    os.makedirs(listing, exist_ok=True)
+    for index in range(1000):
+        files[os.path.join('dir', 'file-{:04}.txt'.format(index))] = b''
+    for name, content in files.items():
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        os.utime(path, (fixture_mtime, fixture_mtime))
+    os.utime(listing, (fixture_mtime, fixture_mtime))
+
+class HelloHandler(MinHTTPRequestHandler):
+    '''Handler of MinHTTPServer with a body of unknown length, sent chunked.'''
+    def do_GET(self):
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', 'text/plain')
+        self.end_headers()
+        self.start_body()
+        self.outfile.write(b'Hello, world!\n')
+        self.end_body()
+
+server_classes = {
+    'min': (MinHTTPServer, HelloHandler),
+    'file': (FileHTTPServer, FileHTTPRequestHandler),
+    'python': (PythonHTTPServer, PythonHTTPRequestHandler),
+    'proxy': (ProxyHTTPServer, ProxyHTTPRequestHandler),
+}
+
+class Scenario(object):
+    '''requests are (method, path, headers), configure is called with the
+    server before it serves.
+    '''
+    def __init__(self, name, description, server, requests, configure=None,
+                 keep_alive=True):
+        self.name = name
+        self.description = description
+        self.server = server
+        self.requests = requests
+        self.configure = configure
+        self.keep_alive = keep_alive
+
+    def needs_origin(self):
+        return any('{origin}' in path for method, path, headers in self.requests)
+
+    def request_list(self, origin=None):
+        '''(method, raw request) of the requests.'''
+        return [(method, request_bytes(method, path.format(origin=origin),
+                                       headers, self.keep_alive))
+                for method, path, headers in self.requests]
+
+    def make_server(self, fixture_dir, backend=None):
+        '''The configured server of the scenario, on a free local port.'''
+        server_class, handler_class = server_classes[self.server]
+        if backend is not None:
+            server_class = with_backend(server_class, backend)
+        server = server_class(('127.0.0.1', 0), handler_class)
+        server.daemon_threads = True
+        if hasattr(server, 'content_dir'):
+            server.content_dir = fixture_dir
+        if self.configure is not None:
+            self.configure(server)
+        return server
+
+def use_gzip(server):
+    server.using_gzip = True
+
+def use_module_cache(server):
+    server.enable_module_cache(warmup=True)
+
+def disable_proxy_cache(server):
+    server.response_cache = None
+    server.flights = None
+
+gzip = [('Accept-Encoding', 'gzip')]
+
+scenarios = [
+    Scenario('min-hello', 'MinHTTPServer, tiny chunked body', 'min',
+             [('GET', '/', [])]),
+    Scenario('static-small', '1 KiB file', 'file',
+             [('GET', '/small.txt', [])]),
+    Scenario('static-small-close', '1 KiB file, a connection per request',
+             'file', [('GET', '/small.txt', [])], keep_alive=False),
+    Scenario('static-large', '8 MiB file', 'file',
+             [('GET', '/large.bin', [])]),
+    Scenario('static-range', 'single and multiple ranges of the 8 MiB file',
+             'file', [('GET', '/large.bin', [('Range', 'bytes=1048576-1114111')]),
+                      ('GET', '/large.bin', [('Range', 'bytes=0-99,4096-8191')])]),
+    Scenario('gzip-on', '64 KiB page, gzip', 'file',
+             [('GET', '/page.html', gzip)], use_gzip),
+    Scenario('gzip-off', '64 KiB page, no compression', 'file',
+             [('GET', '/page.html', gzip)]),
+    Scenario('listing', 'listing of 1000 files', 'file',
+             [('GET', '/dir/', [])]),
+    Scenario('script', 'pythonhttp script, ModuleCachePool', 'python',
+             [('GET', '/hello.py', [])], use_module_cache),
+    Scenario('script-uncached', 'pythonhttp script, imported every request',
+             'python', [('GET', '/hello.py', [])]),
+    Scenario('proxy', 'proxy of a 1 KiB file, no cache', 'proxy',
+             [('GET', '{origin}/small.txt', [])], disable_proxy_cache),
+    Scenario('proxy-cached', 'proxy of a 1 KiB file, from the cache', 'proxy',
+             [('GET', '{origin}/small.txt', [])]),
+]
+
+by_name = dict((scenario.name, scenario) for scenario in scenarios)
+
+# the origin of the proxy scenarios
+origin = Scenario('origin', 'origin of the proxy', 'file', [])
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
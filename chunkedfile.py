@@ -1,7 +1,7 @@
 '''
 Read and write chunked encoded data.
 
-RFC 2616, section 3.6.1
+RFC 2616, section 3.6.1 (RFC 7230, section 4.1)
 
 Chunked-Body   = *chunk
                  last-chunk
@@ -40,58 +40,97 @@ True
 >>> reader.close()
 '''
 
+import re
 from io import BytesIO
 
+chunk_size_re = re.compile(b'[0-9A-Fa-f]+')
+
+class ChunkedError(ValueError):
+    '''Chunked data which is malformed or over a limit.'''
+
 class ChunkedWriter(object):
+    r'''Write chunked encoded data to fileobj.
+    Data is gathered in a preallocated buffer of bufsize bytes, or written
+    as a chunk at once if bufsize <= 0. A chunk is framed and written with
+    a single fileobj.writev call when fileobj has it, like SocketWriter.
+
+    >>> from io import BytesIO
+    >>> buf = BytesIO()
+    >>> writer = ChunkedWriter(buf, bufsize=8)
+    >>> writer.write(memoryview(b'abc'))
+    3
+    >>> writer.write(bytearray(b'defghijk'))
+    8
+    >>> writer.end_file([('Digest', 'x')])
+    >>> buf.getvalue()
+    b'b\r\nabcdefghijk\r\n0\r\nDigest: x\r\n\r\n'
+    '''
     def __init__(self, fileobj, bufsize=4096):
         self.fileobj = fileobj
         self.bufsize = bufsize
-        self.buffer = BytesIO()
+        self.buffer = bytearray(max(bufsize, 0))
+        self.buffered = 0
         self.closed = False
         self.ended = False
 
     def write(self, data, flush=False):
         if self.closed or self.ended:
             raise ValueError('Operation is not allowed.')
-        if self.bufsize <= 0:
-            self.write_chunk(data)
-        else:
-            self.buffer.write(data)
-            if self.buffer.tell() >= self.bufsize or flush:
-                self.flush()
-        return len(data)
+        with memoryview(data) as view:
+            data = view.cast('B') if view.format != 'B' else view
+            size = len(data)
+            if self.bufsize <= 0:
+                self.write_chunk(data)
+            elif self.buffered + size < self.bufsize:
+                self.buffer[self.buffered:self.buffered + size] = data
+                self.buffered += size
+                if flush:
+                    self.flush()
+            else:
+                # frame what is buffered and data as one chunk, without copy
+                with memoryview(self.buffer) as buffered:
+                    self.write_chunk(buffered[:self.buffered], data)
+                self.buffered = 0
+        return size
 
-    def write_chunk(self, data):
+    def write_chunk(self, *pieces):
+        '''Write pieces of data as one chunk.'''
         if self.closed or self.ended:
             raise ValueError('Operation is not allowed.')
-        if not data:
+        size = sum(len(piece) for piece in pieces)
+        if not size:
             return
-        # chunk-size
-        self.fileobj.write('{:x}'.format(len(data)).encode(
-            'latin-1', 'strict'))
-        self.fileobj.write(b'\r\n')
-        # chunk-data
-        self.fileobj.write(data)
-        self.fileobj.write(b'\r\n')
+        # chunk-size CRLF chunk-data CRLF
+        self.writev(['{:x}\r\n'.format(size).encode('latin-1')] +
+                    [piece for piece in pieces if len(piece)] + [b'\r\n'])
+
+    def writev(self, buffers):
+        writev = getattr(self.fileobj, 'writev', None)
+        if writev is not None:
+            writev(buffers)
+        else:
+            for buf in buffers:
+                self.fileobj.write(buf)
 
     def flush(self):
         if self.closed:
             raise ValueError('Operation is not allowed.')
-        buffered = self.buffer.tell()
-        if buffered == 0: return
-        self.buffer.seek(0)
-        data = self.buffer.read(buffered)
-        self.write_chunk(data)
-        self.buffer.seek(0)
-
-    def end_file(self):
+        if not self.buffered:
+            return
+        with memoryview(self.buffer) as buffered:
+            self.write_chunk(buffered[:self.buffered])
+        self.buffered = 0
+
+    def end_file(self, trailers=()):
+        '''Write the last chunk, and trailers as (name, value) pairs.'''
         if self.closed:
             raise ValueError('Operation is not allowed.')
         self.flush()
-        # last-chunk
-        self.fileobj.write(b'0\r\n')
-        # end of Chunked-Body
-        self.fileobj.write(b'\r\n')
+        # last-chunk, trailer and the end of Chunked-Body
+        end = ['0\r\n']
+        end.extend('{}: {}\r\n'.format(name, value) for name, value in trailers)
+        end.append('\r\n')
+        self.writev([''.join(end).encode('latin-1')])
         self.ended = True
 
     def close(self):
@@ -103,48 +142,200 @@ class ChunkedWriter(object):
         self.closed = True
 
 class ChunkedReader(object):
-    def __init__(self, fileobj):
+    r'''Read chunked encoded data from fileobj.
+
+    read(size) and readinto fill the caller's buffer across chunks, read1
+    returns what the current chunk has at once. Extensions of the last
+    chunk are in extensions, the trailer fields in trailers. A chunk larger
+    than max_chunk_size or a body larger than max_size is an error.
+
+    >>> from io import BytesIO
+    >>> reader = ChunkedReader(BytesIO(
+    ...     b'4;name=v\r\nab\nc\r\n3\r\nde\n\r\n0\r\nDigest: x\r\n\r\n'))
+    >>> reader.readline(), reader.extensions
+    (b'ab\n', {'name': 'v'})
+    >>> buf = bytearray(10)
+    >>> reader.readinto(buf), bytes(buf[:4])
+    (4, b'cde\n')
+    >>> reader.eof, reader.trailers
+    (True, [('Digest', 'x')])
+    >>> for body in b'10\r\n', b'0x10\r\n', b'+10\r\n':
+    ...     try:
+    ...         ChunkedReader(BytesIO(body), max_chunk_size=8).read()
+    ...     except ChunkedError as error:
+    ...         print(error)
+    Chunk of 16 bytes is too large
+    Invalid chunk size
+    Invalid chunk size
+    '''
+    def __init__(self, fileobj, max_chunk_size=None, max_size=None,
+                 max_line=8192, max_trailers=100):
         self.fileobj = fileobj
-        self.buffer = BytesIO()
+        self.max_chunk_size = max_chunk_size
+        self.max_size = max_size
+        self.max_line = max_line
+        self.max_trailers = max_trailers
+        # bytes left in the current chunk, None before the first one
+        self.remaining = None
+        self.size = 0
+        self.extensions = {}
+        self.trailers = []
         self.eof = False
         self.closed = False
 
+    def readable(self):
+        return True
+
     def read(self, size=-1):
-        if self.closed:
-            raise ValueError('I/O operation on closed file.')
-        if self.eof: return b''
-        if size < 0:
-            data = b''
-            while not self.eof:
-                data += self.read_chunk()
-            return data
-        data = self.buffer.read(size)
-        if len(data) != size:
-            self.buffer = BytesIO(self.read_chunk())
-            data += self.buffer.read(size - len(data))
+        if size is None or size < 0:
+            return self.readall()
+        buf = bytearray(size)
+        n = self.readinto(buf)
+        del buf[n:]
+        return bytes(buf)
+
+    def readall(self):
+        data = []
+        while True:
+            chunk = self.read1()
+            if not chunk:
+                return b''.join(data)
+            data.append(chunk)
+
+    def readinto(self, b):
+        '''Fill b until the end of the body, return the number of bytes read.'''
+        with memoryview(b) as view:
+            view = view.cast('B') if view.format != 'B' else view
+            filled = 0
+            while filled < len(view):
+                n = self.readinto1(view[filled:])
+                if not n:
+                    break
+                filled += n
+            return filled
+
+    def readinto1(self, b):
+        '''Read into b from the current chunk only.'''
+        if not self.next_chunk():
+            return 0
+        with memoryview(b) as view:
+            view = view[:self.remaining]
+            readinto = getattr(self.fileobj, 'readinto', None)
+            if readinto is not None:
+                n = readinto(view)
+            else:
+                data = self.fileobj.read(len(view))
+                n = len(data)
+                view[:n] = data
+        if not n:
+            raise ChunkedError('Chunked body ended within a chunk')
+        self.remaining -= n
+        return n
+
+    def read1(self, size=-1):
+        '''Read up to size bytes, -1 for all, from the current chunk only.'''
+        if not self.next_chunk():
+            return b''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size)
+        if not data:
+            raise ChunkedError('Chunked body ended within a chunk')
+        self.remaining -= len(data)
         return data
 
+    def readline(self, size=-1):
+        line = []
+        while size != 0:
+            if not self.next_chunk():
+                break
+            limit = self.remaining if size < 0 else min(size, self.remaining)
+            data = self.fileobj.readline(limit)
+            if not data:
+                raise ChunkedError('Chunked body ended within a chunk')
+            self.remaining -= len(data)
+            if size > 0:
+                size -= len(data)
+            line.append(data)
+            if data.endswith(b'\n'):
+                break
+        return b''.join(line)
+
     def read_chunk(self):
+        '''Read the rest of the current chunk, or the next one.'''
+        return self.read1()
+
+    def next_chunk(self):
+        '''Start the next chunk if the current one is consumed.
+        Return False at the end of the body.
+        '''
         if self.closed:
             raise ValueError('I/O operation on closed file.')
         if self.eof:
-            raise ValueError('File ended.')
-        # chunk-size
-        size = self.fileobj.readline().strip()
-        size = int(size.decode(), 16)
+            return False
+        if self.remaining:
+            return True
+        if self.remaining is not None:
+            # CRLF after chunk-data
+            if self.readline_raw() != b'':
+                raise ChunkedError('Expecting \\r\\n after data')
+        # chunk-size [ chunk-ext ] CRLF
+        size, sep, extensions = self.readline_raw().partition(b';')
+        # int() would take a sign, a 0x prefix or underscores too
+        size = size.strip(b' \t')
+        if not chunk_size_re.fullmatch(size):
+            raise ChunkedError('Invalid chunk size')
+        size = int(size, 16)
+        if self.max_chunk_size is not None and size > self.max_chunk_size:
+            raise ChunkedError('Chunk of {} bytes is too large'.format(size))
+        self.size += size
+        if self.max_size is not None and self.size > self.max_size:
+            raise ChunkedError('Chunked body is too large')
+        self.extensions = parse_extensions(extensions)
+        self.remaining = size
         if size == 0:
+            self.read_trailers()
             self.eof = True
-            del self.fileobj
-            return b''
-        # chunk-data
-        data = self.fileobj.read(size)
-        if self.fileobj.read(2) != b'\r\n':
-            raise ValueError('Excepting \\r\\n after data.')
-        return data
+            return False
+        return True
+
+    def read_trailers(self):
+        while True:
+            line = self.readline_raw()
+            if not line:
+                return
+            if len(self.trailers) >= self.max_trailers:
+                raise ChunkedError('Too many trailer fields')
+            name, sep, value = line.decode('latin-1').partition(':')
+            if not sep or not name or name != name.strip():
+                raise ChunkedError('Invalid trailer field')
+            self.trailers.append((name, value.strip()))
+
+    def readline_raw(self):
+        '''Read a line of the framing, without its line end.'''
+        line = self.fileobj.readline(self.max_line + 1)
+        if len(line) > self.max_line:
+            raise ChunkedError('Chunk framing line is too long')
+        if not line.endswith(b'\n'):
+            raise ChunkedError('Chunked body ended unexpectedly')
+        return line.rstrip(b'\r\n')
 
     def close(self):
         self.closed = True
 
+def parse_extensions(extensions):
+    '''Parse chunk-ext, ;name[=value] pairs, to a dict.'''
+    parsed = {}
+    for extension in extensions.decode('latin-1').split(';'):
+        name, sep, value = extension.partition('=')
+        name = name.strip()
+        if name:
+            value = value.strip()
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            parsed[name] = value if sep else None
+    return parsed
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -0,0 +1,194 @@
+'''
+Collapsing of concurrent identical requests into one upstream fetch.
+
+The first request of a key leads a Flight: it fetches the response and
+feeds it to the flight while it sends it to its own client. Requests of
+the same key arriving meanwhile follow the flight and receive the body as
+it comes, from its first byte, unless the flight has buffered more than
+max_buffer bytes already: the request then leads a new flight.
+
+>>> flights = Flights(max_buffer=3)
+>>> flight, leader = flights.join('k', 'a')
+>>> follower, following = flights.join('k', 'b')
+>>> leader, following, follower is flight
+(True, False, True)
+>>> flight.start(200, 'OK', [('Content-Length', '4')], {})
+>>> flight.write(b'ab')
+>>> body = follower.body('b', timeout=1)
+>>> next(body)
+b'ab'
+>>> flight.write(b'cd')
+>>> replacement, leader = flights.join('k', 'c')
+>>> replacement is flight, leader
+(False, True)
+>>> flight.commit()
+>>> list(body)
+[b'cd']
+>>> flight.leave('b')
+>>> flight.chunks
+[]
+>>> flights.land('k', flight)
+>>> flights.land('k', replacement)
+>>> flights.flights
+{}
+'''
+
+import threading
+
+class FlightAborted(Exception):
+    pass
+
+class Flight(object):
+    '''A response fetched by a leader and shared with followers.
+
+    state is 'pending' until the leader knows the response, then
+    'streaming', 'done' when the body is complete, 'failed' if the response
+    cannot be shared or broke, or 'revalidated' if a stored response was
+    revalidated instead.
+
+    The body is buffered from its first byte for followers which may still
+    join, up to max_buffer bytes. Past that, the flight takes no more
+    followers and only keeps the chunks its followers have not read yet,
+    none once they have all left.
+    '''
+    def __init__(self, max_buffer=8 << 20):
+        self.cond = threading.Condition()
+        self.state = 'pending'
+        self.response = None
+        self.entry = None
+        self.max_buffer = max_buffer
+        self.joinable = True
+        # chunks[0] is chunk first of the body, buffered is their size
+        self.chunks = []
+        self.first = 0
+        self.buffered = 0
+        # index of the next chunk of each follower
+        self.positions = {}
+
+    def add_follower(self, follower):
+        '''Follow the flight from the first chunk, False if it is too late.'''
+        with self.cond:
+            if not self.joinable:
+                return False
+            self.positions[follower] = 0
+            return True
+
+    def leave(self, follower):
+        '''Stop following, the chunks are not kept for follower anymore.'''
+        with self.cond:
+            self.positions.pop(follower, None)
+            self.trim()
+
+    def start(self, status, reason, headers, request_headers):
+        with self.cond:
+            self.response = status, reason, headers, request_headers
+            self.state = 'streaming'
+            self.cond.notify_all()
+
+    def write(self, data):
+        with self.cond:
+            self.chunks.append(data)
+            self.buffered += len(data)
+            if self.buffered > self.max_buffer:
+                self.joinable = False
+            self.trim()
+            self.cond.notify_all()
+
+    def trim(self):
+        '''Drop the chunks every follower has read, once none can join.'''
+        if self.joinable:
+            return
+        end = self.first + len(self.chunks)
+        read = min(self.positions.values(), default=end) - self.first
+        if read:
+            self.buffered -= sum(len(chunk) for chunk in self.chunks[:read])
+            del self.chunks[:read]
+            self.first += read
+
+    def commit(self):
+        self.finish('done')
+
+    def abort(self):
+        self.finish('failed')
+
+    def revalidated(self, entry):
+        '''Share a stored response the upstream server confirmed with 304.'''
+        self.entry = entry
+        self.finish('revalidated')
+
+    def finish(self, state):
+        with self.cond:
+            if self.state in ('pending', 'streaming'):
+                self.state = state
+            self.cond.notify_all()
+
+    def wait(self, timeout):
+        '''Wait until the response is known, return the state.'''
+        with self.cond:
+            self.cond.wait_for(lambda: self.state != 'pending', timeout)
+            return self.state
+
+    def body(self, follower, timeout):
+        '''Yield the chunks of the body to follower, as the leader receives
+        them. Raise FlightAborted if the body breaks or stalls for timeout.
+        '''
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(
+                        lambda: self.positions[follower] <
+                        self.first + len(self.chunks) or
+                        self.state != 'streaming', timeout):
+                    raise FlightAborted('Upstream response stalled.')
+                chunks = self.chunks[self.positions[follower] - self.first:]
+                state = self.state
+                self.positions[follower] += len(chunks)
+                self.trim()
+            for chunk in chunks:
+                yield chunk
+            if state != 'streaming':
+                if state != 'done':
+                    raise FlightAborted('Upstream response broke.')
+                return
+
+class Flights(object):
+    '''Flights in progress, by key.
+    Followers wait up to wait_timeout for the response of the leader,
+    then fall back to a fetch of their own. A flight buffers up to
+    max_buffer bytes of its body for followers, see Flight.
+    '''
+    def __init__(self, wait_timeout=10, max_buffer=8 << 20):
+        self.wait_timeout = wait_timeout
+        self.max_buffer = max_buffer
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.led = 0
+        self.collapsed = 0
+        self.fallbacks = 0
+
+    def join(self, key, follower):
+        '''Return (flight, leader) where leader is True for a new flight.
+        A flight which takes no more followers is replaced by a new one.
+        A follower has to leave the flight once done with it.
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and flight.add_follower(follower):
+                return flight, False
+            flight = self.flights[key] = Flight(self.max_buffer)
+            self.led += 1
+            return flight, True
+
+    def land(self, key, flight):
+        '''End a flight of its leader. Followers keep reading its body.'''
+        flight.abort()
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
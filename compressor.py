@@ -0,0 +1,224 @@
+'''
+Compression of responses on the fly.
+
+A CompressionPolicy decides whether a response is worth compressing, by
+its Content-Type and Content-Length, and negotiates the content-coding
+with Accept-Encoding q-values. gzip and deflate are always available,
+zstd when the runtime has it. The compression level is lowered as the
+load of the machine or the queue of the server grows.
+
+>>> parse_accept_encoding('gzip;q=0.5, deflate, br;q=0, *;q=0.1')
+{'gzip': 0.5, 'deflate': 1.0, 'br': 0.0, '*': 0.1}
+>>> policy = CompressionPolicy()
+>>> policy.negotiate('gzip;q=0.5, deflate', 'text/html')
+'deflate'
+>>> policy.negotiate('gzip', 'image/jpeg') is None
+True
+>>> policy.negotiate('gzip', 'text/css', length=100) is None
+True
+>>> import io, zlib
+>>> buf = io.BytesIO()
+>>> encoder = policy.open('gzip', buf, 6)
+>>> encoder.write(b'hello ' * 100)
+600
+>>> encoder.close()
+>>> zlib.decompress(buf.getvalue(), 31) == b'hello ' * 100
+True
+'''
+
+import os
+import threading
+import time
+import zlib
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def parse_accept_encoding(value):
+    '''Codings of an Accept-Encoding value with their q-values.'''
+    accepted = {}
+    for item in (value or '').split(','):
+        coding, *params = item.split(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, sep, number = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = min(max(float(number), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        accepted[coding] = q
+    return accepted
+
+class ZstdCompressor(object):
+    '''zstd compressor with the compress and flush methods of zlib.'''
+    def __init__(self, level):
+        if zstd is not None:
+            self.compressor = zstd.ZstdCompressor(level)
+            self.block = zstd.ZstdCompressor.FLUSH_BLOCK
+            self.frame = zstd.ZstdCompressor.FLUSH_FRAME
+        else:
+            self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self.block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            self.frame = zstandard.COMPRESSOBJ_FLUSH_FINISH
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self, mode=zlib.Z_FINISH):
+        return self.compressor.flush(
+            self.block if mode == zlib.Z_SYNC_FLUSH else self.frame)
+
+class Encoder(object):
+    '''Writable file object which compresses to fileobj.
+    flush sends what is compressed so far, close ends the stream.
+    '''
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+
+    def write(self, data):
+        compressed = self.compressor.compress(data)
+        if compressed:
+            self.fileobj.write(compressed)
+        return len(data)
+
+    def flush(self):
+        compressed = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if compressed:
+            self.fileobj.write(compressed)
+        self.fileobj.flush()
+
+    def close(self):
+        if self.compressor is None:
+            return
+        compressed = self.compressor.flush(zlib.Z_FINISH)
+        self.compressor = None
+        if compressed:
+            self.fileobj.write(compressed)
+
+class CompressionPolicy(object):
+    '''Which responses to compress, with which coding and level.
+
+    Types listed in allow are compressed, then those matching deny are
+    not, those matching allow are, others if compress_unknown. A pattern
+    ending with '/' matches a type prefix, one starting with '+' a
+    structured syntax suffix.
+    Bodies known to be smaller than min_size are sent as they are.
+    level is lowered down to min_level as the load average per CPU, or
+    the queue of the server relative to its size, goes from low_load to
+    high_load.
+    '''
+
+    allow = ('text/', '+xml', '+json', 'application/json',
+             'application/javascript', 'application/ecmascript',
+             'application/xml', 'application/wasm', 'application/x-python',
+             'image/svg+xml', 'image/x-icon', 'image/bmp', 'font/ttf',
+             'font/otf', 'application/vnd.ms-fontobject')
+    deny = ('video/', 'audio/', 'image/', 'font/woff', 'font/woff2',
+            'application/zip', 'application/gzip', 'application/x-gzip',
+            'application/x-bzip2', 'application/x-xz', 'application/zstd',
+            'application/x-7z-compressed', 'application/pdf',
+            'application/octet-stream')
+    compress_unknown = False
+    min_size = 1024
+    level = 6
+    min_level = 1
+    low_load = 0.5
+    high_load = 1.0
+    sample_interval = 1
+
+    def __init__(self):
+        self.codings = ['gzip', 'deflate']
+        if zstd is not None or zstandard is not None:
+            self.codings.insert(0, 'zstd')
+        self._templates = {}
+        self._lock = threading.Lock()
+        self._sampled = None
+        self._cpu_load = 0.0
+
+    def compressible(self, ctype, length=None):
+        '''Whether a response of this type and length is worth compressing.'''
+        if length is not None and int(length) < self.min_size:
+            return False
+        if ctype is None:
+            return self.compress_unknown
+        ctype = ctype.split(';')[0].strip().lower()
+        if ctype in self.allow:
+            return True
+        if any(self.matches(ctype, pattern) for pattern in self.deny):
+            return False
+        if any(self.matches(ctype, pattern) for pattern in self.allow):
+            return True
+        return self.compress_unknown
+
+    @staticmethod
+    def matches(ctype, pattern):
+        if pattern.endswith('/'):
+            return ctype.startswith(pattern)
+        if pattern.startswith('+'):
+            return ctype.endswith(pattern)
+        return ctype == pattern
+
+    def negotiate(self, accept_encoding, ctype=None, length=None):
+        '''Return the coding to compress a response with, None for identity.'''
+        if not accept_encoding or not self.compressible(ctype, length):
+            return None
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for coding in self.codings:
+            q = accepted.get(coding, accepted.get('*', 0.0))
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def current_level(self, server=None):
+        '''Compression level for the current load.'''
+        load = self.load(server)
+        if load <= self.low_load:
+            return self.level
+        if load >= self.high_load:
+            return self.min_level
+        fraction = (load - self.low_load) / (self.high_load - self.low_load)
+        return round(self.level - (self.level - self.min_level) * fraction)
+
+    def load(self, server=None):
+        now = time.monotonic()
+        if self._sampled is None or now - self._sampled > self.sample_interval:
+            self._sampled = now
+            if hasattr(os, 'getloadavg'):
+                self._cpu_load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        load = self._cpu_load
+        queue_size = getattr(server, 'queue_size', None)
+        if queue_size:
+            load = max(load, getattr(server, 'queue_depth', 0) / queue_size)
+        return load
+
+    def open(self, coding, fileobj, level):
+        '''Return an Encoder of coding writing to fileobj.'''
+        if coding == 'zstd':
+            return Encoder(fileobj, ZstdCompressor(level))
+        # copying a prepared compressobj is cheaper than making a new one
+        key = coding, level
+        template = self._templates.get(key)
+        if template is None:
+            wbits = 31 if coding == 'gzip' else 15
+            template = zlib.compressobj(level, zlib.DEFLATED, wbits)
+            with self._lock:
+                self._templates.setdefault(key, template)
+        return Encoder(fileobj, template.copy())
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,161 @@
+'''
+Keep-alive connections to upstream HTTP servers.
+
+>>> pool = ConnectionPool(max_per_host=1)
+>>> conn, reused = pool.get('http', 'localhost', 80)
+>>> other, reused = pool.get('http', 'localhost', 80)
+>>> reused, pool.total
+(False, 2)
+>>> pool.discard(other)
+>>> pool.total
+1
+'''
+
+import collections
+import http.client
+import select
+import threading
+import time
+
+class ConnectionPool(object):
+    '''Pool of persistent http.client connections, per (scheme, host, port).
+
+    A connection is checked out with get, an idle one if there is one,
+    otherwise a new one, so requests never wait for each other. It is
+    returned with put, or discard if it cannot be reused. At most
+    max_per_host idle connections are kept per host and max_total in all,
+    a connection returned beyond these is closed, or the oldest idle one
+    of another host. Idle connections are closed after idle_timeout, and
+    checked before reuse: a readable idle socket has been closed by the
+    upstream server or is out of sync.
+    '''
+    def __init__(self, max_per_host=8, max_total=256, idle_timeout=30,
+                 timeout=30, blocksize=64 << 10):
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.blocksize = blocksize
+        self.idle = {}
+        self.count = collections.Counter()
+        self.total = 0
+        self.idle_total = 0
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+        self.retried = 0
+
+    def get(self, scheme, host, port):
+        '''Check out a connection. Return (connection, reused).'''
+        key = scheme, host, port
+        with self.lock:
+            conn = self._pop_idle(key)
+            if conn is not None:
+                self.reused += 1
+                return conn, True
+            self.count[key] += 1
+            self.total += 1
+            self.created += 1
+        try:
+            conn = self.connect(scheme, host, port)
+        except:
+            with self.lock:
+                self._forget(key)
+            raise
+        conn.pool_key = key
+        return conn, False
+
+    def connect(self, scheme, host, port):
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        # size of the blocks of a streamed request body
+        conn.blocksize = self.blocksize
+        return conn
+
+    def put(self, conn):
+        '''Return a connection whose last response has been read entirely.'''
+        if conn.sock is None:
+            self.discard(conn)
+            return
+        with self.lock:
+            idle = self.idle.setdefault(conn.pool_key, [])
+            if len(idle) < self.max_per_host:
+                if self.idle_total >= self.max_total:
+                    self._close_oldest_idle()
+                if self.idle_total < self.max_total:
+                    idle.append((conn, time.monotonic()))
+                    self.idle_total += 1
+                    return
+        self.discard(conn)
+
+    def discard(self, conn):
+        '''Close a checked out connection and forget it.'''
+        conn.close()
+        with self.lock:
+            self.discarded += 1
+            self._forget(conn.pool_key)
+
+    def idle_count(self):
+        return self.idle_total
+
+    def close(self):
+        with self.lock:
+            for key, idle in list(self.idle.items()):
+                for conn, released in idle:
+                    conn.close()
+                    self._forget(key)
+            self.idle.clear()
+            self.idle_total = 0
+
+    def _pop_idle(self, key):
+        idle = self.idle.get(key)
+        while idle:
+            conn, released = idle.pop()
+            self.idle_total -= 1
+            if (time.monotonic() - released < self.idle_timeout and
+                    self.healthy(conn)):
+                return conn
+            conn.close()
+            self._forget(key)
+        return None
+
+    def _close_oldest_idle(self):
+        oldest = None
+        for key, idle in self.idle.items():
+            if idle and (oldest is None or idle[0][1] < oldest[1][0][1]):
+                oldest = key, idle
+        if oldest is not None:
+            key, idle = oldest
+            conn, released = idle.pop(0)
+            self.idle_total -= 1
+            conn.close()
+            self._forget(key)
+
+    def _forget(self, key):
+        self.count[key] -= 1
+        if not self.count[key]:
+            del self.count[key]
+            self.idle.pop(key, None)
+        self.total -= 1
+
+    @staticmethod
+    def healthy(conn):
+        '''An idle connection is healthy if nothing can be read from it.'''
+        if conn.sock is None:
+            return False
+        try:
+            if hasattr(select, 'poll'):
+                poller = select.poll()
+                poller.register(conn.sock, select.POLLIN)
+                return not poller.poll(0)
+            readable, writable, failed = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
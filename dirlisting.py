@@ -0,0 +1,200 @@
+'''
+Directory listings for FileHTTPRequestHandler.
+
+Directories are read with os.scandir, which knows whether an entry is a
+directory or a link without extra stat calls, and sorted once per mtime of
+the directory. Sizes and mtimes of entries are not cached longer than
+details_ttl seconds, since rewriting a file does not change the mtime of
+its directory. Listings are rendered as HTML or JSON, piece by piece, so a
+huge directory can be streamed instead of built in memory.
+
+>>> entries = [Entry('a', True, False), Entry('b', False, False)]
+>>> listing = Listing('/', 0, entries)
+>>> b''.join(render_html(listing, '/', 'utf-8')).count(b'<li>')
+2
+>>> import json
+>>> json.loads(b''.join(render_json(listing, '/', limit=1)).decode())
+{'path': '/', 'total': 2, 'offset': 0, 'entries': [{'name': 'a', 'type': 'directory', 'size': None, 'mtime': None}], 'next': 1}
+'''
+
+import collections
+import html
+import json
+import os
+import time
+import urllib.parse
+from filecache import LRUCache
+
+Entry = collections.namedtuple('Entry', 'name is_dir is_link')
+
+class Listing(object):
+    '''Sorted entries of a directory as it was at mtime_ns.'''
+    details_ttl = 1
+
+    def __init__(self, path, mtime_ns, entries):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self._details = None
+
+    @classmethod
+    def scan(cls, path):
+        fs = os.stat(path)
+        entries = []
+        it = os.scandir(path)
+        try:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                entries.append(Entry(entry.name, is_dir, entry.is_symlink()))
+        finally:
+            if hasattr(it, 'close'):
+                it.close()
+        entries.sort(key=lambda entry: entry.name.lower())
+        return cls(path, fs.st_mtime_ns, entries)
+
+    def details(self, index):
+        '''Return (size, mtime) of an entry, stat when first asked and once
+        the last stat is details_ttl seconds old.
+        '''
+        if self._details is None:
+            self._details = [None] * len(self.entries)
+        now = time.monotonic()
+        details = self._details[index]
+        if details is None or now - details[2] >= self.details_ttl:
+            fullname = os.path.join(self.path, self.entries[index].name)
+            try:
+                st = os.stat(fullname)
+            except OSError:
+                try:
+                    st = os.lstat(fullname)
+                except OSError:
+                    st = None
+            details = (st.st_size, st.st_mtime, now) if st else (None, None, now)
+            self._details[index] = details
+        return details[:2]
+
+    def __len__(self):
+        return len(self.entries)
+
+class ListingCache(object):
+    '''Listings of directories, and rendered HTML pages of up to
+    max_rendered_entries entries. JSON pages, which hold the sizes and
+    mtimes of entries, are rendered for every request.
+    A listing is used while the mtime of its directory does not change.
+    '''
+    def __init__(self, max_entries=1000000, max_rendered=16 << 20,
+                 max_rendered_entries=1000):
+        self.listings = LRUCache(max_entries)
+        self.rendered = LRUCache(max_rendered)
+        self.max_rendered_entries = max_rendered_entries
+
+    def get(self, path):
+        listing = self.listings.get(path)
+        if listing is not None:
+            if os.stat(path).st_mtime_ns == listing.mtime_ns:
+                return listing
+        listing = Listing.scan(path)
+        self.listings.put(path, listing, len(listing) + 1)
+        return listing
+
+    def clear(self):
+        self.listings.clear()
+        self.rendered.clear()
+
+def page(listing, offset=0, limit=None):
+    '''Indices of the entries of a page.'''
+    end = len(listing) if limit is None else min(offset + limit, len(listing))
+    return range(min(offset, len(listing)), end)
+
+def render_html(listing, displaypath, enc, offset=0, limit=None,
+                entries_per_piece=1000):
+    '''Yield an HTML listing in encoded pieces.'''
+    displaypath = html.escape(displaypath)
+    title = 'Directory listing for %s' % displaypath
+    r = []
+    r.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" '
+             '"http://www.w3.org/TR/html4/strict.dtd">')
+    r.append('<html>\n<head>')
+    r.append('<meta http-equiv="Content-Type" '
+             'content="text/html; charset=%s">' % enc)
+    r.append('<title>%s</title>\n</head>' % title)
+    r.append('<body>\n<h1>%s</h1>' % title)
+    r.append('<hr>\n<ul>')
+    indices = page(listing, offset, limit)
+    for i in indices:
+        name, is_dir, is_link = listing.entries[i]
+        displayname = linkname = name
+        # Append / for directories or @ for symbolic links
+        if is_dir:
+            displayname = name + '/'
+            linkname = name + '/'
+        if is_link:
+            displayname = name + '@'
+            # Note: a link to a directory displays with @ and links with /
+        r.append('<li><a href="%s">%s</a></li>'
+                % (urllib.parse.quote(linkname,
+                                      errors='surrogatepass'),
+                   html.escape(displayname)))
+        if len(r) >= entries_per_piece:
+            yield ('\n'.join(r) + '\n').encode(enc, 'surrogateescape')
+            r = []
+    r.append('</ul>')
+    if indices.stop < len(listing):
+        r.append('<p><a href="?offset=%d&amp;limit=%d">Next page</a></p>'
+                 % (indices.stop, len(indices)))
+    r.append('<hr>\n</body>\n</html>\n')
+    yield '\n'.join(r).encode(enc, 'surrogateescape')
+
+def render_json(listing, displaypath, offset=0, limit=None,
+                entries_per_piece=1000):
+    '''Yield a JSON listing with sizes and mtimes in UTF-8 pieces.'''
+    indices = page(listing, offset, limit)
+    head = {'path': displaypath, 'total': len(listing), 'offset': indices.start}
+    yield json.dumps(head)[:-1].encode('utf-8', 'surrogateescape')
+    yield b', "entries": ['
+    r = []
+    for i in indices:
+        name, is_dir, is_link = listing.entries[i]
+        size, mtime = listing.details(i)
+        kind = 'link' if is_link else 'directory' if is_dir else 'file'
+        r.append(json.dumps({'name': name, 'type': kind,
+                             'size': size, 'mtime': mtime}))
+        if len(r) >= entries_per_piece:
+            yield (', '.join(r)).encode('utf-8', 'surrogateescape')
+            yield b', ' if i + 1 < indices.stop else b''
+            r = []
+    yield (', '.join(r)).encode('utf-8', 'surrogateescape')
+    next_offset = indices.stop if indices.stop < len(listing) else None
+    yield ('], "next": %s}' % json.dumps(next_offset)).encode('utf-8')
+
+class IterFile(object):
+    '''Read-only file object over an iterable of bytes.'''
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.pending = b''
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.pending + b''.join(self.iterator)
+            self.pending = b''
+            return data
+        while not self.pending:
+            self.pending = next(self.iterator, None)
+            if self.pending is None:
+                self.pending = b''
+                return b''
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if close:
+            close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,300 @@
+'''
+Caches used by FileHTTPServer.
+
+>>> cache = LRUCache(10)
+>>> cache.put('a', b'12345', 5)
+>>> cache.put('b', b'1234567', 7)
+>>> cache.get('a') is None
+True
+>>> cache.get('b')
+b'1234567'
+>>> cache.size, cache.evictions
+(7, 1)
+'''
+
+import collections
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+class LRUCache(object):
+    '''Thread-safe mapping bounded by the total size of its values.
+    The least recently used entries are evicted first.
+    '''
+    def __init__(self, max_size, max_entries=None):
+        self.max_size = max_size
+        self.max_entries = max_entries
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=1):
+        if size > self.max_size:
+            return
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                old = self._remove(key)
+                if old[1] != value:
+                    evicted.append(old)
+            self.entries[key] = value, size
+            self.size += size
+            while (self.size > self.max_size or
+                   self.max_entries is not None and
+                   len(self.entries) > self.max_entries):
+                oldest = next(iter(self.entries))
+                evicted.append(self._remove(oldest))
+                self.evictions += 1
+        for key, value in evicted:
+            self.evict(key, value)
+
+    def pop(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            key, value = self._remove(key)
+        self.evict(key, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            evicted = [(key, value) for key, (value, size) in self.entries.items()]
+            self.entries.clear()
+            self.size = 0
+        for key, value in evicted:
+            self.evict(key, value)
+
+    def _remove(self, key):
+        value, size = self.entries.pop(key)
+        self.size -= size
+        return key, value
+
+    def evict(self, key, value):
+        '''Called outside the lock for every entry dropped from the cache.'''
+        pass
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self.entries),
+                'size': self.size}
+
+class DiskLRUCache(LRUCache):
+    '''LRUCache whose values are file names, removed on eviction.'''
+    def evict(self, key, value):
+        try:
+            os.remove(value)
+        except OSError:
+            pass
+
+Resolved = collections.namedtuple('Resolved', 'kind path stat ctype validators')
+Resolved.__doc__ = '''Result of resolving a request path.
+kind is one of 'file', 'directory', 'redirect' and 'missing'.
+validators is a tuple of (path, stat_signature(stat) or None if missing).
+'''
+
+def stat_signature(st):
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+def still_valid(validators):
+    '''Whether every path of validators is still in the same state.'''
+    for path, signature in validators:
+        try:
+            st = os.stat(path)
+        except OSError:
+            if signature is not None:
+                return False
+            continue
+        if signature != stat_signature(st):
+            return False
+    return True
+
+class ResolveCache(object):
+    '''Resolved request paths, including those which do not exist.
+    An entry is trusted for ttl seconds. After that it is checked again by
+    stat of its validators, which is cheaper than resolving the path again.
+    '''
+    def __init__(self, max_entries=10000, ttl=1):
+        self.entries = LRUCache(max_entries)
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        resolved, checked = entry
+        now = time.monotonic()
+        if now - checked < self.ttl:
+            return resolved
+        if not still_valid(resolved.validators):
+            self.entries.pop(key)
+            return None
+        entry[1] = now
+        return resolved
+
+    def put(self, key, resolved):
+        self.entries.put(key, [resolved, time.monotonic()])
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return self.entries.stats()
+
+CachedFile = collections.namedtuple('CachedFile', 'signature headers body')
+
+class ContentCache(object):
+    '''Content of small files kept in memory.
+    Files up to max_file_size are cached, evicting the least recently used
+    ones to stay within max_size bytes. An entry is used only while the
+    stat of its file still has the same inode, size and mtime.
+    '''
+    def __init__(self, max_size=64 << 20, max_file_size=256 << 10):
+        self.entries = LRUCache(max_size)
+        self.max_file_size = max_file_size
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def evictions(self):
+        return self.entries.evictions
+
+    @property
+    def size(self):
+        return self.entries.size
+
+    def get(self, path, fs):
+        '''Return the CachedFile of path if it matches the stat result fs.'''
+        entry = self.entries.get(path)
+        if entry is not None and entry.signature == stat_signature(fs):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def load(self, path, fs, headers):
+        '''Read path into the cache with its prebuilt header lines.
+        Return the CachedFile, or None if the file is too large or changed.
+        '''
+        if fs.st_size > self.max_file_size:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                if stat_signature(os.fstat(f.fileno())) != stat_signature(fs):
+                    return None
+                body = f.read(fs.st_size + 1)
+        except OSError:
+            return None
+        if len(body) != fs.st_size:
+            return None
+        entry = CachedFile(stat_signature(fs), headers, body)
+        self.entries.put(path, entry, len(headers) + len(body))
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        # hits of the LRUCache may still be stale files
+        return dict(self.entries.stats(), hits=self.hits, misses=self.misses)
+
+class GzipCache(object):
+    '''Gzip compressed variants of static files.
+
+    A sidecar file (path + '.gz') not older than the file itself is served
+    as is. Otherwise the file is compressed once and the result is kept in
+    memory, or in cache_dir when it is larger than max_memory_file.
+    Variants are keyed by path, mtime and size, so a changed file is
+    compressed again and the stale variant ages out of the cache.
+    '''
+    def __init__(self, max_memory=32 << 20, max_memory_file=1 << 20,
+                 cache_dir=None, max_disk=1 << 30):
+        self.memory = LRUCache(max_memory)
+        self.max_memory_file = max_memory_file
+        self.cache_dir = cache_dir
+        self.disk = DiskLRUCache(max_disk)
+        self.use_sidecar = True
+
+    def get(self, path, fs, compress_level=9):
+        '''Return (fileobj, size) of the gzipped content of path, or None if
+        the file cannot be cached and has to be compressed on the fly.
+        fs is the stat result of path.
+        '''
+        if self.use_sidecar:
+            variant = self.open_sidecar(path, fs)
+            if variant:
+                return variant
+        key = path, fs.st_mtime_ns, fs.st_size
+        data = self.memory.get(key)
+        if data is not None:
+            return io.BytesIO(data), len(data)
+        if fs.st_size <= self.max_memory_file:
+            with open(path, 'rb') as f:
+                data = self.compress(f, fs, compress_level).getvalue()
+            self.memory.put(key, data, len(data))
+            return io.BytesIO(data), len(data)
+        if self.cache_dir:
+            return self.open_disk(key, path, fs, compress_level)
+        return None
+
+    def open_sidecar(self, path, fs):
+        try:
+            f = open(path + '.gz', 'rb')
+        except OSError:
+            return None
+        gs = os.fstat(f.fileno())
+        if gs.st_mtime < fs.st_mtime:
+            f.close()
+            return None
+        return f, gs.st_size
+
+    def open_disk(self, key, path, fs, compress_level):
+        name = hashlib.sha1(repr(key).encode('utf-8', 'surrogateescape'))
+        name = os.path.join(self.cache_dir, name.hexdigest() + '.gz')
+        try:
+            f = open(name, 'rb')
+        except OSError:
+            with open(path, 'rb') as source:
+                with tempfile.NamedTemporaryFile(dir=self.cache_dir,
+                                                 delete=False) as temp:
+                    self.compress(source, fs, compress_level, temp)
+            os.replace(temp.name, name)
+            f = open(name, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        self.disk.put(key, name, size)
+        return f, size
+
+    def compress(self, source, fs, compress_level, target=None):
+        if target is None:
+            target = io.BytesIO()
+        # a fixed mtime in the gzip header keeps the variant reproducible
+        with gzip.GzipFile(filename='', mode='wb', fileobj=target,
+                           compresslevel=compress_level,
+                           mtime=int(fs.st_mtime)) as gzip_file:
+            shutil.copyfileobj(source, gzip_file)
+        return target
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -3,16 +3,23 @@ from http.server import SimpleHTTPRequestHandler
 import os
 from http import HTTPStatus
 import urllib.parse
-import html
 import sys
 import io
 import posixpath
+import stat
+import time
 from servers import run_server
-from minhttp import MinHTTPRequestHandler, MinHTTPServer
-from rangedfile import RangedFile
+from minhttp import MinHTTPRequestHandler, MinHTTPServer, SocketWriter
+from rangedfile import RangedFile, MultipartRanges, parse_range, content_range
+from filecache import GzipCache, ResolveCache, ContentCache, Resolved, stat_signature
+from dirlisting import Listing, ListingCache, IterFile, page, render_html, render_json
+from httputil import parse_http_date, etag_matches
 
 __version__ = '0.1'
 
+conditional_headers = ('If-Match', 'If-None-Match', 'If-Modified-Since',
+                       'If-Unmodified-Since')
+
 class FileHTTPRequestHandler(MinHTTPRequestHandler,
                              SimpleHTTPRequestHandler):
     '''Extended SimpleHTTPRequestHandler with HTTP request header Range supported.'''
@@ -22,6 +29,8 @@ class FileHTTPRequestHandler(MinHTTPRequestHandler,
 
     def do_GET(self):
         '''Same as SimpleHTTPRequestHandler, but we use self.outfile instead of self.wfile.'''
+        if self.send_cached():
+            return
         f = self.send_head()
         if f:
             self.start_body()
@@ -31,139 +40,376 @@ class FileHTTPRequestHandler(MinHTTPRequestHandler,
                 f.close()
                 self.end_body()
 
+    def do_HEAD(self):
+        '''Serve a HEAD request.'''
+        if self.send_cached():
+            return
+        super().do_HEAD()
+
+    def send_cached(self):
+        '''Answer a plain GET or HEAD of a small file from the content cache
+        of the server, sending headers and body in a single write.
+        Return False if the request has to be served the usual way.
+        '''
+        cache = self.server.content_cache
+        if (cache is None or 'Range' in self.headers or
+                any(name in self.headers for name in conditional_headers)):
+            return False
+        resolved = self.resolve(self.path)
+        if (resolved.kind != 'file' or not self.is_static(resolved) or
+                resolved.stat.st_size > cache.max_file_size):
+            return False
+        if self.server.using_gzip and self.server.compression.compressible(
+                resolved.ctype, resolved.stat.st_size):
+            # the response depends on Accept-Encoding
+            return False
+        entry = cache.get(resolved.path, resolved.stat)
+        if entry is None:
+            headers = ('Content-type: {}\r\n'
+                       'Content-Length: {}\r\n'
+                       'Last-Modified: {}\r\n'
+                       'ETag: {}\r\n').format(
+                resolved.ctype, resolved.stat.st_size,
+                self.date_time_string(resolved.stat.st_mtime),
+                self.etag(resolved.stat))
+            entry = cache.load(resolved.path, resolved.stat,
+                               headers.encode('latin-1', 'strict'))
+            if entry is None:
+                return False
+        self.send_response(HTTPStatus.OK)
+        if self.command == 'HEAD':
+            self.end_headers_with(entry.headers)
+        else:
+            self.end_headers_with(entry.headers, entry.body)
+        return True
+
+    def is_static(self, resolved):
+        '''Whether a resolved file is sent as it is.'''
+        return True
+
+    index_files = 'index.html', 'index.htm'
+
     def send_head(self):
         '''Same as super().send_header, but sending status code 206 and HTTP response header Content-Length.'''
-        path = self.translate_path(self.path)
-        f = None
-        if os.path.isdir(path):
+        resolved = self.resolve(self.path)
+        if resolved.kind == 'redirect':
+            # redirect browser - doing basically what apache does
             parts = urllib.parse.urlsplit(self.path)
-            if not parts.path.endswith('/'):
-                # redirect browser - doing basically what apache does
-                self.send_response(HTTPStatus.MOVED_PERMANENTLY)
-                new_parts = (parts[0], parts[1], parts[2] + '/',
-                             parts[3], parts[4])
-                new_url = urllib.parse.urlunsplit(new_parts)
-                self.send_header('Location', new_url)
-                self.end_headers()
-                return None
-            for index in 'index.html', 'index.htm':
+            self.send_response(HTTPStatus.MOVED_PERMANENTLY)
+            new_parts = (parts[0], parts[1], parts[2] + '/',
+                         parts[3], parts[4])
+            new_url = urllib.parse.urlunsplit(new_parts)
+            self.send_header('Location', new_url)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.start_body()
+                self.end_body()
+            return None
+        if resolved.kind == 'directory' and self.server.allow_lsdir:
+            return self.list_directory(resolved.path)
+        if resolved.kind != 'file':
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+        return self.send_file_head(resolved.path, resolved.ctype)
+
+    def resolve(self, path):
+        '''Resolve a request path with the cache of the server.'''
+        path = path.split('?', 1)[0]
+        path = path.split('#', 1)[0]
+        cache = self.server.resolve_cache
+        if cache is not None:
+            resolved = cache.get(path)
+            if resolved is not None:
+                return resolved
+        resolved = self.resolve_path(path)
+        if cache is not None:
+            cache.put(path, resolved)
+        return resolved
+
+    def resolve_path(self, path):
+        '''Map a request path to a Resolved file, directory, redirect or missing path.'''
+        path = self.translate_path(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return Resolved('missing', path, None, None, ((path, None),))
+        if stat.S_ISDIR(st.st_mode):
+            validators = (path, stat_signature(st)),
+            if not path.endswith('/'):
+                return Resolved('redirect', path, st, None, validators)
+            for index in self.index_files:
                 index = os.path.join(path, index)
-                if os.path.exists(index):
-                    path = index
-                    break
-            else:
-                if self.server.allow_lsdir:
-                    return self.list_directory(path)
-                else:
-                    self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
-                    return None
-        ctype = self.guess_type(path)
+                try:
+                    index_st = os.stat(index)
+                except OSError:
+                    continue
+                if stat.S_ISREG(index_st.st_mode):
+                    validators += (index, stat_signature(index_st)),
+                    return Resolved('file', index, index_st,
+                                    self.guess_type(index), validators)
+            return Resolved('directory', path, st, None, validators)
+        if path.endswith('/'):
+            return Resolved('missing', path, None, None, ((path, None),))
+        return Resolved('file', path, st, self.guess_type(path),
+                        ((path, stat_signature(st)),))
+
+    def send_file_head(self, path, ctype=None):
+        '''Open a regular file and send the headers for it.
+        A cached gzip variant is sent instead when the client accepts it.
+        '''
+        if ctype is None:
+            ctype = self.guess_type(path)
         try:
             f = open(path, 'rb')
         except OSError:
             self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
             return None
         try:
-            if 'Range' not in self.headers:
-                fs = os.fstat(f.fileno())
-                if 'If-Modified-Since' in self.headers:
-                    if self.headers['If-Modified-Since'] == self.date_time_string(fs.st_mtime):
-                        self.send_response(HTTPStatus.NOT_MODIFIED)
-                        self.end_headers()
-                        f.close()
-                        return None
+            fs = os.fstat(f.fileno())
+            size = fs.st_size
+            variant = self.gzip_variant(path, fs, ctype)
+            if variant:
+                f.close()
+                f, size = variant
+            if variant:
+                etag = self.etag(fs, 'gzip')
+            elif self.response_coding(ctype, size):
+                # compressed on the fly, not byte for byte the same each time
+                etag = self.etag(fs, self.content_coding, weak=True)
+            else:
+                etag = self.etag(fs)
+            status = self.evaluate_preconditions(fs, etag)
+            if status is not None:
+                f.close()
+                self.send_response(status)
+                if status == HTTPStatus.NOT_MODIFIED:
+                    self.send_header('ETag', etag)
+                    self.send_header('Last-Modified',
+                                     self.date_time_string(fs.st_mtime))
+                else:
+                    self.send_header('Content-Length', '0')
+                self.send_variant_headers(variant, ctype, fs)
+                self.using_gzip = False
+                self.end_headers()
+                return None
+            ranges = self.requested_ranges(fs, size, etag)
+            if ranges is None:
                 self.send_response(HTTPStatus.OK)
                 self.send_header('Content-type', ctype)
-                self.send_header('Content-Length', str(fs[6]))
+                self.send_header('Content-Length', str(size))
                 self.send_header('Last-Modified',
                                  self.date_time_string(fs.st_mtime))
+                self.send_header('ETag', etag)
+                self.send_variant_headers(variant, ctype, fs)
                 self.end_headers()
-                return f
+                # no more than Content-Length if the file grows meanwhile
+                return RangedFile(f, 0, size)
+            if not ranges:
+                f.close()
+                self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.send_variant_headers(variant, ctype, fs)
+                self.using_gzip = False
+                self.end_headers()
+                return None
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Last-Modified',
+                             self.date_time_string(fs.st_mtime))
+            if variant:
+                self.send_header('ETag', etag)
             else:
-                fs = os.fstat(f.fileno())
-                self.send_response(HTTPStatus.PARTIAL_CONTENT)
+                self.send_header('ETag', self.etag(fs))
+            if len(ranges) == 1:
+                start, end = ranges[0]
+                f = RangedFile(f, start, end)
                 self.send_header('Content-type', ctype)
-                self.send_header('Last-Modified',
-                                 self.date_time_string(fs.st_mtime))
-                rstart, rend = self.headers['Range'].split('=')[-1].split('-')
-                rstart = 0 if rstart == '' else int(rstart)
-                rend = fs[6] if rend == '' else int(rend)
-                self.send_header('Content-Range', '{0}-{1}/{2}'.format(
-                    rstart, rend, fs[6]))
-                self.send_header('Content-Length', str(rend - rstart + 1))
-                self.end_headers()
-                return f
+                self.send_header('Content-Range',
+                                 content_range(start, end, size))
+                self.send_header('Content-Length', str(end - start))
+            else:
+                f = MultipartRanges(f, ranges, size, ctype)
+                self.send_header('Content-type', f.content_type)
+                self.send_header('Content-Length', str(f.length))
+            self.send_variant_headers(variant, ctype, fs)
+            # ranges are of the bytes as they are sent, never gzip them again
+            self.using_gzip = False
+            self.end_headers()
+            return f
         except:
             f.close()
             raise
 
+    def etag(self, fs, coding=None, weak=None):
+        '''Entity tag of a file made of its inode, size and mtime.
+        Weak tags are used if the server asks for them.
+        '''
+        tag = '{:x}-{:x}-{:x}'.format(fs.st_ino, fs.st_size, fs.st_mtime_ns)
+        if coding:
+            tag += '-' + coding
+        if weak is None:
+            weak = self.server.weak_etags
+        return ('W/"{}"' if weak else '"{}"').format(tag)
+
+    def evaluate_preconditions(self, fs, etag):
+        '''Evaluate conditional headers in the order of RFC 7232, section 6.
+        Return NOT_MODIFIED or PRECONDITION_FAILED, or None to go on.
+        '''
+        mtime = int(fs.st_mtime)
+        if 'If-Match' in self.headers:
+            if not etag_matches(self.headers['If-Match'], etag, strong=True):
+                return HTTPStatus.PRECONDITION_FAILED
+        elif 'If-Unmodified-Since' in self.headers:
+            date = parse_http_date(self.headers['If-Unmodified-Since'])
+            if date is not None and mtime > date:
+                return HTTPStatus.PRECONDITION_FAILED
+        if 'If-None-Match' in self.headers:
+            if etag_matches(self.headers['If-None-Match'], etag):
+                if self.command in ('GET', 'HEAD'):
+                    return HTTPStatus.NOT_MODIFIED
+                return HTTPStatus.PRECONDITION_FAILED
+        elif ('If-Modified-Since' in self.headers and
+                self.command in ('GET', 'HEAD')):
+            date = parse_http_date(self.headers['If-Modified-Since'])
+            if date is not None and date <= time.time() and mtime <= date:
+                return HTTPStatus.NOT_MODIFIED
+        return None
+
+    def requested_ranges(self, fs, size, etag=None):
+        '''Return the (start, end) ranges of the Range header to send of a
+        file of size bytes, [] if none is satisfiable, or None if the whole
+        file has to be sent.
+        '''
+        if self.command != 'GET' or 'Range' not in self.headers:
+            return None
+        if 'If-Range' in self.headers and not self.if_range_matches(fs, etag):
+            return None
+        return parse_range(self.headers['Range'], size)
+
+    def if_range_matches(self, fs, etag=None):
+        '''Whether the validator of If-Range still matches the file.'''
+        validator = self.headers['If-Range'].strip()
+        if validator.startswith(('"', 'W/"')):
+            return etag is not None and etag_matches(validator, etag, strong=True)
+        return validator == self.date_time_string(fs.st_mtime)
+
+    def gzip_variant(self, path, fs, ctype=None):
+        '''Return (fileobj, size) of a cached gzip variant of path, or None.'''
+        if not (self.server.using_gzip and self.server.gzip_cache and
+                self.server.compression.compressible(ctype, fs.st_size) and
+                self.accept_encoding('gzip')):
+            return None
+        return self.server.gzip_cache.get(path, fs, self.server.compress_level)
+
+    def send_variant_headers(self, variant, ctype, fs):
+        '''Send the headers describing which variant of the file is sent.'''
+        if not (self.server.using_gzip and self.server.gzip_cache and
+                self.server.compression.compressible(ctype, fs.st_size)):
+            return
+        self.send_header('Vary', 'Accept-Encoding')
+        if variant:
+            self.send_header('Content-Encoding', 'gzip')
+            # already compressed, the real Content-Length can be sent
+            self.using_gzip = False
+
     def list_directory(self, path):
         '''Helper to produce a directory listing (absent index.html).
 
         Return value is either a file object, or None (indicating an
         error).  In either case, the headers are sent, making the
         interface the same as for send_head().
+        Small HTML listings are cached, large ones and JSON are streamed.
+        ?format=json lists sizes and mtimes, ?offset= and ?limit= select a page.
         '''
+        cache = self.server.listing_cache
         try:
-            list = os.listdir(path)
+            if cache is None:
+                listing = Listing.scan(path)
+            else:
+                listing = cache.get(path)
         except OSError:
             self.send_error(
                 HTTPStatus.NOT_FOUND,
                 'No permission to list directory')
             return None
-        list.sort(key=lambda a: a.lower())
-        r = []
+        parts = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(parts.query)
+        form = query.get('format', ['html'])[-1]
         try:
-            displaypath = urllib.parse.unquote(self.path,
+            offset = max(int(query.get('offset', [0])[-1]), 0)
+            limit = query.get('limit', [self.server.listing_page_size])[-1]
+            limit = None if limit is None else max(int(limit), 1)
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Invalid page')
+            return None
+        try:
+            displaypath = urllib.parse.unquote(parts.path,
                                                errors='surrogatepass')
         except UnicodeDecodeError:
-            displaypath = urllib.parse.unquote(path)
-        displaypath = html.escape(displaypath)
-        enc = sys.getfilesystemencoding()
-        title = 'Directory listing for %s' % displaypath
-        r.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" '
-                 '"http://www.w3.org/TR/html4/strict.dtd">')
-        r.append('<html>\n<head>')
-        r.append('<meta http-equiv="Content-Type" '
-                 'content="text/html; charset=%s">' % enc)
-        r.append('<title>%s</title>\n</head>' % title)
-        r.append('<body>\n<h1>%s</h1>' % title)
-        r.append('<hr>\n<ul>')
-        for name in list:
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
-                displayname = name + '/'
-                linkname = name + '/'
-            if os.path.islink(fullname):
-                displayname = name + '@'
-                # Note: a link to a directory displays with @ and links with /
-            r.append('<li><a href="%s">%s</a></li>'
-                    % (urllib.parse.quote(linkname,
-                                          errors='surrogatepass'),
-                       html.escape(displayname)))
-        r.append('</ul>\n<hr>\n</body>\n</html>\n')
-        encoded = '\n'.join(r).encode(enc, 'surrogateescape')
-        f = io.BytesIO()
-        f.write(encoded)
-        f.seek(0)
+            displaypath = urllib.parse.unquote(parts.path)
+        if form == 'json':
+            ctype = 'application/json'
+            pieces = render_json(listing, displaypath, offset, limit)
+        else:
+            enc = sys.getfilesystemencoding()
+            ctype = 'text/html; charset=%s' % enc
+            pieces = render_html(listing, displaypath, enc, offset, limit)
+        key = path, listing.mtime_ns, displaypath, form, offset, limit
+        body = cache.rendered.get(key) if cache else None
+        if (body is None and cache and form != 'json' and
+                len(page(listing, offset, limit)) <= cache.max_rendered_entries):
+            body = b''.join(pieces)
+            cache.rendered.put(key, body, len(body))
         self.send_response(HTTPStatus.OK)
-        self.send_header('Content-type', 'text/html; charset=%s' % enc)
-        self.send_header('Content-Length', str(len(encoded)))
+        self.send_header('Content-type', ctype)
+        if body is None:
+            # no Content-Length, the listing is streamed in chunks
+            self.end_headers()
+            return IterFile(pieces)
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        return f
+        return io.BytesIO(body)
 
     def send_fileobj(self, f):
         '''Send content of a file object to response body.'''
-        if 'Range' in self.headers:
-            rstart, rend = self.headers['Range'].split('=')[-1].split('-')
-            rstart = 0 if rstart == '' else int(rstart)
-            rend = float('inf') if rend == '' else int(rend)
-            input_file = RangedFile(f, rstart, rend)
+        if (self.server.use_sendfile and self.outfile is self.wfile and
+                isinstance(self.wfile, SocketWriter)):
+            # identity encoding and no chunked framing: let the kernel copy
+            if isinstance(f, MultipartRanges):
+                for piece in f.pieces():
+                    if isinstance(piece, bytes):
+                        self.outfile.write(piece)
+                    elif not self.sendfile(piece):
+                        super().copyfile(piece, self.outfile)
+                return
+            if self.sendfile(f):
+                return
+        super().copyfile(f, self.outfile)
+
+    def sendfile(self, f):
+        '''Send a file object with socket.sendfile, no read loop in python.
+        RangedFile is sent as offset and count of its underlying file, so
+        a file which grows is not sent past its Content-Length.
+        Return False if f is not backed by a real file.
+        '''
+        if isinstance(f, RangedFile):
+            fileobj = f.fileobj
+            offset = f.start + f.position
+            count = f.length
+            if count is not None:
+                count -= f.position
         else:
-            input_file = f
-        super().copyfile(input_file, self.outfile)
+            fileobj = f
+            offset = f.tell()
+            count = None
+        try:
+            fileobj.fileno()
+        except (AttributeError, OSError):
+            return False
+        if count is not None and count <= 0:
+            return True
+        self.wfile.sendfile(fileobj, offset, count)
+        return True
 
     def translate_path(self, path):
         '''Same as SimpleHTTPServer.translate_path, buf self.server.content_dir is used instead of os.getcwd()'''
@@ -194,6 +440,13 @@ class FileHTTPServer(MinHTTPServer):
         super().__init__(*args, **kwargs)
         self.content_dir = './'
         self.allow_lsdir = True
+        self.use_sendfile = True
+        self.weak_etags = False
+        self.gzip_cache = GzipCache()
+        self.resolve_cache = ResolveCache()
+        self.content_cache = ContentCache()
+        self.listing_cache = ListingCache()
+        self.listing_page_size = None
 
     @property
     def content_dir(self):
@@ -203,6 +456,26 @@ class FileHTTPServer(MinHTTPServer):
         if not value.endswith('/'):
             value += '/'
         self._content_dir = value
+        if getattr(self, 'resolve_cache', None):
+            self.resolve_cache.clear()
+        if getattr(self, 'content_cache', None):
+            self.content_cache.clear()
+        if getattr(self, 'listing_cache', None):
+            self.listing_cache.clear()
+
+    def cache_stats(self):
+        stats = super().cache_stats()
+        for name in 'resolve_cache', 'content_cache':
+            cache = getattr(self, name)
+            if cache is not None:
+                stats[name] = cache.stats()
+        if self.gzip_cache is not None:
+            stats['gzip_memory'] = self.gzip_cache.memory.stats()
+            stats['gzip_disk'] = self.gzip_cache.disk.stats()
+        if self.listing_cache is not None:
+            stats['listings'] = self.listing_cache.listings.stats()
+            stats['rendered_listings'] = self.listing_cache.rendered.stats()
+        return stats
 
 def main(args):
     if len(args) == 1:
@@ -211,7 +484,7 @@ def main(args):
         port = 8000
     server_address = ('', port)
     with run_server(server_address, FileHTTPServer, FileHTTPRequestHandler) as server:
-        pass
+        server.stats_path = '/__stats'
 
 if __name__ == '__main__':
     from sys import argv
@@ -0,0 +1,363 @@
+r'''
+Query strings and form bodies of requests to pythonhttp scripts.
+
+Values are kept in a MultiDict, which maps a name to its last value, as
+the dict of get_query did, and keeps all of them. Form bodies are parsed
+as they are read, in blocks: application/x-www-form-urlencoded fields are
+kept in memory, the files of multipart/form-data are spooled to disk once
+they are larger than spool_size. The limits are attributes of RequestData.
+
+>>> query = parse_query('/a.py?x=1&y=a%3Db&x=2&flag&z=%E2%82%AC+')
+>>> query['x'], query.getlist('x'), query['y'], query['flag'], query['z']
+('2', ['1', '2'], 'a=b', '', '€ ')
+>>> import io
+>>> body = (b'--xyz\r\nContent-Disposition: form-data; name="title"\r\n\r\n'
+...         b'hello\r\n--xyz\r\nContent-Disposition: form-data; name="up"; '
+...         b'filename="a.txt"\r\nContent-Type: text/plain\r\n\r\n'
+...         b'line 1\r\nline 2\r\n--xyz--\r\n')
+>>> form, files = parse_multipart(io.BytesIO(body), b'xyz', RequestData())
+>>> form['title'], files['up'].filename, files['up'].file.read()
+('hello', 'a.txt', b'line 1\r\nline 2')
+>>> form, files = parse_urlencoded(io.BytesIO(b'a=1&b=x+y&a=2'), RequestData())
+>>> form.getlist('a'), form['b']
+(['1', '2'], 'x y')
+'''
+
+import codecs
+import re
+import tempfile
+import urllib.parse
+from http import HTTPStatus
+from chunkedfile import ChunkedReader
+from httputil import parse_digits
+from rangedfile import RangedFile
+
+class FormError(ValueError):
+    '''A form which cannot be parsed, status is the one to answer with.'''
+    def __init__(self, message, status=HTTPStatus.BAD_REQUEST):
+        super().__init__(message)
+        self.status = status
+
+class MultiDict(dict):
+    '''dict of the last value of each name, which keeps all the values.'''
+    def __init__(self, pairs=()):
+        super().__init__()
+        self.lists = {}
+        for name, value in pairs:
+            self.add(name, value)
+
+    def add(self, name, value):
+        self.lists.setdefault(name, []).append(value)
+        self[name] = value
+
+    def getlist(self, name):
+        return list(self.lists.get(name, ()))
+
+    def allitems(self):
+        return [(name, value) for name, values in self.lists.items()
+                for value in values]
+
+class UploadedFile(object):
+    '''A file of a multipart form. file is positioned at its start.'''
+    def __init__(self, name, filename, content_type, headers, file, size):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.headers = headers
+        self.file = file
+        self.size = size
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+
+param_re = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+def parse_header_value(value):
+    '''Split a header value such as Content-Type into the value and a dict
+    of its parameters, whose names are lower case.
+    '''
+    value = value or ''
+    main, _, rest = value.partition(';')
+    params = {}
+    for match in param_re.finditer(';' + rest):
+        name, param = match.group(1).lower(), match.group(2).strip()
+        if param.startswith('"'):
+            param = re.sub(r'\\(.)', r'\1', param[1:-1])
+        if name.endswith('*'):
+            # RFC 5987 charset'language'value
+            charset, _, encoded = param.partition("'")
+            encoded = encoded.partition("'")[2]
+            try:
+                param = urllib.parse.unquote(encoded, charset or 'utf-8',
+                                             'strict')
+            except (LookupError, UnicodeDecodeError):
+                continue
+            name = name[:-1]
+        params[name] = param
+    return main.strip().lower(), params
+
+def parse_query(path, encoding='utf-8'):
+    '''MultiDict of the query string of a request path.'''
+    query = path.partition('?')[2].partition('#')[0]
+    if not query:
+        return MultiDict()
+    return MultiDict(urllib.parse.parse_qsl(
+        query, keep_blank_values=True, encoding=encoding, errors='replace'))
+
+def parse_urlencoded(fileobj, limits, encoding='utf-8'):
+    '''Parse an application/x-www-form-urlencoded body as it is read.
+    Return (form, files), files being empty.
+    '''
+    form = MultiDict()
+    count = total = 0
+    rest = b''
+    while True:
+        block = fileobj.read(limits.blocksize)
+        total += len(block)
+        if total > limits.max_form_size:
+            raise FormError('Form too large',
+                            HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        data = rest + block if rest else block
+        if block:
+            cut = data.rfind(b'&')
+            if cut < 0:
+                if len(data) > limits.max_field_size:
+                    raise FormError('Form field too large',
+                                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                rest = data
+                continue
+            data, rest = data[:cut], data[cut + 1:]
+        pairs = urllib.parse.parse_qsl(
+            data.decode('latin-1'), keep_blank_values=True,
+            encoding=encoding, errors='replace')
+        count += len(pairs)
+        if count > limits.max_fields:
+            raise FormError('Too many form fields',
+                            HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        for name, value in pairs:
+            form.add(name, value)
+        if not block:
+            return form, MultiDict()
+
+class MultipartParser(object):
+    '''Parser of a multipart/form-data body, reading fileobj in blocks.'''
+
+    max_header_size = 16 << 10
+
+    def __init__(self, fileobj, boundary, limits, encoding='utf-8'):
+        self.fileobj = fileobj
+        self.delimiter = b'--' + boundary
+        self.separator = b'\r\n' + self.delimiter
+        self.limits = limits
+        self.encoding = encoding
+        self.buffer = bytearray()
+        self.total = 0
+
+    def fill(self):
+        '''Read a block into the buffer, return False at the end of the body.'''
+        block = self.fileobj.read(self.limits.blocksize)
+        if not block:
+            return False
+        self.total += len(block)
+        if self.total > self.limits.max_form_size:
+            raise FormError('Form too large',
+                            HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        self.buffer += block
+        return True
+
+    def find(self, pattern, limit=None):
+        '''Fill the buffer until it contains pattern, return its index.'''
+        start = 0
+        while True:
+            index = self.buffer.find(pattern, start)
+            if index >= 0:
+                return index
+            if limit is not None and len(self.buffer) > limit:
+                raise FormError('Form part headers too large')
+            start = max(len(self.buffer) - len(pattern) + 1, 0)
+            if not self.fill():
+                raise FormError('Form body is truncated')
+
+    def parse(self):
+        form, files = MultiDict(), MultiDict()
+        count = 0
+        # the preamble is ignored
+        index = self.find(self.delimiter, self.max_header_size)
+        del self.buffer[:index + len(self.delimiter)]
+        while True:
+            while len(self.buffer) < 2 and self.fill():
+                pass
+            if self.buffer[:2] == b'--':
+                # so is the epilogue, which is read to the end of the body
+                del self.buffer[:]
+                while self.fill():
+                    del self.buffer[:]
+                return form, files
+            count += 1
+            if count > self.limits.max_fields:
+                raise FormError('Too many form fields',
+                                HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+            end = self.find(b'\r\n\r\n', self.max_header_size)
+            headers = self.parse_headers(bytes(self.buffer[:end]))
+            del self.buffer[:end + 4]
+            disposition, params = parse_header_value(
+                headers.get('content-disposition'))
+            name = params.get('name')
+            if disposition != 'form-data' or name is None:
+                raise FormError('Form part without a name')
+            if 'filename' in params:
+                file = tempfile.SpooledTemporaryFile(
+                    self.limits.spool_size, dir=self.limits.upload_dir)
+                size = self.read_part(file, self.limits.max_file_size)
+                file.seek(0)
+                files.add(name, UploadedFile(
+                    name, params['filename'], headers.get('content-type'),
+                    headers, file, size))
+            else:
+                value = bytearray()
+                self.read_part(value, self.limits.max_field_size)
+                charset = parse_header_value(
+                    headers.get('content-type'))[1].get('charset')
+                form.add(name, self.decode(value, charset))
+
+    def parse_headers(self, data):
+        headers = {}
+        # the first line is the end of the delimiter line
+        for line in data.split(b'\r\n')[1:]:
+            name, sep, value = line.decode('utf-8', 'replace').partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        return headers
+
+    def read_part(self, sink, max_size):
+        '''Move the data of a part to sink, a bytearray or a file, up to the
+        next delimiter. Return its size.
+        '''
+        write = sink.extend if isinstance(sink, bytearray) else sink.write
+        separator = self.separator
+        # what may be the start of a separator stays in the buffer
+        keep = len(separator) - 1
+        size = 0
+        while True:
+            index = self.buffer.find(separator)
+            count = index if index >= 0 else len(self.buffer) - keep
+            if count > 0:
+                size += count
+                if size > max_size:
+                    raise FormError('Form part too large',
+                                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                with memoryview(self.buffer) as view:
+                    write(view[:count])
+                del self.buffer[:count]
+            if index >= 0:
+                del self.buffer[:len(separator)]
+                return size
+            if not self.fill():
+                raise FormError('Form body is truncated')
+
+    def decode(self, value, charset):
+        try:
+            return value.decode(charset or self.encoding, 'replace')
+        except LookupError:
+            return value.decode(self.encoding, 'replace')
+
+def parse_multipart(fileobj, boundary, limits, encoding='utf-8'):
+    '''Parse a multipart/form-data body as it is read, return (form, files).'''
+    return MultipartParser(fileobj, boundary, limits, encoding).parse()
+
+def request_body(handler):
+    '''File object of the body of the request of handler, which ends with
+    the body. It is made once per request and kept as handler.body_reader.
+    Raise FormError if the body has no valid length.
+    '''
+    reader = getattr(handler, 'body_reader', None)
+    if reader is None:
+        if 'chunked' in handler.headers.get('Transfer-Encoding', '').lower():
+            reader = ChunkedReader(handler.rfile)
+        else:
+            length = handler.headers.get('Content-Length', '0').strip()
+            length = parse_digits(length)
+            if length is None:
+                raise FormError('Bad Content-Length')
+            reader = RangedFile(handler.rfile, 0, length)
+        handler.body_reader = reader
+    return reader
+
+def body_consumed(reader):
+    '''Whether the whole request body has been read from reader.'''
+    if isinstance(reader, ChunkedReader):
+        return reader.eof
+    return not getattr(reader, 'remaining', 0)
+
+class RequestData(object):
+    '''query, form and files of a request, parsed when they are first used.
+
+    Mixed into request handlers, which have path, headers and rfile.
+    form and files are parsed from the request body, of which at most
+    max_form_size bytes are read. A field is at most max_field_size bytes,
+    a file max_file_size, and a form has at most max_fields of both. Files
+    larger than spool_size are written to upload_dir, the temporary
+    directory by default.
+    '''
+
+    max_form_size = 1 << 30
+    max_field_size = 1 << 20
+    max_file_size = 256 << 20
+    max_fields = 1000
+    spool_size = 1 << 20
+    upload_dir = None
+    blocksize = 64 << 10
+
+    # limits passed on to the processes of a script pool
+    form_limits = ('max_form_size', 'max_field_size', 'max_file_size',
+                   'max_fields', 'spool_size', 'upload_dir')
+
+    @property
+    def query(self):
+        state = self.__dict__
+        if state.get('_query_path') != self.path:
+            state['_query'] = parse_query(self.path)
+            state['_query_path'] = self.path
+        return state['_query']
+
+    @query.setter
+    def query(self, value):
+        self.__dict__['_query'] = value
+        self.__dict__['_query_path'] = self.path
+
+    @property
+    def form(self):
+        return self.parse_form()[0]
+
+    @property
+    def files(self):
+        return self.parse_form()[1]
+
+    def parse_form(self):
+        '''Parse the body of the request once, return (form, files).'''
+        state = self.__dict__
+        body = request_body(self)
+        if state.get('_form_body') is not body:
+            state['_form'] = self.read_form(body)
+            state['_form_body'] = body
+        return state['_form']
+
+    def read_form(self, body):
+        ctype, params = parse_header_value(self.headers.get('Content-Type'))
+        encoding = params.get('charset', 'utf-8')
+        try:
+            codecs.lookup(encoding)
+        except LookupError:
+            encoding = 'utf-8'
+        if ctype == 'application/x-www-form-urlencoded':
+            return parse_urlencoded(body, self, encoding)
+        if ctype == 'multipart/form-data':
+            boundary = params.get('boundary')
+            if not boundary:
+                raise FormError('Multipart form without a boundary')
+            return parse_multipart(body, boundary.encode('latin-1'), self,
+                                   encoding)
+        return MultiDict(), MultiDict()
@@ -0,0 +1,354 @@
+'''
+Shared HTTP cache for ProxyHTTPServer, a subset of RFC 7234.
+
+Responses to GET are stored per URL and per the values of the request
+headers named by Vary. Small bodies are kept in memory, larger ones in
+files of cache_dir, both tiers are bounded and evict the least recently
+used responses. A body is stored while it is sent to the client.
+
+>>> parse_cache_control('max-age=60, no-cache="Set-Cookie, Foo", Public')
+{'max-age': '60', 'no-cache': 'Set-Cookie, Foo', 'public': None}
+>>> delta_seconds(parse_cache_control('max-age=\u00b9'), 'max-age')
+0
+>>> cache = HTTPCache()
+>>> writer = cache.store('http://a/', {}, 200, 'OK',
+...     [('Cache-Control', 'max-age=60'), ('Date', email.utils.formatdate())],
+...     time.time())
+>>> writer.write(b'hello')
+>>> writer.commit()
+>>> entry = cache.lookup('http://a/', {})
+>>> cache.is_fresh(entry, {}), entry.read_body()
+(True, b'hello')
+>>> cache.is_fresh(entry, {'Cache-Control': 'no-cache'})
+False
+>>> cache.invalidate('http://a/')
+>>> cache.lookup('http://a/', {}) is None
+True
+'''
+
+import email.utils
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+from filecache import LRUCache
+from httputil import parse_digits, parse_http_date
+
+# statuses which may be stored without explicit freshness, RFC 7231 6.1
+cacheable_statuses = frozenset([200, 203, 300, 301, 404, 405, 410, 414, 501])
+
+# headers of a stored response which are not sent from the cache
+unstored_headers = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'te', 'trailer', 'transfer-encoding', 'upgrade', 'content-length', 'age'])
+
+directive_re = re.compile(
+    r'''([!#$%&'*+\-.^_`|~\w]+)(?:\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^\s,]*)))?''')
+
+def parse_cache_control(value):
+    '''Directives of a Cache-Control value as a dict of lower case names.'''
+    directives = {}
+    for match in directive_re.finditer(value or ''):
+        name, quoted, token = match.groups()
+        directives[name.lower()] = quoted if quoted is not None else token
+    return directives
+
+def delta_seconds(directives, name):
+    '''Value of a delta-seconds directive, 0 if it is invalid.'''
+    return parse_digits(directives[name]) or 0
+
+class CachedResponse(object):
+    '''A stored response. Its body is bytes in memory or the file path.'''
+    def __init__(self, key, status, reason, headers, request_time,
+                 response_time, body=None, path=None, size=0):
+        self.key = key
+        self.status = status
+        self.reason = reason
+        self.body = body
+        self.path = path
+        self.size = size
+        self.update(headers, request_time, response_time)
+
+    def update(self, headers, request_time, response_time):
+        '''Set the headers, as received or freshened by a 304 response.'''
+        self.headers = [(key, value) for key, value in headers
+                        if key.lower() not in unstored_headers]
+        fields = {}
+        for key, value in headers:
+            key = key.lower()
+            fields[key] = fields[key] + ', ' + value if key in fields else value
+        self.fields = fields
+        self.cache_control = parse_cache_control(fields.get('cache-control'))
+        self.request_time = request_time
+        self.response_time = response_time
+        date = parse_http_date(fields.get('date'))
+        self.date = response_time if date is None else date
+        age = parse_digits(fields.get('age', '').strip()) or 0
+        # RFC 7234 4.2.3
+        apparent_age = max(0, response_time - self.date)
+        self.initial_age = max(apparent_age, age + response_time - request_time)
+        self.lifetime = self.freshness_lifetime()
+
+    def freshness_lifetime(self):
+        directives = self.cache_control
+        if 'no-cache' in directives and directives['no-cache'] is None:
+            return 0
+        for name in ('s-maxage', 'max-age'):
+            if name in directives:
+                return delta_seconds(directives, name)
+        if 'expires' in self.fields:
+            expires = parse_http_date(self.fields['expires'])
+            return 0 if expires is None else max(0, expires - self.date)
+        if self.status in cacheable_statuses or 'public' in directives:
+            # heuristic freshness, RFC 7234 4.2.2
+            last_modified = parse_http_date(self.fields.get('last-modified'))
+            if last_modified is not None:
+                return min(HTTPCache.heuristic_max,
+                           max(0, self.date - last_modified) *
+                           HTTPCache.heuristic_fraction)
+        return 0
+
+    def age(self, now=None):
+        if now is None:
+            now = time.time()
+        return self.initial_age + now - self.response_time
+
+    def validators(self):
+        '''Headers of a request revalidating this response.'''
+        headers = []
+        if 'etag' in self.fields:
+            headers.append(('If-None-Match', self.fields['etag']))
+        if 'last-modified' in self.fields:
+            headers.append(('If-Modified-Since', self.fields['last-modified']))
+        return headers
+
+    def open(self):
+        '''File object of the body, None if its file has been evicted.'''
+        if self.path is None:
+            return io.BytesIO(self.body)
+        try:
+            return open(self.path, 'rb')
+        except OSError:
+            return None
+
+    def read_body(self):
+        f = self.open()
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+class DiskResponses(LRUCache):
+    '''LRUCache of CachedResponse whose body files are removed on eviction.'''
+    def evict(self, key, value):
+        try:
+            os.remove(value.path)
+        except OSError:
+            pass
+
+class CacheWriter(object):
+    '''Store a body while it is received, see HTTPCache.store.
+    The body is buffered in memory up to max_memory_object, then spills to
+    a file of cache_dir. Storing is given up if the body grows too large.
+    '''
+    def __init__(self, cache, entry, expected=None):
+        self.cache = cache
+        self.entry = entry
+        self.expected = expected
+        self.buffer = io.BytesIO()
+        self.file = None
+        self.size = 0
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_object:
+            self.abort()
+        elif self.file is not None:
+            self.file.write(data)
+        elif self.size <= self.cache.max_memory_object:
+            self.buffer.write(data)
+        elif self.cache.cache_dir:
+            self.file = tempfile.NamedTemporaryFile(
+                dir=self.cache.cache_dir, prefix='proxy-', delete=False)
+            self.file.write(self.buffer.getvalue())
+            self.file.write(data)
+            self.buffer = None
+        else:
+            self.abort()
+
+    def commit(self):
+        '''Store the response if its body is complete.'''
+        if self.expected is not None and self.size != self.expected:
+            self.abort()
+        if self.failed:
+            return
+        entry = self.entry
+        entry.size = self.size
+        if self.file is not None:
+            self.file.close()
+            entry.path = self.file.name
+        else:
+            entry.body = self.buffer.getvalue()
+        self.cache.put(entry)
+
+    def abort(self):
+        self.failed = True
+        self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            try:
+                os.remove(self.file.name)
+            except OSError:
+                pass
+            self.file = None
+
+class HTTPCache(object):
+    '''Bounded memory and disk tiers of CachedResponse.
+
+    hits count the responses served fresh from the cache, revalidated those
+    served from the cache after a 304, misses the others. bytes_saved is
+    the size of the bodies which were not transferred from the origin.
+    '''
+
+    heuristic_fraction = 0.1
+    heuristic_max = 24 * 3600
+
+    def __init__(self, max_memory=64 << 20, max_memory_object=1 << 20,
+                 cache_dir=None, max_disk=1 << 30, max_object=256 << 20,
+                 max_urls=100000):
+        self.memory = LRUCache(max_memory, max_urls)
+        self.disk = DiskResponses(max_disk, max_urls)
+        # names of the headers in Vary of the last response of an URL
+        self.vary = LRUCache(max_urls)
+        self.max_memory_object = max_memory_object
+        self.cache_dir = cache_dir
+        self.max_object = max_object
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stored = 0
+        self.bytes_saved = 0
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.revalidated + self.misses
+        return (self.hits + self.revalidated) / total if total else 0.0
+
+    def key(self, url, request_headers, vary=None):
+        if vary is None:
+            vary = self.vary.get(url, ())
+        return url, tuple(request_headers.get(name) for name in vary)
+
+    def lookup(self, url, request_headers):
+        '''Return the stored response for a request, or None.'''
+        key = self.key(url, request_headers)
+        return self.memory.get(key) or self.disk.get(key)
+
+    def is_fresh(self, entry, request_headers):
+        '''Whether entry may be sent without revalidation.'''
+        directives = parse_cache_control(request_headers.get('Cache-Control'))
+        if 'no-cache' in directives or (
+                request_headers.get('Cache-Control') is None and
+                'no-cache' in request_headers.get('Pragma', '')):
+            return False
+        age = entry.age()
+        if 'max-age' in directives and age > delta_seconds(directives, 'max-age'):
+            return False
+        if 'min-fresh' in directives:
+            age += delta_seconds(directives, 'min-fresh')
+        return age < entry.lifetime
+
+    @staticmethod
+    def storable(status, headers, request_headers):
+        '''Whether a response to GET may be stored, RFC 7234 3.'''
+        if status < 200 or status in (206, 304):
+            return False
+        request_directives = parse_cache_control(
+            request_headers.get('Cache-Control'))
+        if 'no-store' in request_directives:
+            return False
+        fields = {}
+        for key, value in headers:
+            key = key.lower()
+            fields[key] = fields[key] + ', ' + value if key in fields else value
+        directives = parse_cache_control(fields.get('cache-control'))
+        if 'no-store' in directives or 'private' in directives:
+            return False
+        if fields.get('vary', '').strip() == '*':
+            return False
+        if 'set-cookie' in fields and 'public' not in directives:
+            # cookies of one client must not be sent to others
+            return False
+        if 'authorization' in request_headers and not (
+                'public' in directives or 's-maxage' in directives or
+                'must-revalidate' in directives):
+            return False
+        return (status in cacheable_statuses or 'expires' in fields or
+                'max-age' in directives or 's-maxage' in directives or
+                'public' in directives)
+
+    def store(self, url, request_headers, status, reason, headers,
+              request_time):
+        '''Return a CacheWriter for the body of a response to store.'''
+        vary = []
+        for key, value in headers:
+            if key.lower() == 'vary':
+                vary.extend(name.strip().lower() for name in value.split(',')
+                            if name.strip())
+        vary = tuple(vary)
+        self.vary.put(url, vary)
+        key = self.key(url, request_headers, vary)
+        entry = CachedResponse(key, status, reason, headers, request_time,
+                               time.time())
+        expected = None
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                expected = parse_digits(value.strip())
+        return CacheWriter(self, entry, expected)
+
+    def put(self, entry):
+        if entry.path is None:
+            self.disk.pop(entry.key)
+            self.memory.put(entry.key, entry, entry.size)
+        else:
+            self.memory.pop(entry.key)
+            self.disk.put(entry.key, entry, entry.size)
+        self.count('stored')
+
+    def freshen(self, entry, headers, request_time):
+        '''Update a stored response with the headers of a 304 response.'''
+        merged = dict((key.lower(), (key, value)) for key, value in entry.headers)
+        for key, value in headers:
+            merged[key.lower()] = key, value
+        entry.update(list(merged.values()), request_time, time.time())
+
+    def invalidate(self, url):
+        '''Drop the responses of url, after an unsafe request to it got a
+        2xx or 3xx response.
+        '''
+        for tier in (self.memory, self.disk):
+            with tier.lock:
+                keys = [stored for stored in tier.entries if stored[0] == url]
+            for stored in keys:
+                tier.pop(stored)
+
+    def count(self, name, size=0):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+            if size:
+                self.bytes_saved += size
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+        self.vary.clear()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
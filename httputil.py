@@ -0,0 +1,66 @@
+'''
+Parsing of HTTP header values shared by the file server and the proxy
+cache, without the servers themselves.
+
+>>> parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT')
+784111777.0
+>>> parse_http_date('yesterday') is None
+True
+>>> parse_digits('0012'), parse_digits('+12'), parse_digits('\u00b9')
+(12, None, None)
+'''
+
+import datetime
+import email.utils
+import re
+
+# isdigit is true of other digits than 0-9 too, which int() may reject
+digits_re = re.compile('[0-9]+')
+
+def parse_digits(value):
+    '''Integer of a string of ASCII digits, such as a Content-Length, None
+    if value is None or anything else.
+    '''
+    if value is None or not digits_re.fullmatch(value):
+        return None
+    return int(value)
+
+def parse_http_date(value):
+    '''Parse an HTTP date to a timestamp, None if it is invalid.'''
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+def etag_matches(header, etag, strong=False):
+    '''Whether an If-Match or If-None-Match value matches etag.
+    Weak comparison ignores the W/ prefix, strong comparison never matches
+    weak tags.
+    >>> etag_matches('"a", W/"b"', '"b"')
+    True
+    >>> etag_matches('W/"b"', '"b"', strong=True)
+    False
+    >>> etag_matches('*', 'W/"c"')
+    True
+    '''
+    if header.strip() == '*':
+        return True
+    if strong and etag.startswith('W/'):
+        return False
+    for tag in re.findall(r'(?:W/)?"[^"]*"', header):
+        if tag.startswith('W/'):
+            if strong:
+                continue
+            tag = tag[2:]
+        if tag == etag or 'W/' + tag == etag:
+            return True
+    return False
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,391 @@
+'''
+Counters and latency histograms of the requests of a server.
+
+Every thread records into a shard of its own, so recording takes no lock.
+Shards are summed when the metrics are read, and the shards of threads
+which have ended are folded into the totals. Requests are counted by
+handler class and status class, with the bytes sent and the duration in
+fixed buckets, from the request line to the end of the response.
+
+The metrics are those of a process: every process of a forking or
+prefork server has its own.
+
+>>> metrics = Metrics()
+>>> metrics.record('FileHTTPRequestHandler', 200, 0.003, 512)
+>>> metrics.record('FileHTTPRequestHandler', 206, 0.2, 4096)
+>>> metrics.record('FileHTTPRequestHandler', 404, 0.0004, 100)
+>>> snapshot = metrics.snapshot()
+>>> stats = snapshot['handlers']['FileHTTPRequestHandler']['2xx']
+>>> stats['count'], stats['bytes'], stats['buckets']['0.005']
+(2, 4608, 1)
+>>> snapshot['requests']['count'], snapshot['requests']['bytes']
+(3, 4708)
+>>> text = render_prometheus(snapshot)
+>>> print('\\n'.join(line for line in text.splitlines() if '"4xx"' in line
+...                 and 'bucket' not in line))
+http_requests_total{handler="FileHTTPRequestHandler",status="4xx"} 1
+http_request_errors_total{handler="FileHTTPRequestHandler",status="4xx"} 0
+http_response_bytes_total{handler="FileHTTPRequestHandler",status="4xx"} 100
+http_request_duration_seconds_sum{handler="FileHTTPRequestHandler",status="4xx"} 0.0004
+http_request_duration_seconds_count{handler="FileHTTPRequestHandler",status="4xx"} 1
+>>> stats_format('/__stats?format=prometheus', None)
+'prometheus'
+>>> stats_format('/__stats', 'text/plain;version=0.0.4;q=0.5,*/*;q=0.1')
+'prometheus'
+>>> stats_format('/__stats', '*/*')
+'json'
+'''
+
+import bisect
+import json
+import threading
+import time
+import urllib.parse
+from http import HTTPStatus
+
+# upper bounds of the buckets of request durations, in seconds
+duration_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# cache statistics which are current values rather than running totals
+gauge_names = frozenset(['entries', 'size', 'open', 'idle', 'workers',
+                         'in_flight'])
+
+# columns of a row of request counters, followed by the bucket counts
+COUNT, ERRORS, BYTES, SECONDS, BUCKETS = range(5)
+
+def status_label(status_class):
+    return '{}xx'.format(status_class) if status_class else 'none'
+
+class Shard(object):
+    '''Counters recorded by a single thread.'''
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.rows = {}
+        self.connections = 0
+        self.active = 0
+
+    def add(self, shard):
+        for key, row in list(shard.rows.items()):
+            total = self.rows.get(key)
+            if total is None:
+                total = self.rows[key] = [0] * len(row)
+            for index, value in enumerate(row):
+                total[index] += value
+        self.connections += shard.connections
+        self.active += shard.active
+
+class Metrics(object):
+    '''Registry of the request metrics of a server, see the module
+    documentation. buckets are the upper bounds of the duration histogram.
+    '''
+    def __init__(self, buckets=duration_buckets):
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        # counters of the threads which have ended
+        self.retired = Shard()
+        self.fold_at = 64
+        self.start_time = time.time()
+        self.started = time.monotonic()
+        self.previous = self.started, 0
+
+    def shard(self):
+        '''Shard of the current thread.'''
+        try:
+            return self.local.shard
+        except AttributeError:
+            pass
+        shard = self.local.shard = Shard(threading.current_thread())
+        with self.lock:
+            self.shards.append(shard)
+            if len(self.shards) >= self.fold_at:
+                # a thread per connection would leave a shard each
+                self.fold()
+                self.fold_at = max(64, 2 * len(self.shards))
+        return shard
+
+    def fold(self):
+        '''Add the shards of ended threads to retired, with the lock held.'''
+        live = []
+        for shard in self.shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+            else:
+                self.retired.add(shard)
+        self.shards = live
+
+    def record(self, handler, status, seconds, sent=0, error=False):
+        '''Count a request of the handler class named handler, answered
+        with status, None if it got no response, in seconds with sent
+        bytes. error tells that it was ended by an exception.
+        '''
+        try:
+            rows = self.local.shard.rows
+        except AttributeError:
+            rows = self.shard().rows
+        key = handler, status // 100 if status else 0
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = [0] * (BUCKETS + len(self.buckets) + 1)
+        row[COUNT] += 1
+        if error:
+            row[ERRORS] += 1
+        row[BYTES] += sent
+        row[SECONDS] += seconds
+        row[BUCKETS + bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def connection_opened(self):
+        shard = self.shard()
+        shard.connections += 1
+        shard.active += 1
+
+    def connection_closed(self):
+        # the connection may have been opened by another thread, only the
+        # sum of the shards is meaningful
+        self.shard().active -= 1
+
+    def totals(self):
+        '''Shard of the sums of all the shards.'''
+        with self.lock:
+            self.fold()
+            shards = [self.retired] + self.shards
+        total = Shard()
+        for shard in shards:
+            total.add(shard)
+        return total
+
+    def snapshot(self, server=None):
+        '''The metrics as plain data, with the cache statistics of server.
+        rate is the number of requests per second since the previous
+        snapshot.
+        '''
+        total = self.totals()
+        handlers = {}
+        count = errors = sent = 0
+        for (handler, status), row in sorted(total.rows.items()):
+            handlers.setdefault(handler, {})[status_label(status)] = \
+                self.row_stats(row)
+            count += row[COUNT]
+            errors += row[ERRORS]
+            sent += row[BYTES]
+        now = time.monotonic()
+        with self.lock:
+            then, previous = self.previous
+            self.previous = now, count
+        rate = (count - previous) / (now - then) if now > then else 0.0
+        caches = {}
+        if server is not None and hasattr(server, 'cache_stats'):
+            caches = server.cache_stats()
+        return {
+            'start_time': self.start_time,
+            'uptime': now - self.started,
+            'connections': {'count': total.connections,
+                            'active': total.active},
+            'requests': {'count': count, 'errors': errors, 'bytes': sent,
+                         'rate': rate},
+            'handlers': handlers,
+            'caches': caches,
+        }
+
+    def row_stats(self, row):
+        counts = row[BUCKETS:]
+        buckets = {}
+        cumulative = 0
+        for bound, bucket in zip(self.buckets + (None,), counts):
+            cumulative += bucket
+            buckets['+Inf' if bound is None else repr(bound)] = cumulative
+        stats = {
+            'count': row[COUNT],
+            'errors': row[ERRORS],
+            'bytes': row[BYTES],
+            'seconds': row[SECONDS],
+            'buckets': buckets,
+        }
+        for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99),
+                        ('p999', 0.999)):
+            stats[name] = self.quantile(counts, q)
+        return stats
+
+    def quantile(self, counts, q):
+        '''Estimate of the q quantile of the durations counted in buckets,
+        interpolated within its bucket like histogram_quantile of
+        Prometheus. Durations beyond the last bucket are given its bound.
+        '''
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return lower
+
+def escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+def render_prometheus(snapshot, prefix='http'):
+    '''Text exposition format 0.0.4 of Prometheus of a snapshot.'''
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for suffix, labels, value in samples:
+            labels = ','.join('{}="{}"'.format(key, escape_label(label))
+                              for key, label in labels)
+            lines.append('{}_{}{}{} {}'.format(
+                prefix, name, suffix, '{' + labels + '}' if labels else '',
+                value))
+
+    rows = [((('handler', handler), ('status', status)), stats)
+            for handler, statuses in snapshot['handlers'].items()
+            for status, stats in statuses.items()]
+    family('requests_total', 'counter', 'Requests by handler and status class.',
+           [('', labels, stats['count']) for labels, stats in rows])
+    family('request_errors_total', 'counter',
+           'Requests ended by an exception.',
+           [('', labels, stats['errors']) for labels, stats in rows])
+    family('response_bytes_total', 'counter', 'Bytes sent in responses.',
+           [('', labels, stats['bytes']) for labels, stats in rows])
+    samples = []
+    for labels, stats in rows:
+        for bound, count in stats['buckets'].items():
+            samples.append(('_bucket', labels + (('le', bound),), count))
+        samples.append(('_sum', labels, stats['seconds']))
+        samples.append(('_count', labels, stats['count']))
+    family('request_duration_seconds', 'histogram',
+           'Time from the request line to the end of the response.', samples)
+    connections = snapshot['connections']
+    family('connections_total', 'counter', 'Accepted connections.',
+           [('', (), connections['count'])])
+    family('active_connections', 'gauge', 'Open connections.',
+           [('', (), connections['active'])])
+    family('start_time_seconds', 'gauge', 'Start time of the server.',
+           [('', (), snapshot['start_time'])])
+    names = sorted(set(name for stats in snapshot['caches'].values()
+                       for name in stats))
+    for name in names:
+        samples = [('', (('cache', cache),), stats[name])
+                   for cache, stats in sorted(snapshot['caches'].items())
+                   if name in stats]
+        if name in gauge_names:
+            family('cache_' + name, 'gauge', 'Current ' + name + ' of caches.',
+                   samples)
+        else:
+            family('cache_' + name + '_total', 'counter',
+                   'Count of ' + name + ' of caches.', samples)
+    return '\n'.join(lines) + '\n'
+
+def stats_format(path, accept):
+    '''Format of the metrics asked for by the format query parameter,
+    or by Accept: prometheus for Prometheus servers, json otherwise.
+    '''
+    query = urllib.parse.parse_qs(path.partition('?')[2])
+    if 'format' in query:
+        return query['format'][0]
+    accept = (accept or '').lower()
+    if 'application/json' not in accept and (
+            'text/plain' in accept or 'openmetrics' in accept):
+        return 'prometheus'
+    return 'json'
+
+class RequestMetrics(object):
+    '''Mix-in class of request handlers which records their connections
+    and requests in server.metrics, and answers GET and HEAD of
+    server.stats_path with them, when it is not None.
+    '''
+
+    request_started = None
+    response_status = None
+    metrics = None
+
+    def setup(self):
+        super().setup()
+        self.metrics = getattr(self.server, 'metrics', None)
+        if self.metrics is not None:
+            self.metrics.connection_opened()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            if self.metrics is not None:
+                self.metrics.connection_closed()
+                self.metrics = None
+
+    def handle_one_request(self):
+        self.request_started = None
+        try:
+            super().handle_one_request()
+        except BaseException:
+            self.record_request(True)
+            raise
+        self.record_request(False)
+
+    def parse_request(self):
+        '''Start the clock once the request line is read, and answer the
+        requests for the metrics.
+        '''
+        self.request_started = time.perf_counter()
+        self.response_status = None
+        self.sent_before = getattr(self.wfile, 'sent', 0)
+        if not super().parse_request():
+            return False
+        stats_path = getattr(self.server, 'stats_path', None)
+        if (stats_path and self.metrics is not None and
+                self.command in ('GET', 'HEAD') and
+                self.path.partition('?')[0] == stats_path):
+            self.send_stats()
+            return False
+        return True
+
+    def send_response_only(self, code, message=None):
+        if code >= 200:
+            self.response_status = code
+        super().send_response_only(code, message)
+
+    def record_request(self, error=False):
+        '''Record the current request, once.'''
+        started = self.request_started
+        if started is None or self.metrics is None:
+            return
+        self.request_started = None
+        self.metrics.record(type(self).__name__, self.response_status,
+                            time.perf_counter() - started,
+                            getattr(self.wfile, 'sent', 0) - self.sent_before,
+                            error)
+
+    def send_stats(self):
+        '''Send the metrics in the format asked for.'''
+        fmt = stats_format(self.path, self.headers.get('Accept'))
+        snapshot = self.metrics.snapshot(self.server)
+        if fmt == 'json':
+            body = json.dumps(snapshot, indent=2).encode()
+            ctype = 'application/json'
+        elif fmt == 'prometheus':
+            body = render_prometheus(snapshot).encode()
+            ctype = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Unknown format')
+            return
+        # sent as it is, by any handler
+        self.using_gzip = False
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.wfile.flush()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,50 +1,141 @@
-import gzip
+import html
+import io
 from http.server import BaseHTTPRequestHandler
 from http import HTTPStatus
 from chunkedfile import ChunkedWriter
+from compressor import CompressionPolicy, parse_accept_encoding
+from metrics import Metrics, RequestMetrics
 from servers import ThreadingHTTPServer
 
 __version__ = '0.1'
 
-class MinHTTPRequestHandler(BaseHTTPRequestHandler):
+class SocketWriter(io.BufferedIOBase):
+    '''Unbuffered writer of a socket, as the wfile of StreamRequestHandler
+    when wbufsize is 0, which also writes several buffers in a single
+    sendmsg call with writev. sent counts the bytes written.
+    '''
+    def __init__(self, sock):
+        self._sock = sock
+        self.sent = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._sock.sendall(b)
+        with memoryview(b) as view:
+            self.sent += view.nbytes
+            return view.nbytes
+
+    def writev(self, buffers):
+        if not hasattr(self._sock, 'sendmsg'):
+            self.write(b''.join(buffers))
+            return
+        buffers = [memoryview(buf).cast('B') for buf in buffers]
+        while buffers:
+            sent = self._sock.sendmsg(buffers)
+            self.sent += sent
+            # drop what was sent, sendmsg may stop anywhere
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers.pop(0))
+            if buffers:
+                buffers[0] = buffers[0][sent:]
+
+    def sendfile(self, fileobj, offset=0, count=None):
+        '''Send a file with socket.sendfile, the kernel copies the data.'''
+        sent = self._sock.sendfile(fileobj, offset, count)
+        self.sent += sent
+        return sent
+
+    def fileno(self):
+        return self._sock.fileno()
+
+class MinHTTPRequestHandler(RequestMetrics, BaseHTTPRequestHandler):
     '''Extend BaseHTTPRequestHandler to support:
     * long HTTP connection
     * Content-Encoding
+    * metrics of its requests, see metrics.RequestMetrics
     self.outfile instead of self.wfile should be used.
     '''
 
     server_version = 'MinHTTP/' + __version__
     protocol_version = 'HTTP/1.1'
+    status_code = None
+    # wfile is not buffered: a response written in several pieces would
+    # wait for the delayed ACK of the client with Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        if self.wbufsize == 0:
+            self.wfile = SocketWriter(self.connection)
+
+    def handle_one_request(self):
+        '''Forget the encoding state left by the previous request on this connection.'''
+        for name in ('using_gzip', 'using_chunked', 'compress_level',
+                     'content_coding'):
+            if hasattr(self, name):
+                delattr(self, name)
+        super().handle_one_request()
 
     def send_header(self, keyword, value):
-        '''Find Content-Length and catch it if possible.'''
+        '''Find Content-Length and catch it if possible.
+        Content-Type and Vary are noted for the compression policy.'''
         if not hasattr(self, '_content_length'):
             self._content_length = None
         if keyword == 'Content-Length':
             self._content_length = value
-        else:
-            super().send_header(keyword, value)
+            return
+        if keyword.lower() == 'content-type':
+            self._content_type = value
+        elif keyword.lower() == 'vary':
+            self._varies = True
+        super().send_header(keyword, value)
+
+    def send_response_only(self, code, message=None):
+        '''Remember the status code, some responses never have a body.'''
+        self.status_code = code
+        super().send_response_only(code, message)
 
     def end_headers(self):
         '''Send extra HTTP headers.
         If you want to send response body as well, you are supposed to use self.start_body() and self.end_body().
         '''
+        if self.status_code is not None and self.status_code < 200:
+            # interim response, the final one follows with its own headers
+            self.forget_headers()
+            super().end_headers()
+            return
+        if self.status_code in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED):
+            # no body at all, hence no Content-Length, encoding or framing
+            self.using_gzip = False
+            self.using_chunked = False
+            self._content_length = None
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            else:
+                self.send_header('Connection', 'keep-alive')
+            super().end_headers()
+            self.forget_headers()
+            return
         if not hasattr(self, 'using_gzip'):
             self.using_gzip = self.server.using_gzip
         if not hasattr(self, 'using_chunked'):
             self.using_chunked = False
 
-        if 'Accept-Encoding' in self.headers and self.using_gzip:
-            encodings = self.headers['Accept-Encoding'].split(',')
-            encodings = [encoding.strip() for encoding in encodings]
-            if 'gzip' in encodings:
-                self.send_header('Content-Encoding', 'gzip')
-                self.using_gzip = True
-                if not hasattr(self, 'compress_level'):
-                    self.compress_level = self.server.compress_level
-            elif 'deflate' in encodings:
-                # unusual
-                pass
+        policy = self.server.compression
+        coding = self.response_coding(getattr(self, '_content_type', None),
+                                      self._content_length)
+        if coding:
+            self.send_header('Content-Encoding', coding)
+            if not hasattr(self, 'compress_level'):
+                self.compress_level = policy.current_level(self.server)
+        if (self.using_gzip and not getattr(self, '_varies', False) and
+                policy.compressible(getattr(self, '_content_type', None),
+                                    self._content_length)):
+            # the coding depends on Accept-Encoding
+            self.send_header('Vary', 'Accept-Encoding')
+        self.using_gzip = bool(coding)
 
         if self.close_connection:
             self.send_header('Connection', 'close')
@@ -62,13 +153,50 @@ class MinHTTPRequestHandler(BaseHTTPRequestHandler):
             self.using_chunked = True
 
         super().end_headers()
-        delattr(self, '_content_length')
+        self.forget_headers()
+
+    def forget_headers(self):
+        for name in '_content_length', '_content_type', '_varies':
+            if hasattr(self, name):
+                delattr(self, name)
+
+    def response_coding(self, ctype=None, length=None):
+        '''Content-coding to compress the response with on the fly, as
+        negotiated by the compression policy of the server, None for none.
+        The choice is kept for the rest of the response.
+        '''
+        if not getattr(self, 'using_gzip', self.server.using_gzip):
+            return None
+        if not hasattr(self, 'content_coding'):
+            self.content_coding = self.server.compression.negotiate(
+                self.headers.get('Accept-Encoding'), ctype, length)
+        return self.content_coding
+
+    def accept_encoding(self, coding):
+        '''Whether the content-coding is acceptable, by Accept-Encoding.'''
+        accepted = parse_accept_encoding(self.headers.get('Accept-Encoding'))
+        return accepted.get(coding, accepted.get('*', 0)) > 0
+
+    def end_headers_with(self, headers, body=b''):
+        '''End headers with prebuilt header lines, which must include
+        Content-Length, and send them with the whole body in a single write.
+        '''
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        else:
+            self.send_header('Connection', 'keep-alive')
+        self.forget_headers()
+        self._headers_buffer.append(headers)
+        self._headers_buffer.append(b'\r\n')
+        if body:
+            self._headers_buffer.append(body)
+        self.flush_headers()
 
     def just_end_headers(self):
         '''Just end headers, doing nothing else.'''
         if self._content_length:
             super().send_header('Content-Length', self._content_length)
-        delattr(self, '_content_length')
+        self.forget_headers()
         super().end_headers()
 
     def start_body(self):
@@ -80,16 +208,14 @@ class MinHTTPRequestHandler(BaseHTTPRequestHandler):
         else:
             self.chunked_file = None
         if self.using_gzip:
-            self.outfile = self.gzip_file = gzip.GzipFile(
-                    fileobj=self.outfile, mode='wb',
-                    compresslevel=self.compress_level)
+            self.outfile = self.gzip_file = self.server.compression.open(
+                    self.content_coding, self.outfile, self.compress_level)
         else:
             self.gzip_file = None
 
     def end_body(self):
         '''Do some clean up works.'''
         if self.gzip_file:
-            self.gzip_file.flush()
             self.gzip_file.close()
         if self.chunked_file:
             self.chunked_file.end_file()
@@ -100,6 +226,8 @@ class MinHTTPRequestHandler(BaseHTTPRequestHandler):
             delattr(self, 'using_chunked')
         if hasattr(self, 'compress_level'):
             delattr(self, 'compress_level')
+        if hasattr(self, 'content_coding'):
+            delattr(self, 'content_coding')
         if hasattr(self, 'outfile'):
             delattr(self, 'outfile')
 
@@ -117,7 +245,6 @@ class MinHTTPRequestHandler(BaseHTTPRequestHandler):
         output has been generated), logs the error, and finally sends
         a piece of HTML explaining the error to the user.
         """
-        from http.server import _quote_html
         try:
             shortmsg, longmsg = self.responses[code]
         except KeyError:
@@ -127,9 +254,10 @@ class MinHTTPRequestHandler(BaseHTTPRequestHandler):
         if explain is None:
             explain = longmsg
         self.log_error("code %d, message %s", code, message)
-        # using _quote_html to prevent Cross Site Scripting attacks (see bug #1100201)
+        # escaping to prevent Cross Site Scripting attacks (see bug #1100201)
         content = (self.error_message_format %
-                   {'code': code, 'message': _quote_html(message), 'explain': _quote_html(explain)})
+                   {'code': code, 'message': html.escape(message, quote=False),
+                    'explain': html.escape(explain, quote=False)})
         body = content.encode('UTF-8', 'replace')
         self.send_response(code, message)
         self.send_header("Content-Type", self.error_content_type)
@@ -147,4 +275,14 @@ class MinHTTPServer(ThreadingHTTPServer):
         super().__init__(*args, **kwargs)
         self.using_gzip = False
         self.compress_level = 9
+        self.compression = CompressionPolicy()
+        self.metrics = Metrics()
+        # path at which the metrics are served, such as '/__stats'. None
+        # by default: they are public to every client and the path shadows
+        # any file or upstream URL of the same name
+        self.stats_path = None
+
+    def cache_stats(self):
+        '''Statistics of the caches of the server, by cache name.'''
+        return {}
 
@@ -0,0 +1,373 @@
+'''
+Cache of the responses of pythonhttp scripts.
+
+A script declares that its output may be cached with module attributes:
+
+cache_ttl
+    seconds a response is fresh, the only one required.
+cache_vary_query
+    names of the query parameters the response depends on, by default all.
+cache_vary_headers
+    names of the request headers the response depends on.
+cache_max_size
+    largest body to store, 1 MiB by default.
+cache_stale
+    seconds an expired response may still be sent while it is refreshed
+    in the background, by one thread per response.
+
+Responses with status 200 to GET are stored, unless they set cookies or
+Cache-Control forbids it. The policy of a script is learnt from its runs:
+until it is known to declare one, a script runs with the request handler
+itself. Afterwards it is run with a RecordingHandler, which sends the
+response once it is complete, or streams it as soon as it is too large to
+be stored.
+
+>>> class Script(object):
+...     cache_ttl = 60
+...     cache_vary_query = ('page',)
+>>> policy = script_cache_policy(Script)
+>>> policy['ttl'], policy['vary_query'], policy['stale']
+(60, ('page',), 0)
+>>> script_cache_policy(object()) is None
+True
+'''
+
+import io
+import threading
+import time
+from filecache import LRUCache
+from formdata import RequestData
+from http import HTTPStatus
+
+# headers of a script response which are not stored
+unstored_headers = frozenset([
+    'server', 'date', 'connection', 'keep-alive', 'content-length',
+    'transfer-encoding', 'age'])
+
+# attributes of the handler set by a script which are replayed
+replayed_attributes = ('using_gzip', 'compress_level')
+
+# attributes of the handler which a RecordingHandler takes from it, those
+# which do not write the response
+forwarded_attributes = frozenset([
+    'protocol_version', 'server_version', 'sys_version', 'responses',
+    'extensions_map', 'weekdayname', 'monthname', 'date_time_string',
+    'log_date_time_string', 'address_string', 'version_string',
+    'translate_path', 'guess_type', 'log_request'])
+
+def script_cache_policy(module):
+    '''Cache policy declared by a script module, or None.'''
+    ttl = getattr(module, 'cache_ttl', None)
+    if not ttl:
+        return None
+    vary_query = getattr(module, 'cache_vary_query', None)
+    return {
+        'ttl': ttl,
+        'vary_query': None if vary_query is None else tuple(vary_query),
+        'vary_headers': tuple(getattr(module, 'cache_vary_headers', ())),
+        'max_size': getattr(module, 'cache_max_size', 1 << 20),
+        'stale': getattr(module, 'cache_stale', 0),
+    }
+
+class StoredResponse(object):
+    def __init__(self, status, reason, headers, attributes, body, ttl, stale):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.attributes = attributes
+        self.body = body
+        self.stored = time.monotonic()
+        self.ttl = ttl
+        self.stale = stale
+
+    def age(self):
+        return time.monotonic() - self.stored
+
+    def size(self):
+        return len(self.body) + sum(len(key) + len(value)
+                                    for key, value in self.headers)
+
+    def send(self, handler):
+        '''Send the response for the request of handler.'''
+        for name, value in self.attributes.items():
+            setattr(handler, name, value)
+        handler.send_response(self.status, self.reason)
+        ctype = varies = None
+        for key, value in self.headers:
+            if key.lower() == 'content-type':
+                ctype = value
+            elif key.lower() == 'vary':
+                varies = True
+        if not handler.response_coding(ctype, len(self.body)):
+            # sent as it is, headers and body in a single write
+            lines = ''.join('{}: {}\r\n'.format(key, value)
+                            for key, value in self.headers)
+            if (not varies and
+                    getattr(handler, 'using_gzip', handler.server.using_gzip) and
+                    handler.server.compression.compressible(
+                        ctype, len(self.body))):
+                lines += 'Vary: Accept-Encoding\r\n'
+            lines += 'Age: {}\r\nContent-Length: {}\r\n'.format(
+                int(self.age()), len(self.body))
+            lines = lines.encode('latin-1', 'strict')
+            if handler.command == 'HEAD':
+                handler.end_headers_with(lines)
+            else:
+                handler.end_headers_with(lines, self.body)
+            return
+        for key, value in self.headers:
+            handler.send_header(key, value)
+        handler.send_header('Age', str(int(self.age())))
+        handler.send_header('Content-Length', str(len(self.body)))
+        handler.end_headers()
+        if handler.command != 'HEAD':
+            handler.start_body()
+            try:
+                handler.outfile.write(self.body)
+            finally:
+                handler.end_body()
+
+class RecordingHandler(RequestData):
+    '''Stand-in of a request handler which records the response of a script.
+
+    With a target handler, the response is sent to it by finish, or is
+    streamed to it from the moment the body grows larger than max_size or
+    the script sends an error. Without one, it is only recorded.
+    '''
+    def __init__(self, handler, max_size, target=None):
+        self.handler = handler
+        for name in ('path', 'command', 'request_version', 'requestline',
+                     'client_address', 'headers', 'server') + self.form_limits:
+            setattr(self, name, getattr(handler, name))
+        self.log_message = handler.log_message
+        self.log_error = handler.log_error
+        self.rfile = self.body_reader = io.BytesIO()
+        self.wfile = self.outfile = self
+        self.max_size = max_size
+        self.target = target
+        self.streaming = False
+        self.failed = False
+        self.status = self.reason = None
+        self.response_headers = []
+        self.headers_ended = False
+        self.length = None
+        self.cache_policy = None
+        self.body = bytearray()
+
+    def __getattr__(self, name):
+        if name not in forwarded_attributes:
+            raise AttributeError(
+                '{!r} is not available to scripts whose output is cached.'.format(
+                    name))
+        return getattr(self.__dict__['handler'], name)
+
+    def send_response(self, code, message=None):
+        self.status, self.reason = code, message
+        self.response_headers = []
+
+    def send_response_only(self, code, message=None):
+        pass
+
+    def send_header(self, keyword, value):
+        if self.headers_ended:
+            return
+        name = keyword.lower()
+        if name == 'content-length':
+            self.length = value
+        elif name not in unstored_headers:
+            self.response_headers.append((keyword, str(value)))
+
+    def end_headers(self):
+        self.headers_ended = True
+
+    def flush_headers(self):
+        pass
+
+    def send_error(self, code, message=None, explain=None):
+        self.failed = True
+        if self.target is not None and not self.streaming:
+            self.streaming = True
+            self.target.send_error(code, message, explain)
+
+    def start_body(self):
+        pass
+
+    def end_body(self):
+        pass
+
+    def write(self, data):
+        if self.failed:
+            return len(data)
+        if self.streaming:
+            return self.target.outfile.write(data)
+        self.body += data
+        if len(self.body) > self.max_size and self.target is not None:
+            self.stream()
+        return len(data)
+
+    def flush(self):
+        if self.streaming and not self.failed:
+            self.target.outfile.flush()
+
+    def stream(self):
+        '''Send what is recorded to the target, then pass writes on.'''
+        self.streaming = True
+        target = self.target
+        for name in replayed_attributes:
+            if name in self.__dict__:
+                setattr(target, name, self.__dict__[name])
+        target.send_response(self.status or HTTPStatus.OK, self.reason)
+        for key, value in self.response_headers:
+            target.send_header(key, value)
+        if self.length is not None:
+            target.send_header('Content-Length', self.length)
+        target.end_headers()
+        target.start_body()
+        target.outfile.write(self.body)
+        self.body = None
+
+    def response(self):
+        '''The recorded response as a StoredResponse, or None if it may not
+        be stored.
+        '''
+        policy = self.cache_policy
+        if (policy is None or self.failed or self.streaming or
+                self.status != HTTPStatus.OK or self.command != 'GET' or
+                len(self.body) > policy['max_size']):
+            return None
+        for key, value in self.response_headers:
+            key = key.lower()
+            if key == 'set-cookie':
+                return None
+            if key == 'cache-control' and any(
+                    directive in value.lower()
+                    for directive in ('no-store', 'private', 'no-cache')):
+                return None
+        attributes = dict((name, self.__dict__[name])
+                          for name in replayed_attributes
+                          if name in self.__dict__)
+        return StoredResponse(self.status, self.reason, self.response_headers,
+                              attributes, bytes(self.body), policy['ttl'],
+                              policy['stale'])
+
+    def finish(self, response=None):
+        '''Send the response to the target, after the script is done.'''
+        target = self.target
+        if self.__dict__.get('close_connection'):
+            target.close_connection = True
+        if self.streaming:
+            if not self.failed:
+                target.end_body()
+            return
+        if response is None:
+            response = StoredResponse(self.status or HTTPStatus.OK, self.reason,
+                                      self.response_headers, {},
+                                      bytes(self.body), 0, 0)
+        response.send(target)
+
+class OutputCache(object):
+    '''Bounded LRU cache of script responses, see the module documentation.'''
+    def __init__(self, max_size=64 << 20, max_entries=10000):
+        self.entries = LRUCache(max_size, max_entries)
+        self.policies = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def key(self, script, handler, policy):
+        vary_query = policy['vary_query']
+        if vary_query is None:
+            query = tuple(sorted(handler.query.allitems()))
+        else:
+            query = tuple(tuple(handler.query.getlist(name))
+                          for name in vary_query)
+        headers = tuple(handler.headers.get(name)
+                        for name in policy['vary_headers'])
+        return script, query, headers
+
+    def serve(self, handler, script, execute):
+        '''Answer the request of handler for script from the cache, or by
+        execute(handler, script) which runs the script.
+        '''
+        policy = self.policies.get(script)
+        if policy is None:
+            # not known to be cacheable, nothing to record
+            handler.cache_policy = None
+            execute(handler, script)
+            if handler.cache_policy is not None:
+                self.policies[script] = handler.cache_policy
+            return
+        key = self.key(script, handler, policy)
+        response = self.entries.get(key)
+        if response is not None:
+            age = response.age()
+            if age < response.ttl:
+                self.count('hits')
+                response.send(handler)
+                return
+            if age < response.ttl + response.stale:
+                self.count('stale_hits')
+                self.refresh(key, handler, script, execute, policy)
+                response.send(handler)
+                return
+        self.count('misses')
+        recorder = RecordingHandler(handler, policy['max_size'], handler)
+        try:
+            execute(recorder, script)
+        except:
+            if recorder.streaming:
+                handler.close_connection = True
+            raise
+        response = self.learn(script, recorder)
+        recorder.finish(response)
+
+    def learn(self, script, recorder):
+        '''Keep the policy and the response of a run of script.'''
+        policy = recorder.cache_policy
+        if policy is None:
+            self.policies.pop(script, None)
+            return None
+        self.policies[script] = policy
+        response = recorder.response()
+        if response is not None:
+            self.entries.put(self.key(script, recorder, policy), response,
+                             response.size())
+        return response
+
+    def refresh(self, key, handler, script, execute, policy):
+        '''Run script again in the background, unless it already is.'''
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        recorder = RecordingHandler(handler, policy['max_size'])
+        thread = threading.Thread(target=self.run_refresh,
+                                  args=(key, recorder, script, execute),
+                                  daemon=True)
+        thread.start()
+
+    def run_refresh(self, key, recorder, script, execute):
+        try:
+            execute(recorder, script)
+            self.learn(script, recorder)
+            self.count('refreshes')
+        except Exception:
+            recorder.log_error('Refresh of %s failed', script)
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def clear(self):
+        self.entries.clear()
+        self.policies.clear()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -1,128 +1,560 @@
 from http import HTTPStatus
-import urllib.request
-import sys
-import io
-import random
-import math
-import os
+import http.client
+import urllib.parse
 import shutil
 import socket
+import threading
 import time
-import copy
-import gzip
-import html
 from http.server import BaseHTTPRequestHandler
-from chunkedfile import ChunkedWriter
+from chunkedfile import ChunkedError, ChunkedReader, ChunkedWriter
+from collapsing import Flights, FlightAborted
+from connpool import ConnectionPool
+from httpcache import HTTPCache, parse_cache_control
+from httputil import parse_digits
+from metrics import Metrics, RequestMetrics
+from minhttp import SocketWriter
+from rangedfile import RangedFile
+from servers import ThreadingHTTPServer, run_server
+from tunnel import Tunnel
 
 __version__ = '0.1'
 
-class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
+# headers which only make sense for a single connection, RFC 7230 section 6.1
+hop_by_hop_headers = frozenset([
+    'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate',
+    'proxy-authorization', 'te', 'trailer', 'transfer-encoding', 'upgrade'])
+
+# errors of a reused connection which the upstream server closed meanwhile
+stale_errors = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                ConnectionResetError, BrokenPipeError)
+
+class ProxyHTTPRequestHandler(RequestMetrics, BaseHTTPRequestHandler):
     '''A HTTP proxy request handler.'''
 
     server_version = 'ProxyHTTP/' + __version__
     protocol_version = 'HTTP/1.1'
+    copy_size = 64 << 10
+    continue_pending = False
+    # wfile is not buffered, see MinHTTPRequestHandler
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        if self.wbufsize == 0:
+            self.wfile = SocketWriter(self.connection)
 
     def do_HEAD(self):
         '''Serve a HEAD request.'''
         if not self.authorize(): return
-        request = urllib.request.Request(self.path,
-                                         headers=self.headers,
-                                         method='HEAD')
-        request.headers['Connection'] = 'close'
-        try:
-            response = urllib.request.urlopen(request)
-        except urllib.error.HTTPError as error:
-            self.send_error(error.code, error.reason)
-            return
-        try:
-            self.send_response(response.status)
-            for key, value in response.headers.items():
-                self.send_header(key, value)
-            self.end_headers()
-        finally:
-            response.close()
+        self.forward()
 
     def do_GET(self):
         '''Serve a GET request.'''
         if not self.authorize(): return
-        request = urllib.request.Request(self.path,
-                                         headers=self.headers,
-                                         method='GET')
-        try:
-            response = urllib.request.urlopen(request)
-        except urllib.error.HTTPError as error:
-            self.send_error(error.code, error.reason)
-            return
-        try:
-            self.transfer(response)
-        finally:
-            response.close()
+        self.forward()
 
     def do_POST(self):
-        '''Serve a POST request.'''
+        '''Serve a POST request, or another one which may have a body.
+        The body is streamed upstream while it is read.
+        '''
         if not self.authorize(): return
-        request = urllib.request.Request(self.path,
-                                         headers=self.headers,
-                                         method='POST',
-                                         data=self.rfile.read())
         try:
-            response = urllib.request.urlopen(request)
-        except urllib.error.HTTPError as error:
-            self.send_error(error.code, error.reason)
+            body = self.request_body()
+        except ValueError as error:
+            self.send_error(HTTPStatus.BAD_REQUEST, str(error))
             return
-        try:
-            self.transfer(response)
-        finally:
-            response.close()
+        self.forward(body)
+        if self.continue_pending or not self.body_consumed(body):
+            # the rest of the body would be taken for the next request
+            self.close_connection = True
+        self.continue_pending = False
+
+    do_PUT = do_PATCH = do_DELETE = do_OPTIONS = do_POST
+
+    def handle_expect_100(self):
+        '''Defer 100 Continue until the request can be sent upstream, the
+        client does not send a body an error response would ignore.'''
+        self.continue_pending = True
+        return True
+
+    def send_continue(self):
+        if self.continue_pending:
+            self.continue_pending = False
+            self.send_response_only(HTTPStatus.CONTINUE)
+            self.end_headers()
+
+    def request_body(self):
+        '''Return a file object of the request body, None if it has none.'''
+        codings = self.headers.get('Transfer-Encoding')
+        if codings is not None:
+            if codings.split(',')[-1].strip().lower() != 'chunked':
+                raise ValueError('Unsupported transfer coding')
+            return ChunkedReader(self.rfile)
+        length = self.headers.get('Content-Length')
+        if length is None:
+            return None
+        length = parse_digits(length.strip())
+        if length is None:
+            raise ValueError('Bad Content-Length')
+        return RangedFile(self.rfile, 0, length)
+
+    @staticmethod
+    def body_consumed(body):
+        if body is None:
+            return True
+        if isinstance(body, ChunkedReader):
+            return body.eof
+        return body.remaining == 0
 
     def do_CONNECT(self):
         '''Serve a CONNECT request.'''
         if not self.authorize(): return
-        host, port = self.path.split(':')
-        port = int(port)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((host, port))
+        host, sep, port = self.path.rpartition(':')
+        port = parse_digits(port)
+        if not sep or port is None or port > 65535:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'host:port expected')
+            return
+        try:
+            sock = socket.create_connection((host.strip('[]'), port),
+                                            self.server.connection_pool.timeout)
+        except OSError as error:
+            self.send_error(HTTPStatus.BAD_GATEWAY, str(error))
+            return
+        self.close_connection = True
         self.send_response(HTTPStatus.OK, 'Connection Established')
         self.end_headers()
-        self.rfile.flush()
         self.wfile.flush()
-        self.connection.setblocking(0)
-        sock.setblocking(0)
-        while True:
-            try:
-                buf = sock.recv(1024)
-                if not buf: break
-                self.connection.send(buf)
-            except BlockingIOError:
-                time.sleep(0.01)
-            try:
-                buf = self.connection.recv(1024)
-                if not buf: break
-                sock.send(buf)
-            except BlockingIOError:
-                time.sleep(0.01)
-        sock.close()
-        self.close_connection = True
-        
+        try:
+            # the client may have sent data along with the request
+            early = self.buffered_input()
+            if early:
+                sock.sendall(early)
+        except OSError:
+            sock.close()
+            return
+        # the request is counted as established, not for the life of the tunnel
+        self.record_request()
+        tunnel = Tunnel(self.connection, sock, self.server.tunnel_idle_timeout)
+        tunnel.early = len(early)
+        self.server.open_tunnel(tunnel)
+        try:
+            tunnel.run()
+        finally:
+            self.server.close_tunnel(tunnel)
+            self.log_message('tunnel to %s closed, %d bytes sent, %d received',
+                             self.path, tunnel.sent, tunnel.received)
+
+    def buffered_input(self):
+        '''Read what is already buffered in rfile, without blocking.'''
+        timeout = self.connection.gettimeout()
+        self.connection.setblocking(False)
+        try:
+            data = self.rfile.peek(1)
+        except OSError:
+            data = b''
+        finally:
+            self.connection.settimeout(timeout)
+        return self.rfile.read(len(data))
+
     def authorize(self):
         return True
 
-    def transfer(self, response):
-        '''Send data to client.'''
-        self.send_response(response.status)
-        headers = copy.deepcopy(response.headers)
-        del headers['Transfer-Encoding']
-        del headers['Connection']
-        for key, value in headers.items():
-            self.send_header(key, value)
-        if 'Content-Length' not in response.headers and self.headers.get('Connection').lower() == 'keep-alive':
+    def forward(self, body=None):
+        '''Send the request upstream with a pooled connection and transfer the response.
+        GET and HEAD are answered from the response cache when possible, and
+        concurrent identical GET requests are collapsed into one fetch.
+        '''
+        url = urllib.parse.urlsplit(self.path)
+        if url.scheme not in ('http', 'https') or not url.hostname:
+            self.send_error(HTTPStatus.BAD_REQUEST, 'Absolute URL expected')
+            return
+        cache = self.server.response_cache
+        entry = body_file = None
+        if cache is not None and self.command in ('GET', 'HEAD'):
+            if self.cacheable_request():
+                entry, body_file = self.lookup_cache()
+                if entry is not None and cache.is_fresh(entry, self.headers):
+                    cache.count('hits', entry.size)
+                    self.send_cached(entry, body_file)
+                    return
+        flights = self.server.flights
+        if (flights is None or self.command != 'GET' or
+                not self.cacheable_request()):
+            self.fetch(url, body, entry, body_file)
+            return
+        key = self.flight_key()
+        flight, leader = flights.join(key, self)
+        try:
+            if leader and entry is None and cache is not None:
+                # a flight may have stored the response since the lookup
+                entry, body_file = self.lookup_cache()
+                if entry is not None and cache.is_fresh(entry, self.headers):
+                    cache.count('hits', entry.size)
+                    self.send_cached(entry, body_file)
+                    return
+            if not leader:
+                try:
+                    followed = self.follow(flight)
+                finally:
+                    flight.leave(self)
+                if followed:
+                    if body_file:
+                        body_file.close()
+                    return
+                flights.count('fallbacks')
+            self.fetch(url, body, entry, body_file, flight if leader else None)
+        finally:
+            if leader:
+                flights.land(key, flight)
+
+    def lookup_cache(self):
+        '''Return the stored response to the request and its opened body,
+        or (None, None) if there is none worth sending or revalidating.
+        '''
+        entry = self.server.response_cache.lookup(self.path, self.headers)
+        body_file = entry and entry.open()
+        if body_file is None:
+            return None, None
+        if self.server.response_cache.is_fresh(entry, self.headers) or (
+                self.command == 'GET' and entry.validators()):
+            return entry, body_file
+        body_file.close()
+        return None, None
+
+    def fetch(self, url, body, entry=None, body_file=None, flight=None):
+        '''Request url upstream, revalidating the stored entry if given, and
+        transfer the response. The response is stored in the cache and
+        shared with the followers of flight when it allows it.
+        '''
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        target = urllib.parse.urlunsplit(('', '', url.path or '/', url.query, ''))
+        headers = self.upstream_headers()
+        if entry is not None:
+            headers.extend(entry.validators())
+        cache = self.server.response_cache
+        pool = self.server.connection_pool
+        request_time = time.time()
+        try:
+            conn, response = self.request_upstream(
+                pool, url.scheme, url.hostname, port, target, headers, body)
+        except ChunkedError as error:
+            # the body of the client is malformed, not the upstream server
+            if body_file:
+                body_file.close()
+            self.close_connection = True
+            self.send_error(HTTPStatus.BAD_REQUEST, str(error))
+            return
+        except (OSError, http.client.HTTPException) as error:
+            if body_file:
+                body_file.close()
+            self.send_error(HTTPStatus.BAD_GATEWAY, str(error))
+            return
+        if (cache is not None and 200 <= response.status < 400 and
+                self.command not in ('GET', 'HEAD', 'OPTIONS', 'TRACE')):
+            # an unsafe request which failed changed nothing, RFC 7234 4.4
+            cache.invalidate(self.path)
+        if entry is not None and response.status == HTTPStatus.NOT_MODIFIED:
+            response.read()
+            self.release(conn, response)
+            cache.freshen(entry, response.getheaders(), request_time)
+            cache.count('revalidated', entry.size)
+            if flight:
+                flight.revalidated(entry)
+            self.send_cached(entry, body_file)
+            return
+        if body_file:
+            body_file.close()
+        writers = []
+        headers = response.getheaders()
+        if self.command == 'GET' and 'Range' not in self.headers:
+            shareable = HTTPCache.storable(response.status, headers, self.headers)
+            if cache is not None:
+                if self.cacheable_request():
+                    cache.count('misses')
+                if shareable:
+                    writers.append(cache.store(
+                        self.path, self.headers, response.status,
+                        response.reason, headers, request_time))
+            if flight and shareable:
+                flight.start(response.status, response.reason, headers,
+                             self.headers)
+                writers.append(flight)
+        try:
+            self.transfer(response, writers)
+        except:
+            pool.discard(conn)
+            raise
+        self.release(conn, response)
+
+    def flight_key(self):
+        cache = self.server.response_cache
+        if cache is not None:
+            return cache.key(self.path, self.headers)
+        return self.path, ()
+
+    def follow(self, flight):
+        '''Send the response fetched by the leader of flight.
+        Return False if it cannot be used, the request is then fetched.
+        '''
+        flights = self.server.flights
+        state = flight.wait(flights.wait_timeout)
+        if state == 'revalidated':
+            body_file = flight.entry.open()
+            if body_file is None:
+                return False
+            flights.count('collapsed')
+            self.send_cached(flight.entry, body_file)
+            return True
+        if state not in ('streaming', 'done'):
+            return False
+        status, reason, headers, request_headers = flight.response
+        for key, value in headers:
+            if key.lower() == 'vary':
+                for name in value.split(','):
+                    name = name.strip()
+                    if self.headers.get(name) != request_headers.get(name):
+                        return False
+        flights.count('collapsed')
+        outfile = self.send_upstream_head(status, reason, headers)
+        if outfile is None:
+            return True
+        try:
+            for data in flight.body(self, self.server.connection_pool.timeout):
+                outfile.write(data)
+        except FlightAborted as error:
+            # the status is sent already, the client can only see a broken body
+            self.log_error('%s', error)
+            self.close_connection = True
+            return True
+        if outfile is not self.wfile:
+            outfile.end_file()
+        return True
+
+    def release(self, conn, response):
+        '''Return the connection to the pool if it can be reused.'''
+        pool = self.server.connection_pool
+        if response.length == 0:
+            # read1 does not close a response at the end of its length
+            response.close()
+        if response.isclosed() and not response.will_close:
+            pool.put(conn)
+        else:
+            pool.discard(conn)
+
+    def cacheable_request(self):
+        '''Whether the response may be taken from the cache.
+        Requests with their own preconditions or ranges go to the origin.
+        '''
+        if 'no-store' in parse_cache_control(self.headers.get('Cache-Control')):
+            return False
+        return not any(name in self.headers for name in (
+            'Range', 'If-Match', 'If-None-Match', 'If-Modified-Since',
+            'If-Unmodified-Since', 'If-Range', 'Authorization'))
+
+    def send_cached(self, entry, body_file):
+        '''Send a response of the cache.'''
+        with body_file:
+            self.log_request(entry.status)
+            self.send_response_only(entry.status, entry.reason)
+            for key, value in entry.headers:
+                self.send_header(key, value)
+            self.send_header('Age', str(int(entry.age())))
+            if entry.status >= 200 and entry.status not in (
+                    HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED):
+                self.send_header('Content-Length', str(entry.size))
+            self.end_headers()
+            if self.command == 'HEAD':
+                return
+            if entry.path is not None and isinstance(self.wfile, SocketWriter):
+                self.wfile.sendfile(body_file)
+            else:
+                shutil.copyfileobj(body_file, self.wfile)
+
+    def request_upstream(self, pool, scheme, host, port, target, headers, body):
+        '''Return (connection, response). A reused connection found stale is retried once with a new one.'''
+        while True:
+            conn, reused = pool.get(scheme, host, port)
+            try:
+                conn.putrequest(self.command, target,
+                                skip_host=True, skip_accept_encoding=True)
+                for key, value in headers:
+                    conn.putheader(key, value)
+                chunked = isinstance(body, ChunkedReader)
+                if chunked:
+                    conn.putheader('Transfer-Encoding', 'chunked')
+                if body is not None:
+                    if conn.sock is None:
+                        conn.connect()
+                    self.send_continue()
+                conn.endheaders(body, encode_chunked=chunked)
+                return conn, conn.getresponse()
+            except stale_errors:
+                pool.discard(conn)
+                if not reused or hasattr(body, 'read'):
+                    # a streamed body cannot be sent again
+                    raise
+                pool.retried += 1
+            except:
+                pool.discard(conn)
+                raise
+
+    def upstream_headers(self):
+        '''Headers of the request without the hop-by-hop ones.'''
+        connection = self.headers.get('Connection', '')
+        dropped = hop_by_hop_headers.union(
+            token.strip().lower() for token in connection.split(','))
+        if 'Transfer-Encoding' in self.headers:
+            # the body is sent chunked, its length is not known
+            dropped = dropped.union(['content-length'])
+        dropped = dropped.union(['expect'])
+        headers = [(key, value) for key, value in self.headers.items()
+                   if key.lower() not in dropped]
+        if 'Host' not in self.headers:
+            headers.insert(0, ('Host', urllib.parse.urlsplit(self.path).netloc))
+        return headers
+
+    def send_upstream_head(self, status, reason, headers):
+        '''Send the status and headers of an upstream response.
+        Return the file to write the body to, None if it has no body.
+        '''
+        self.log_request(status)
+        self.send_response_only(status, reason)
+        connection = ', '.join(value for key, value in headers
+                               if key.lower() == 'connection')
+        dropped = hop_by_hop_headers.union(
+            token.strip().lower() for token in connection.split(','))
+        length = False
+        for key, value in headers:
+            if key.lower() not in dropped:
+                self.send_header(key, value)
+                length = length or key.lower() == 'content-length'
+        if (self.command == 'HEAD' or status < 200 or
+                status in (HTTPStatus.NO_CONTENT, HTTPStatus.NOT_MODIFIED)):
+            self.end_headers()
+            return None
+        if length:
+            outfile = self.wfile
+        elif self.request_version == 'HTTP/1.1':
             outfile = ChunkedWriter(self.wfile, -1)
             self.send_header('Transfer-Encoding', 'chunked')
-            self.end_headers()
-            shutil.copyfileobj(response, outfile)
-            outfile.end_file()
         else:
+            # the end of the body can only be told by closing the connection
             outfile = self.wfile
-            self.end_headers()
-            shutil.copyfileobj(response, self.wfile)
-        
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        return outfile
+
+    def transfer(self, response, writers=()):
+        '''Send data to client. The body is also given to writers, such as
+        a CacheWriter or a Flight, which are committed when it is complete.
+        If the client goes away, the body is still read for the writers.
+        '''
+        outfile = self.send_upstream_head(response.status, response.reason,
+                                          response.getheaders())
+        error = None
+        try:
+            while True:
+                data = response.read1(self.copy_size) if outfile else response.read()
+                if not data:
+                    break
+                if outfile and error is None:
+                    try:
+                        outfile.write(data)
+                    except OSError as exc:
+                        if not writers:
+                            raise
+                        error = exc
+                for writer in writers:
+                    writer.write(data)
+        except:
+            for writer in writers:
+                writer.abort()
+            raise
+        if outfile is not None and outfile is not self.wfile and error is None:
+            outfile.end_file()
+        for writer in writers:
+            writer.commit()
+        if error is not None:
+            raise error
+
+class ProxyHTTPServer(ThreadingHTTPServer):
+    # a class attribute, so that server_close works when __init__ fails
+    connection_pool = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection_pool = ConnectionPool()
+        # shared response cache, None to disable
+        self.response_cache = HTTPCache()
+        # concurrent identical requests, None to fetch each one
+        self.flights = Flights()
+        self.tunnel_idle_timeout = 300
+        # open CONNECT tunnels, and the bytes of those which are closed
+        self.tunnels = set()
+        self.tunnel_lock = threading.Lock()
+        self.tunnel_sent = self.tunnel_received = 0
+        self.metrics = Metrics()
+        # path at which the metrics are served, such as '/__stats'. None
+        # by default: they are public to every client and the path shadows
+        # any file or upstream URL of the same name
+        self.stats_path = None
+
+    def cache_stats(self):
+        '''Statistics of the caches of the server, by cache name.'''
+        stats = {}
+        cache = self.response_cache
+        if cache is not None:
+            stats['response_cache'] = {
+                'hits': cache.hits, 'revalidated': cache.revalidated,
+                'misses': cache.misses, 'stored': cache.stored,
+                'bytes_saved': cache.bytes_saved}
+            stats['response_memory'] = cache.memory.stats()
+            stats['response_disk'] = cache.disk.stats()
+        pool = self.connection_pool
+        stats['connection_pool'] = {
+            'created': pool.created, 'reused': pool.reused,
+            'discarded': pool.discarded, 'retried': pool.retried,
+            'open': pool.total}
+        if self.flights is not None:
+            stats['flights'] = {
+                'led': self.flights.led, 'collapsed': self.flights.collapsed,
+                'fallbacks': self.flights.fallbacks,
+                'in_flight': len(self.flights.flights)}
+        with self.tunnel_lock:
+            tunnels = list(self.tunnels)
+            sent, received = self.tunnel_sent, self.tunnel_received
+        stats['tunnels'] = {
+            'open': len(tunnels),
+            'sent': sent + sum(tunnel.sent for tunnel in tunnels),
+            'received': received + sum(tunnel.received for tunnel in tunnels)}
+        return stats
+
+    def open_tunnel(self, tunnel):
+        with self.tunnel_lock:
+            self.tunnels.add(tunnel)
+
+    def close_tunnel(self, tunnel):
+        '''Forget a tunnel which ended, keeping its byte counts.'''
+        with self.tunnel_lock:
+            self.tunnels.discard(tunnel)
+            self.tunnel_sent += tunnel.sent
+            self.tunnel_received += tunnel.received
+
+    def server_close(self):
+        super().server_close()
+        if self.connection_pool is not None:
+            self.connection_pool.close()
+
+def main(args):
+    if len(args) == 1:
+        port = int(args[0])
+    else:
+        port = 8080
+    server_address = ('', port)
+    with run_server(server_address, ProxyHTTPServer, ProxyHTTPRequestHandler) as server:
+        server.stats_path = '/__stats'
+
+if __name__ == '__main__':
+    from sys import argv
+    main(argv[1:])
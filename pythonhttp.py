@@ -2,241 +2,271 @@
 from http.server import SimpleHTTPRequestHandler
 import os
 from http import HTTPStatus
-import urllib.parse
-import html
 import sys
-import io
-import importlib.machinery
-from rangedfile import RangedFile
+import types
+import threading
+import time
+import traceback
+from filecache import LRUCache, stat_signature
 from filehttp import FileHTTPRequestHandler, FileHTTPServer, run_server
+from outputcache import OutputCache, script_cache_policy
+from formdata import (FormError, RequestData, body_consumed, parse_query,
+                      request_body)
+from scriptapi import call_script
+from scriptpool import ScriptPool
 
 __version__ = '0.1'
 
 def get_query(path):
-    import json
-    query = urllib.parse.urlparse(path).query
-    query = query.split('&')
-    result = {}
-    for item in query:
-        item = urllib.parse.unquote(item)
-        items = item.split('=')
-        if len(items) != 2:
-            continue
-        key, value = items
-        key = json.loads('"{}"'.format(key))
-        value = json.loads('"{}"'.format(value))
-        result[key] = value
-    return result
-
-class PythonHTTPRequestHandler(FileHTTPRequestHandler):
+    '''MultiDict of the query string of path, see formdata.parse_query.'''
+    return parse_query(path)
+
+class PythonHTTPRequestHandler(RequestData, FileHTTPRequestHandler):
     '''Extended SimpleHTTPRequestHandler with HTTP request header Range supported.'''
 
     server_version = 'PythonHTTP/' + __version__
     protocol_version = 'HTTP/1.1'
 
-    def do_GET(self):
-        '''Same as SimpleHTTPRequestHandler, but we use self.outfile instead of self.wfile.'''
-        f = self.send_head()
-        if f:
-            self.start_body()
-            try:
-                self.send_file(f)
-            finally:
-                f.close()
-                self.end_body()
-
     def do_POST(self):
-        '''Handle a POST request.'''
-        f = self.send_head()
-        if not f:
-            raise ValueError('Cannot POST to the file.')
-        try:
-            self.start_body()
-            self.send_file(f)
-        finally:
-            f.close()
-            self.end_body()
+        '''Run a script with the request body. Static files cannot be posted.'''
+        if not self.check_body():
+            return
+        resolved = self.resolve(self.path)
+        if resolved.kind == 'file' and not self.is_static(resolved):
+            self.send_head()
+            return
+        if not body_consumed(request_body(self)):
+            self.close_connection = True
+        if resolved.kind in ('missing', 'redirect'):
+            self.send_head()
+        else:
+            self.send_error(HTTPStatus.METHOD_NOT_ALLOWED,
+                            'Cannot POST to the file')
+
+    index_files = 'index.html', 'index.htm', 'index.py'
 
     def send_head(self):
-        '''Same as super().send_header, but sending status code 206 and HTTP response header Content-Length.'''
-        path = self.translate_path(self.path)
-        f = None
-        if os.path.isdir(path):
-            parts = urllib.parse.urlsplit(self.path)
-            if not parts.path.endswith('/'):
-                if not self.server.allow_lsdir:
-                    self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
-                    return None
-                # redirect browser - doing basically what apache does
-                self.send_response(HTTPStatus.MOVED_PERMANENTLY)
-                new_parts = (parts[0], parts[1], parts[2] + '/',
-                             parts[3], parts[4])
-                new_url = urllib.parse.urlunsplit(new_parts)
-                self.send_header('Location', new_url)
-                self.end_headers()
-                self.start_body()
-                self.end_body()
-                return None
-            for index in 'index.html', 'index.htm', 'index.py':
-                index = os.path.join(path, index)
-                if os.path.exists(index):
-                    path = index
-                    break
-            else:
-                if self.server.allow_lsdir:
-                    return self.list_directory(path)
-                else:
-                    self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
-                    return None
-        ctype = self.guess_type(path)
-        try:
-            f = open(path, 'rb')
-        except OSError:
+        '''Same as FileHTTPRequestHandler.send_head, but directories are not revealed if listing is not allowed.'''
+        if (not self.server.allow_lsdir and
+                self.resolve(self.path).kind == 'redirect'):
             self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
             return None
+        return super().send_head()
+
+    def is_static(self, resolved):
+        '''Python scripts are run instead of sent.'''
+        return resolved.ctype != 'text/x-python'
+
+    def send_file_head(self, path, ctype=None):
+        '''Run python scripts, send other files as FileHTTPRequestHandler does.'''
+        if ctype is None:
+            ctype = self.guess_type(path)
         if ctype == 'text/x-python':
             self.run_script(path)
             return None
-        try:
-            if 'Range' not in self.headers:
-                fs = os.fstat(f.fileno())
-                if 'If-Modified-Since' in self.headers:
-                    if self.headers['If-Modified-Since'] == self.date_time_string(fs.st_mtime):
-                        self.send_response(HTTPStatus.NOT_MODIFIED)
-                        self.end_headers()
-                        f.close()
-                        self.start_body()
-                        self.end_body()
-                        return None
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', ctype)
-                self.send_header('Content-Length', str(fs[6]))
-                self.send_header('Last-Modified',
-                                 self.date_time_string(fs.st_mtime))
-                self.end_headers()
-                return f
-            else:
-                fs = os.fstat(f.fileno())
-                self.send_response(HTTPStatus.PARTIAL_CONTENT)
-                self.send_header('Content-type', ctype)
-                self.send_header('Last-Modified',
-                                 self.date_time_string(fs.st_mtime))
-                rstart, rend = self.headers['Range'].split('=')[-1].split('-')
-                rstart = 0 if rstart == '' else int(rstart)
-                rend = fs[6] if rend == '' else int(rend)
-                self.send_header('Content-Range', '{0}-{1}/{2}'.format(
-                    rstart, rend, fs[6]))
-                self.send_header('Content-Length', str(rend - rstart + 1))
-                self.end_headers()
-                return f
-        except:
-            f.close()
-            raise
-
-    def list_directory(self, path):
-        '''Helper to produce a directory listing (absent index.html).
-
-        Return value is either a file object, or None (indicating an
-        error).  In either case, the headers are sent, making the
-        interface the same as for send_head().
+        return super().send_file_head(path, ctype)
+
+    def check_body(self):
+        '''Make the reader of the request body, see formdata.request_body.
+        A body without a valid length cannot be told from the next request:
+        answer 400, close the connection and return False.
         '''
+        self.body_reader = None
         try:
-            list = os.listdir(path)
-        except OSError:
-            self.send_error(
-                HTTPStatus.NOT_FOUND,
-                'No permission to list directory')
-            return None
-        list.sort(key=lambda a: a.lower())
-        r = []
-        try:
-            displaypath = urllib.parse.unquote(self.path,
-                                               errors='surrogatepass')
-        except UnicodeDecodeError:
-            displaypath = urllib.parse.unquote(path)
-        displaypath = html.escape(displaypath)
-        enc = sys.getfilesystemencoding()
-        title = 'Directory listing for %s' % displaypath
-        r.append('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN" '
-                 '"http://www.w3.org/TR/html4/strict.dtd">')
-        r.append('<html>\n<head>')
-        r.append('<meta http-equiv="Content-Type" '
-                 'content="text/html; charset=%s">' % enc)
-        r.append('<title>%s</title>\n</head>' % title)
-        r.append('<body>\n<h1>%s</h1>' % title)
-        r.append('<hr>\n<ul>')
-        for name in list:
-            fullname = os.path.join(path, name)
-            displayname = linkname = name
-            # Append / for directories or @ for symbolic links
-            if os.path.isdir(fullname):
-                displayname = name + '/'
-                linkname = name + '/'
-            if os.path.islink(fullname):
-                displayname = name + '@'
-                # Note: a link to a directory displays with @ and links with /
-            r.append('<li><a href="%s">%s</a></li>'
-                    % (urllib.parse.quote(linkname,
-                                          errors='surrogatepass'),
-                       html.escape(displayname)))
-        r.append('</ul>\n<hr>\n</body>\n</html>\n')
-        encoded = '\n'.join(r).encode(enc, 'surrogateescape')
-        f = io.BytesIO()
-        f.write(encoded)
-        f.seek(0)
-        self.send_response(HTTPStatus.OK)
-        self.send_header('Content-type', 'text/html; charset=%s' % enc)
-        self.send_header('Content-Length', str(len(encoded)))
-        self.end_headers()
-        return f
-
-    def send_file(self, f):
-        '''Send content of a file object to response body.'''
-        if 'Range' in self.headers:
-            rstart, rend = self.headers['Range'].split('=')[-1].split('-')
-            rstart = 0 if rstart == '' else int(rstart)
-            rend = float('inf') if rend == '' else int(rend)
-            input_file = RangedFile(f, rstart, rend)
-        else:
-            input_file = f
-        super().copyfile(input_file, self.outfile)
+            request_body(self)
+        except FormError as error:
+            self.close_connection = True
+            self.send_error(error.status, str(error))
+            return False
+        return True
 
     def run_script(self, path):
-        if self.server.module_cache_pool:
-            module = self.server.module_cache_pool.update_module(path)
+        if not self.check_body():
+            return
+        cache = self.server.output_cache
+        if cache is not None and self.command in ('GET', 'HEAD'):
+            cache.serve(self, path, self.server.execute_script)
         else:
-            loader = importlib.machinery.SourceFileLoader('web.mod', path)
-            module = loader.load_module()
-        self.query = get_query(self.path)
-        module.handle(self)
+            self.server.execute_script(self, path)
+        # a body left unread, by the script or the output cache, would be
+        # taken for the next request
+        if not body_consumed(request_body(self)):
+            self.close_connection = True
     extensions_map = FileHTTPRequestHandler.extensions_map
     extensions_map.update({'.py': 'text/x-python'})
 
 class PythonHTTPServer(FileHTTPServer):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.module_cache_pool = None
+    # class attributes, so that server_close works when __init__ fails
+    module_cache_pool = None
+    script_pool = None
+    output_cache = None
 
-    def enable_module_cache(self):
+    def enable_module_cache(self, warmup=False):
+        '''Cache the modules of scripts. With warmup, import every script
+        under content_dir now, so that no request pays for it.
+        '''
         self.module_cache_pool = ModuleCachePool()
+        if warmup:
+            self.module_cache_pool.warmup(self.content_dir)
 
     def disable_module_cache(self):
         self.module_cache_pool = None
 
+    def enable_script_pool(self, processes=None, **kwargs):
+        '''Run scripts in worker processes, so that CPU bound scripts do not
+        hold up other requests. See ScriptPool for the keyword arguments.
+        '''
+        self.disable_script_pool()
+        kwargs.setdefault('preload_dir', self.content_dir)
+        self.script_pool = ScriptPool(processes, **kwargs)
+        self.script_pool.start()
+
+    def disable_script_pool(self):
+        if self.script_pool:
+            self.script_pool.close()
+        self.script_pool = None
+
+    def enable_output_cache(self, max_size=64 << 20, max_entries=10000):
+        '''Cache the responses of scripts which declare it, see outputcache.'''
+        self.output_cache = OutputCache(max_size, max_entries)
+
+    def disable_output_cache(self):
+        self.output_cache = None
+
+    def execute_script(self, handler, path):
+        '''Run the script at path for the request of handler.'''
+        if self.script_pool:
+            self.script_pool.run(handler, path)
+            return
+        if self.module_cache_pool:
+            module = self.module_cache_pool.update_module(path)
+        else:
+            module = load_script('web.mod', path)
+        handler.cache_policy = script_cache_policy(module)
+        call_script(module, handler)
+
+    def cache_stats(self):
+        stats = super().cache_stats()
+        if self.module_cache_pool:
+            stats['module_cache'] = dict(self.module_cache_pool.modules.stats(),
+                                         loads=self.module_cache_pool.loads)
+        if self.output_cache:
+            cache = self.output_cache
+            stats['output_cache'] = dict(
+                cache.entries.stats(), hits=cache.hits, misses=cache.misses,
+                stale_hits=cache.stale_hits, refreshes=cache.refreshes)
+        if self.script_pool:
+            pool = self.script_pool
+            stats['script_pool'] = {
+                'workers': len(pool.workers), 'idle': pool.idle.qsize(),
+                'timeouts': pool.timeouts, 'recycled': pool.recycled}
+        return stats
+
+    def server_close(self):
+        super().server_close()
+        self.disable_script_pool()
+
+def compile_script(path):
+    '''Code of the script at path, compiled in memory. No bytecode is
+    written next to the scripts.
+    '''
+    with open(path, 'rb') as f:
+        source = f.read()
+    return compile(source, path, 'exec', dont_inherit=True)
+
+def is_script(code):
+    '''Whether compiled code defines handle or application at top level,
+    rather than being a helper imported by scripts.
+    '''
+    return 'handle' in code.co_names or 'application' in code.co_names
+
+def load_script(name, path):
+    '''Import the script at path as a new module.'''
+    code = compile_script(path)
+    module = types.ModuleType(name)
+    module.__file__ = path
+    previous = sys.modules.get(name)
+    sys.modules[name] = module
+    try:
+        exec(code, module.__dict__)
+    except:
+        if previous is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = previous
+        raise
+    return module
+
+class CachedModule(object):
+    '''A module of a script, with the stat signature of its source.'''
+    def __init__(self, module, signature, checked):
+        self.module = module
+        self.signature = signature
+        self.checked = checked
+
 class ModuleCachePool(object):
-    def __init__(self):
-        self.pool = {}
+    '''Modules of scripts, reloaded when their source changes.
+
+    The source of a module is checked by stat at most once every
+    check_interval seconds. A changed script is imported again as a new
+    module, by one thread while others wait for it, and the new module
+    replaces the old one once it is fully executed. The least recently
+    used of more than max_modules modules are dropped.
+    Scripts are compiled in memory, see compile_script.
+    '''
+    def __init__(self, max_modules=1000, check_interval=1):
+        self.modules = LRUCache(max_modules, max_modules)
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.loads = 0
 
     def update_module(self, modulepath):
-        mtime = os.stat(modulepath).st_mtime
-        if modulepath in self.pool:
-            old_mtime, module = self.pool[modulepath]
-            if old_mtime == mtime:
-                return module
-        loader = importlib.machinery.SourceFileLoader(modulepath, modulepath)
-        module = loader.load_module()
-        self.pool[modulepath] = mtime, module
-        return module
+        '''Return the module of the script at modulepath, loaded if needed.'''
+        now = time.monotonic()
+        cached = self.modules.get(modulepath)
+        if cached is not None and now - cached.checked < self.check_interval:
+            return cached.module
+        signature = stat_signature(os.stat(modulepath))
+        if cached is not None and cached.signature == signature:
+            cached.checked = now
+            return cached.module
+        with self.lock:
+            lock = self.loading.setdefault(modulepath, threading.Lock())
+        with lock:
+            try:
+                # another thread may have loaded it meanwhile
+                cached = self.modules.get(modulepath)
+                if cached is None or cached.signature != signature:
+                    module = load_script(modulepath, modulepath)
+                    cached = CachedModule(module, signature, time.monotonic())
+                    self.modules.put(modulepath, cached)
+                    self.loads += 1
+            finally:
+                # threads still waiting on lock find the module loaded
+                with self.lock:
+                    if self.loading.get(modulepath) is lock:
+                        del self.loading[modulepath]
+        return cached.module
+
+    def warmup(self, directory):
+        '''Import every script under directory, see is_script; helper
+        modules are left to the scripts which import them. Scripts which
+        fail to compile or import are reported and skipped.
+        '''
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                if not name.endswith('.py'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    if is_script(compile_script(path)):
+                        self.update_module(path)
+                except Exception:
+                    traceback.print_exc()
+
+    def __len__(self):
+        return len(self.modules)
 
 def main(args):
     if len(args) == 1:
@@ -246,7 +276,8 @@ def main(args):
     server_address = ('', port)
     with run_server(server_address, PythonHTTPServer, PythonHTTPRequestHandler) as server:
         server.content_dir = './content/'
-        server.enable_module_cache()
+        server.enable_module_cache(warmup=True)
+        server.stats_path = '/__stats'
 
 if __name__ == '__main__':
     from sys import argv
@@ -1,14 +1,54 @@
+r'''
+Byte ranges of files, RFC 7233.
+
+>>> parse_range('bytes=0-499', 10000)
+[(0, 500)]
+>>> parse_range('bytes=9500-', 10000)
+[(9500, 10000)]
+>>> parse_range('bytes=-500', 10000)
+[(9500, 10000)]
+>>> parse_range('bytes=0-0, -1', 10000)
+[(0, 1), (9999, 10000)]
+>>> parse_range('bytes=500-700,601-999,1000-1099', 10000)
+[(500, 1100)]
+>>> parse_range('bytes=9000-20000,20000-', 10000)
+[(9000, 10000)]
+>>> parse_range('bytes=20000-', 10000)
+[]
+>>> parse_range('bytes=5-1', 10000) is None
+True
+>>> parse_range('items=0-1', 10000) is None
+True
+>>> parse_range('bytes=\u00b9-', 10000) is None
+True
+
+>>> from io import BytesIO
+>>> buf = BytesIO(b'0123456789')
+>>> multipart = MultipartRanges(buf, [(0, 2), (8, 10)], 10, 'text/plain', 'B')
+>>> body = multipart.read()
+>>> body.decode()
+'--B\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-1/10\r\n\r\n01\r\n--B\r\nContent-Type: text/plain\r\nContent-Range: bytes 8-9/10\r\n\r\n89\r\n--B--\r\n'
+>>> len(body) == multipart.length
+True
+'''
+
+import binascii
+import os
+from httputil import parse_digits
+
 class RangedFile(object):
-    '''Subranged file object.
+    '''Subranged file object, from offset start up to offset end (exclusive).
     >>> from io import BytesIO
     >>> buf = BytesIO(b'0123456789')
-    >>> ranged = RangedFile(buf, 1, 5)
+    >>> ranged = RangedFile(buf, 1, 6)
     >>> ranged.read(4)
     b'1234'
     >>> ranged.tell()
     4
     >>> ranged.read()
     b'5'
+    >>> ranged.read()
+    b''
     >>> ranged = RangedFile(buf, 1)
     >>> ranged.fix_position()
     >>> buf.seek = None
@@ -16,12 +56,24 @@ class RangedFile(object):
     b'123456789'
     >>> ranged.length
     9
+
+    Streams which cannot seek are read from their current position, this
+    limits a request body to its Content-Length.
+    >>> r, w = os.pipe()
+    >>> os.write(w, b'abcdef')
+    6
+    >>> body = RangedFile(open(r, 'rb'), 0, 4)
+    >>> body.read(), body.remaining
+    (b'abcd', 0)
+    >>> body.close(); os.close(w)
     '''
     def __init__(self, fileobj, start=0, end=float('inf')):
         self.fileobj = fileobj
         self.start = start
         self.end = end
         self.position = 0
+        seekable = getattr(fileobj, 'seekable', None)
+        self.seekable = seekable() if seekable else True
 
     def tell(self):
         return self.position
@@ -33,34 +85,140 @@ class RangedFile(object):
 
     def read(self, size=-1):
         self.fix_position()
-        if size < 0:
-            if self.end == float('inf'):
-                data = self.fileobj.read()
-                self.end = self.fileobj.tell()
-                self.position = self.end - self.start
-                return data
-            else:
-                length = self.end - self.position
-        else:
-            length = min(size, self.end - self.position)
-        data = self.fileobj.read(length)
-        self.position += length
-        if length == 0:
+        if size < 0 and self.end == float('inf'):
+            data = self.fileobj.read()
             self.end = self.fileobj.tell()
             self.position = self.end - self.start
+            return data
+        remaining = max(self.end - self.start - self.position, 0)
+        length = remaining if size < 0 else min(size, remaining)
+        data = self.fileobj.read(length)
+        self.position += len(data)
+        if length and not data:
+            # end of the underlying file
+            self.end = self.start + self.position
         return data
 
     def fix_position(self):
+        if not self.seekable:
+            return
         if self.start + self.position != self.fileobj.tell():
             self.seek(self.position)
 
+    def close(self):
+        self.fileobj.close()
+
     @property
     def length(self):
         if self.end == float('inf'):
             return None
         return self.end - self.start
 
+    @property
+    def remaining(self):
+        return self.end - self.start - self.position
+
+def parse_range(header, size, max_ranges=100):
+    '''Parse the value of a Range header for a representation of size bytes.
+    Return a sorted list of (start, end) pairs, end exclusive, with
+    overlapping and adjacent ranges coalesced. Return [] if no range is
+    satisfiable, and None if the header is invalid and has to be ignored.
+    '''
+    unit, sep, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not sep:
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, sep, last = spec.partition('-')
+        first, last = first.strip(), last.strip()
+        start, end = parse_digits(first), parse_digits(last)
+        if (not sep or (start is None and first) or (end is None and last)
+                or first == last == ''):
+            return None
+        if start is None:
+            # suffix-byte-range-spec, the last bytes of the representation
+            if end:
+                ranges.append((max(size - end, 0), size))
+            continue
+        end = size if end is None else end + 1
+        if last != '' and end <= start:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size)))
+    if len(ranges) > max_ranges:
+        return None
+    ranges.sort()
+    coalesced = []
+    for start, end in ranges:
+        if coalesced and start <= coalesced[-1][1]:
+            coalesced[-1] = coalesced[-1][0], max(end, coalesced[-1][1])
+        else:
+            coalesced.append((start, end))
+    return coalesced
+
+def content_range(start, end, size):
+    '''Value of Content-Range for a (start, end) pair of parse_range.'''
+    return 'bytes {}-{}/{}'.format(start, end - 1, size)
+
+class MultipartRanges(object):
+    '''multipart/byteranges body of several ranges of a file object.
+    Parts are read from the file while the body is read, nothing is buffered.
+    '''
+    def __init__(self, fileobj, ranges, size, content_type, boundary=None):
+        self.fileobj = fileobj
+        if boundary is None:
+            boundary = binascii.hexlify(os.urandom(12)).decode('ascii')
+        self.boundary = boundary
+        self.parts = []
+        for start, end in ranges:
+            head = '--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+                boundary, content_type, content_range(start, end, size))
+            self.parts.append((head.encode('latin-1'), start, end))
+        self.tail = '--{}--\r\n'.format(boundary).encode('latin-1')
+        self.length = len(self.tail) + sum(
+            len(head) + end - start + 2 for head, start, end in self.parts)
+        self._pieces = self.pieces()
+        self._pending = b''
+
+    @property
+    def content_type(self):
+        return 'multipart/byteranges; boundary=' + self.boundary
+
+    def pieces(self):
+        '''Yield the body as bytes and RangedFile pieces.'''
+        for head, start, end in self.parts:
+            yield head
+            yield RangedFile(self.fileobj, start, end)
+            yield b'\r\n'
+        yield self.tail
+
+    def read(self, size=-1):
+        data = []
+        while size < 0 or size > 0:
+            if not self._pending:
+                piece = next(self._pieces, None)
+                if piece is None:
+                    break
+                self._pending = piece
+            if isinstance(self._pending, RangedFile):
+                chunk = self._pending.read(size)
+                if not chunk:
+                    self._pending = b''
+                    continue
+            else:
+                chunk = self._pending if size < 0 else self._pending[:size]
+                self._pending = self._pending[len(chunk):]
+            data.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(data)
+
+    def close(self):
+        self.fileobj.close()
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
-
@@ -0,0 +1,219 @@
+'''
+Responses of pythonhttp scripts given as iterables of chunks.
+
+Besides handle(handler) calling the methods of the handler, a script may
+use one of these contracts, which leave the framing, compression and
+caching of the response to the server:
+
+- handle(handler) returns (status, headers, body), body being bytes or an
+  iterable of bytes.
+- handle(handler) is a generator, which yields (status, headers) and then
+  the chunks of the body.
+- the script defines application, a WSGI application (PEP 3333).
+
+status is a number or a string such as '200 OK', headers a list of
+(name, value). Chunks are written to the client as they are produced, so a
+large response streams in constant memory. An empty chunk flushes what is
+compressed so far.
+
+>>> import io
+>>> class Handler(object):
+...     command = 'GET'
+...     def send_response(self, code, message=None):
+...         print(code, message)
+...     def send_header(self, keyword, value):
+...         print(keyword, value)
+...     def end_headers(self):
+...         pass
+...     def start_body(self):
+...         self.outfile = io.BytesIO()
+...     def end_body(self):
+...         print(self.outfile.getvalue())
+>>> def handle(handler):
+...     yield 200, [('Content-Type', 'text/csv')]
+...     for i in range(3):
+...         yield b'%d\\n' % i
+>>> response = ScriptResponse(Handler())
+>>> response.run_generator(handle(None))
+200 None
+Content-Type text/csv
+b'0\\n1\\n2\\n'
+'''
+
+import inspect
+import sys
+import urllib.parse
+from http import HTTPStatus
+from chunkedfile import ChunkedError
+from formdata import FormError, request_body
+
+def script_paths(path):
+    '''SCRIPT_NAME and PATH_INFO of the path of a request, decoded as
+    PEP 3333 wants them. A directory, whose index script is run, keeps its
+    slash in PATH_INFO.
+
+    >>> script_paths('/app%20v2.py')
+    ('/app v2.py', '')
+    >>> script_paths('/shop/')
+    ('/shop', '/')
+    '''
+    path = urllib.parse.unquote(path, encoding='latin-1')
+    if path.endswith('/'):
+        return path[:-1], '/'
+    return path, ''
+
+def wsgi_environ(handler):
+    '''WSGI environ of the request of handler. wsgi.multithread and
+    wsgi.multiprocess are taken from handler, or the server for the latter.
+    '''
+    path, _, query = handler.path.partition('?')
+    script_name, path_info = script_paths(path.split('#', 1)[0])
+    multiprocess = getattr(handler, 'multiprocess', None)
+    if multiprocess is None:
+        multiprocess = getattr(handler.server, 'multiprocess', False)
+    address = getattr(handler, 'server_address', None)
+    if address is None:
+        address = handler.server.server_address
+    host, port = address[:2]
+    environ = {
+        'REQUEST_METHOD': handler.command,
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': query.split('#', 1)[0],
+        'SERVER_NAME': host,
+        'SERVER_PORT': str(port),
+        'SERVER_PROTOCOL': handler.request_version,
+        'REMOTE_ADDR': handler.client_address[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': request_body(handler),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': getattr(handler, 'multithread', True),
+        'wsgi.multiprocess': multiprocess,
+        'wsgi.run_once': False,
+    }
+    for key, value in handler.headers.items():
+        key = key.upper().replace('-', '_')
+        if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            environ[key] = value
+            continue
+        key = 'HTTP_' + key
+        if key in environ:
+            environ[key] += ',' + value
+        else:
+            environ[key] = value
+    return environ
+
+class ScriptResponse(object):
+    '''Send a response given by status, headers and chunks with handler.
+    The head is sent with the first chunk which is not empty, or at the end.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.status = None
+        self.headers = None
+        self.started = False
+
+    def start_response(self, status, headers, exc_info=None):
+        '''start_response of WSGI.'''
+        if exc_info:
+            try:
+                if self.started:
+                    raise exc_info[1].with_traceback(exc_info[2])
+            finally:
+                exc_info = None
+        elif self.status is not None:
+            raise AssertionError('start_response was already called.')
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def begin(self):
+        if self.status is None:
+            raise AssertionError('No status and headers for the response.')
+        handler = self.handler
+        if isinstance(self.status, int):
+            code, reason = self.status, None
+        else:
+            code, _, reason = self.status.partition(' ')
+            code, reason = int(code), reason or None
+        handler.send_response(code, reason)
+        for key, value in self.headers:
+            handler.send_header(key, value)
+        handler.end_headers()
+        self.started = True
+        if handler.command != 'HEAD':
+            handler.start_body()
+
+    def write(self, data):
+        if not self.started:
+            if not data:
+                return
+            self.begin()
+        if self.handler.command == 'HEAD':
+            return
+        if data:
+            self.handler.outfile.write(data)
+        else:
+            self.handler.outfile.flush()
+
+    def send(self, chunks):
+        '''Write chunks, then end the response.'''
+        if isinstance(chunks, (bytes, bytearray, memoryview)):
+            if not self.started and not any(
+                    key.lower() == 'content-length' for key, value in self.headers):
+                self.headers = list(self.headers)
+                self.headers.append(('Content-Length', str(len(chunks))))
+            chunks = [chunks]
+        try:
+            if self.handler.command != 'HEAD':
+                for chunk in chunks:
+                    self.write(chunk)
+            if not self.started:
+                self.begin()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+        if self.handler.command != 'HEAD':
+            self.handler.end_body()
+
+    def run_application(self, application):
+        self.send(application(wsgi_environ(self.handler), self.start_response))
+
+    def run_generator(self, generator):
+        try:
+            self.status, self.headers = next(generator)
+        except StopIteration:
+            raise AssertionError('The script yielded no status and headers.')
+        self.send(generator)
+
+def call_script(module, handler):
+    '''Run a script module for the request of handler, by any contract.
+    A form which cannot be parsed is answered with the status of the error,
+    a malformed chunked body with 400.
+    '''
+    response = ScriptResponse(handler)
+    try:
+        application = getattr(module, 'application', None)
+        if application is not None:
+            response.run_application(application)
+            return
+        result = module.handle(handler)
+        if result is None:
+            return
+        if inspect.isgenerator(result):
+            response.run_generator(result)
+        else:
+            response.status, response.headers, body = result
+            response.send(body)
+    except (FormError, ChunkedError) as error:
+        if response.started:
+            raise
+        handler.close_connection = True
+        handler.send_error(getattr(error, 'status', HTTPStatus.BAD_REQUEST),
+                           str(error))
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
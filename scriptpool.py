@@ -0,0 +1,372 @@
+'''
+Execution of pythonhttp scripts in a pool of worker processes.
+
+A script run by a worker cannot hold the GIL of the server. The request
+is sent to an idle worker, which runs handle(handler) of the script with a
+RemoteHandler. The calls the script makes on it are relayed back and
+replayed on the real handler by the connection thread, which meanwhile
+only waits on a pipe. The request body is read on demand, the response is
+streamed as the script writes it.
+
+A script may set script_timeout to override the timeout of the pool. A
+worker which times out is killed, workers are replaced after max_requests
+requests.
+
+>>> import multiprocessing
+>>> ours, theirs = multiprocessing.Pipe()
+>>> channel = Channel(theirs)
+>>> channel.write('wfile', b'ab')
+>>> channel.write('wfile', b'cd')
+>>> channel.send(('call', 'end_body', ()))
+>>> ours.recv(), ours.recv()
+(('write', 'wfile', b'abcd'), ('call', 'end_body', ()))
+'''
+
+import http.client
+import io
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+from http import HTTPStatus
+from outputcache import script_cache_policy
+from chunkedfile import ChunkedError
+from formdata import RequestData, body_consumed, request_body
+from scriptapi import call_script
+
+# methods of the handler which scripts may call in a worker
+replayed_methods = frozenset([
+    'send_response', 'send_response_only', 'send_header', 'end_headers',
+    'flush_headers', 'send_error', 'start_body', 'end_body', 'log_message',
+    'log_error'])
+
+# attributes of the handler which scripts may set in a worker
+replayed_attributes = frozenset([
+    'using_gzip', 'using_chunked', 'compress_level', 'close_connection',
+    'cache_policy'])
+
+class Channel(object):
+    '''Messages of a worker to the server.
+    Writes are buffered up to buffer_size, and sent before any other message.
+    '''
+
+    buffer_size = 64 << 10
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.target = None
+        self.buffer = bytearray()
+
+    def write(self, target, data):
+        if target != self.target:
+            self.flush()
+            self.target = target
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.conn.send(('write', self.target, bytes(self.buffer)))
+            del self.buffer[:]
+
+    def send(self, message):
+        self.flush()
+        self.conn.send(message)
+
+    def request(self, message):
+        '''Send a message and return the reply of the server.'''
+        self.send(message)
+        return self.conn.recv()
+
+class RemoteWriter(object):
+    '''wfile or outfile of a RemoteHandler.'''
+    def __init__(self, channel, target):
+        self.channel = channel
+        self.target = target
+
+    def write(self, data):
+        self.channel.write(self.target, bytes(data))
+        return len(data)
+
+    def flush(self):
+        self.channel.send(('flush', self.target))
+
+class RemoteReader(io.RawIOBase):
+    '''rfile of a RemoteHandler, which reads the request body on demand.'''
+    def __init__(self, channel):
+        self.channel = channel
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.channel.request(('read', len(buffer)))
+        buffer[:len(data)] = data
+        return len(data)
+
+class RemoteHandler(RequestData):
+    '''Stand-in of the request handler passed to scripts in a worker.
+    It has the attributes of the request, and the methods and files of the
+    handler which can be replayed by the server.
+    '''
+    def __init__(self, channel, request):
+        channel = self.__dict__['channel'] = channel
+        for name in ('path', 'command', 'request_version', 'requestline',
+                     'client_address', 'server_address'):
+            self.__dict__[name] = request[name]
+        self.__dict__.update(request['form_limits'])
+        # for wsgi_environ: a worker runs one request at a time
+        self.__dict__['multiprocess'] = request['multiprocess']
+        self.__dict__['multithread'] = False
+        headers = http.client.HTTPMessage()
+        for key, value in request['headers']:
+            headers[key] = value
+        self.__dict__['headers'] = headers
+        self.__dict__['rfile'] = io.BufferedReader(RemoteReader(channel))
+        # the server already ends the body where it ends
+        self.__dict__['body_reader'] = self.rfile
+        self.__dict__['wfile'] = RemoteWriter(channel, 'wfile')
+        self.__dict__['outfile'] = RemoteWriter(channel, 'outfile')
+
+    def __getattr__(self, name):
+        if name not in replayed_methods:
+            raise AttributeError(
+                '{!r} is not available to scripts run in a worker.'.format(name))
+        def call(*args):
+            self.channel.send(('call', name, args))
+        return call
+
+    def __setattr__(self, name, value):
+        if name in replayed_attributes:
+            self.channel.send(('set', name, value))
+        self.__dict__[name] = value
+
+def serve_scripts(conn, max_requests, preload_dir):
+    '''Main function of a worker process.'''
+    from pythonhttp import ModuleCachePool
+    modules = ModuleCachePool()
+    if preload_dir:
+        modules.warmup(preload_dir)
+    for _ in range(max_requests):
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            return
+        if request is None:
+            return
+        channel = Channel(conn)
+        try:
+            module = modules.update_module(request['script'])
+            timeout = getattr(module, 'script_timeout', None)
+            if timeout is not None:
+                channel.send(('timeout', timeout))
+            policy = script_cache_policy(module)
+            if policy is not None:
+                channel.send(('set', 'cache_policy', policy))
+            call_script(module, RemoteHandler(channel, request))
+            channel.send(('done', None))
+        except Exception:
+            channel.send(('done', traceback.format_exc()))
+
+class Worker(object):
+    def __init__(self, context, max_requests, preload_dir):
+        self.conn, theirs = context.Pipe()
+        self.process = context.Process(
+            target=serve_scripts, args=(theirs, max_requests, preload_dir),
+            daemon=True)
+        self.process.start()
+        theirs.close()
+        self.requests = 0
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+class ScriptPool(object):
+    '''Pool of worker processes which run scripts.
+
+    A request waits up to queue_timeout for an idle worker. A script which
+    keeps the server waiting for more than timeout seconds, or the
+    script_timeout of its module, is killed. Workers are replaced after
+    max_requests requests. With preload_dir, every script under it is
+    imported by workers when they start.
+    '''
+    def __init__(self, processes=None, max_requests=1000, timeout=30,
+                 queue_timeout=30, preload_dir=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.max_requests = max_requests
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.preload_dir = preload_dir
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            # a forked worker would keep client connections open
+            self.context = multiprocessing.get_context('forkserver')
+        else:
+            self.context = multiprocessing.get_context()
+        self.lock = threading.Lock()
+        self.pid = None
+        self.idle = queue.Queue()
+        self.workers = set()
+        self.timeouts = 0
+        self.recycled = 0
+
+    def start(self):
+        '''Start the workers, or new ones in a forked server process.'''
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # workers of the parent belong to it, not to this process
+            self.pid = os.getpid()
+            self.idle = queue.Queue()
+            self.workers = set()
+            for _ in range(self.processes):
+                self.spawn()
+
+    def spawn(self):
+        worker = Worker(self.context, self.max_requests, self.preload_dir)
+        self.workers.add(worker)
+        self.idle.put(worker)
+
+    def run(self, handler, script):
+        '''Run the script at path script for the request of handler.'''
+        self.start()
+        try:
+            worker = self.idle.get(timeout=self.queue_timeout)
+        except queue.Empty:
+            handler.send_error(HTTPStatus.SERVICE_UNAVAILABLE,
+                               'No script worker available')
+            return
+        worker.requests += 1
+        request = {
+            'script': script,
+            'path': handler.path,
+            'command': handler.command,
+            'request_version': handler.request_version,
+            'requestline': handler.requestline,
+            'client_address': handler.client_address,
+            'headers': list(handler.headers.items()),
+            'form_limits': dict((name, getattr(handler, name))
+                                for name in RequestData.form_limits),
+            'server_address': handler.server.server_address,
+            'multiprocess': self.processes > 1 or getattr(
+                handler.server, 'multiprocess', False),
+        }
+        reusable = False
+        try:
+            worker.conn.send(request)
+            reusable = self.relay(worker, handler, script)
+        finally:
+            self.release(worker, reusable)
+
+    def relay(self, worker, handler, script):
+        '''Replay the messages of worker on handler until the script is done.
+        Return whether the worker may run another request.
+        '''
+        conn = worker.conn
+        body = request_body(handler)
+        remaining = self.timeout
+        waited = 0
+        started = False
+        while True:
+            before = time.monotonic()
+            if not conn.poll(max(remaining - waited, 0)):
+                self.timeouts += 1
+                handler.log_error('Script %s timed out', script)
+                self.fail(handler, HTTPStatus.SERVICE_UNAVAILABLE,
+                          'Script timed out', started)
+                return False
+            try:
+                message = conn.recv()
+            except EOFError:
+                handler.log_error('Worker running %s exited', script)
+                self.fail(handler, HTTPStatus.INTERNAL_SERVER_ERROR,
+                          'Script worker exited', started)
+                return False
+            waited += time.monotonic() - before
+            kind = message[0]
+            if kind == 'write':
+                getattr(handler, message[1]).write(message[2])
+            elif kind == 'call':
+                if message[1] in replayed_methods:
+                    if message[1].startswith('send_'):
+                        started = True
+                    getattr(handler, message[1])(*message[2])
+            elif kind == 'set':
+                if message[1] in replayed_attributes:
+                    setattr(handler, message[1], message[2])
+            elif kind == 'flush':
+                getattr(handler, message[1]).flush()
+            elif kind == 'read':
+                try:
+                    data = body.read(message[1])
+                except ChunkedError as error:
+                    # the script is left waiting for the body
+                    handler.close_connection = True
+                    self.fail(handler, HTTPStatus.BAD_REQUEST, str(error),
+                              started)
+                    return False
+                conn.send(data)
+            elif kind == 'timeout':
+                remaining = message[1]
+            elif kind == 'done':
+                if message[1] is not None:
+                    handler.log_error('Script %s failed', script)
+                    sys.stderr.write(message[1])
+                    self.fail(handler, HTTPStatus.INTERNAL_SERVER_ERROR,
+                              'Script failed', started)
+                if not body_consumed(body):
+                    handler.close_connection = True
+                return True
+
+    @staticmethod
+    def fail(handler, code, message, started):
+        if started:
+            # part of the response is out, the connection cannot go on
+            handler.close_connection = True
+        else:
+            handler.send_error(code, message)
+
+    def release(self, worker, reusable):
+        with self.lock:
+            if worker not in self.workers:
+                # left over by a process the pool was forked from
+                return
+            if reusable and worker.requests < self.max_requests:
+                self.idle.put(worker)
+                return
+            self.workers.discard(worker)
+            if reusable:
+                self.recycled += 1
+                worker.stop()
+            else:
+                worker.kill()
+            self.spawn()
+
+    def close(self):
+        with self.lock:
+            workers, self.workers = self.workers, set()
+            self.pid = None
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.kill()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
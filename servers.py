@@ -1,6 +1,16 @@
 import socketserver
 from http.server import HTTPServer
+import asyncio
+import concurrent.futures
 import contextlib
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
 
 class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
     pass
@@ -8,14 +18,412 @@ class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
 class ForkingHTTPServer(socketserver.ForkingMixIn, HTTPServer):
     pass
 
+class ThreadPoolMixIn(object):
+    '''Mix-in class to handle connections with a fixed pool of threads.
+
+    Accepted connections wait in a queue of queue_size. When it is full,
+    the connection is answered with 503 (overflow = 'reject'), or the server
+    stops accepting until a worker is free (overflow = 'block').
+    '''
+
+    pool_size = 16
+    queue_size = 64
+    overflow = 'reject'
+    keep_alive_timeout = 15
+    reject_response = (b'HTTP/1.1 503 Service Unavailable\r\n'
+                       b'Content-Length: 0\r\n'
+                       b'Retry-After: 1\r\n'
+                       b'Connection: close\r\n\r\n')
+    rejected = 0
+    busy_workers = 0
+    _queue = None
+
+    @property
+    def queue_depth(self):
+        '''Number of accepted connections waiting for a worker.'''
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    def process_request(self, request, client_address):
+        if self._queue is None:
+            self._start_workers()
+        if self.overflow == 'block':
+            self._queue.put((request, client_address))
+            return
+        try:
+            self._queue.put_nowait((request, client_address))
+        except queue.Full:
+            self.rejected += 1
+            self.reject_request(request, client_address)
+
+    def reject_request(self, request, client_address):
+        try:
+            request.settimeout(1)
+            request.sendall(self.reject_response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def _start_workers(self):
+        self._queue = queue.Queue(self.queue_size)
+        self._busy_lock = threading.Lock()
+        self._workers = []
+        for i in range(self.pool_size):
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self._busy_lock:
+                self.busy_workers += 1
+            try:
+                if request.gettimeout() is None:
+                    # idle keep-alive connections must not hold a worker forever
+                    request.settimeout(self.keep_alive_timeout)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self._busy_lock:
+                    self.busy_workers -= 1
+
+    def server_close(self):
+        super().server_close()
+        if self._queue is None:
+            return
+        while True:
+            try:
+                request, client_address = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            self.shutdown_request(request)
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._queue = None
+
+class ThreadPoolHTTPServer(ThreadPoolMixIn, HTTPServer):
+    pass
+
+class AsyncioMixIn(object):
+    '''Mix-in class to serve connections from an asyncio event loop.
+
+    The loop accepts connections and watches idle keep-alive connections,
+    so they do not pin a thread each. When a request arrives, the
+    connection is lent to a bounded pool of threads which runs the request
+    handler as long as requests are pipelined, then it goes back to the loop.
+    '''
+
+    max_workers = 64
+    keep_alive_timeout = 60
+    request_queue_size = 1024
+    _loop = None
+
+    def serve_forever(self, poll_interval=0.5):
+        self._loop = loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.max_workers)
+        self._connections = {}
+        self._stopped = threading.Event()
+        self.socket.setblocking(False)
+        loop.add_reader(self.socket, self._accept)
+        try:
+            loop.run_forever()
+        finally:
+            loop.remove_reader(self.socket)
+            for handler, timer in list(self._connections.items()):
+                if timer is not None:
+                    self._close(handler)
+            self._executor.shutdown(wait=True)
+            for handler in list(self._connections):
+                self._close(handler)
+            loop.close()
+            self._loop = None
+            self._stopped.set()
+
+    def shutdown(self):
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            self._stopped.wait()
+
+    def _accept(self):
+        for i in range(self.request_queue_size):
+            try:
+                request, client_address = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if not self.verify_request(request, client_address):
+                self.shutdown_request(request)
+                continue
+            try:
+                handler = self._setup_handler(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+                continue
+            self._connections[handler] = None
+            self._wait_request(handler)
+
+    def _setup_handler(self, request, client_address):
+        # BaseRequestHandler.__init__ would handle the whole connection at
+        # once, requests are handled one by one by _handle_requests instead.
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.request = request
+        handler.client_address = client_address
+        handler.server = self
+        handler.setup()
+        if handler.timeout is None:
+            # a slow client must not keep a worker thread forever
+            request.settimeout(self.keep_alive_timeout)
+        return handler
+
+    def _wait_request(self, handler):
+        '''Park an idle connection in the loop until it becomes readable.'''
+        self._connections[handler] = self._loop.call_later(
+                self.keep_alive_timeout, self._close, handler)
+        self._loop.add_reader(handler.connection, self._dispatch, handler)
+
+    def _dispatch(self, handler):
+        self._loop.remove_reader(handler.connection)
+        self._connections[handler].cancel()
+        self._connections[handler] = None
+        future = self._loop.run_in_executor(
+                self._executor, self._handle_requests, handler)
+        future.add_done_callback(
+                lambda future: self._request_done(handler, future))
+
+    def _handle_requests(self, handler):
+        '''Handle requests in a worker thread.
+        Return True if the connection should be kept alive.
+        '''
+        try:
+            while True:
+                handler.close_connection = True
+                handler.handle_one_request()
+                if handler.close_connection:
+                    return False
+                if not self._buffered(handler):
+                    return True
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            return False
+
+    def _buffered(self, handler):
+        '''Whether a pipelined request is already waiting to be read.'''
+        connection = handler.connection
+        timeout = connection.gettimeout()
+        connection.setblocking(False)
+        try:
+            return bool(handler.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            connection.settimeout(timeout)
+
+    def _request_done(self, handler, future):
+        if future.result() and self._loop.is_running():
+            self._wait_request(handler)
+        else:
+            self._close(handler)
+
+    def _close(self, handler):
+        timer = self._connections.pop(handler, None)
+        if timer is not None:
+            timer.cancel()
+            self._loop.remove_reader(handler.connection)
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+class AsyncioHTTPServer(AsyncioMixIn, HTTPServer):
+    pass
+
+backends = {
+    'threading': socketserver.ThreadingMixIn,
+    'forking': socketserver.ForkingMixIn,
+    'pool': ThreadPoolMixIn,
+    'asyncio': AsyncioMixIn,
+}
+
+def with_backend(server_class, backend):
+    '''Return a subclass of server_class which serves with the backend.'''
+    mixin = backends[backend]
+    if issubclass(server_class, mixin):
+        return server_class
+    name = mixin.__name__.replace('MixIn', '') + server_class.__name__
+    return type(name, (mixin, server_class), {})
+
+class PreforkSupervisor(object):
+    '''Serve with a number of forked worker processes.
+
+    With reuse_port, every worker listens on its own SO_REUSEPORT socket and
+    the kernel balances connections between them; the supervisor only keeps
+    the address bound. Otherwise the workers accept on the inherited socket.
+    Workers are forked after the server is configured, so caches such as
+    ModuleCachePool start with what was warmed up and stay local to each
+    process.
+    Crashed workers are restarted, SIGTERM and KeyboardInterrupt stop all.
+    A worker stops accepting connections, then lets the requests in
+    progress finish for up to drain_timeout seconds before it exits.
+    '''
+
+    restart_delay = 1
+    stop_timeout = 10
+    # less than stop_timeout, after which workers are killed
+    drain_timeout = 8
+
+    def __init__(self, httpd, workers, reuse_port=True):
+        if not hasattr(os, 'fork'):
+            raise ValueError('Worker processes need os.fork.')
+        self.httpd = httpd
+        self.workers = workers
+        self.reuse_port = reuse_port
+        # seen by handlers, such as wsgi.multiprocess of scripts
+        httpd.multiprocess = workers > 1
+        self.children = {}
+        self.started = {}
+        self.stopping = False
+
+    def run(self):
+        previous = signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            for index in range(self.workers):
+                self.spawn(index)
+            while self.children:
+                try:
+                    pid, status = os.wait()
+                except ChildProcessError:
+                    break
+                index = self.children.pop(pid, None)
+                if index is None or self.stopping:
+                    continue
+                print('Worker {} exited with status {}, restarting.'.format(
+                    pid, status))
+                if time.monotonic() - self.started[index] < self.restart_delay:
+                    # do not fork in a tight loop if workers die at once
+                    time.sleep(self.restart_delay)
+                self.spawn(index)
+        except KeyboardInterrupt:
+            print('Keyboard interrupt received, exiting.')
+        finally:
+            self.stop()
+            signal.signal(signal.SIGTERM, previous)
+            self.httpd.server_close()
+
+    def spawn(self, index):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            self.started[index] = time.monotonic()
+            return pid
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, self._shutdown_worker)
+            if self.reuse_port:
+                listen_reuse_port(self.httpd)
+            try:
+                self.httpd.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            self.close_worker()
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+
+    def _shutdown_worker(self, signum, frame):
+        # shutdown waits for serve_forever, which runs in this very thread
+        threading.Thread(target=self.httpd.shutdown, daemon=True).start()
+
+    def close_worker(self):
+        '''Close the server of a worker, which waits for the requests in
+        progress, for up to drain_timeout seconds.
+        '''
+        closer = threading.Thread(target=self.httpd.server_close, daemon=True)
+        closer.start()
+        closer.join(self.drain_timeout)
+
+    def stop(self):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                self.children.pop(pid)
+        deadline = time.monotonic() + self.stop_timeout
+        while self.children:
+            for pid in list(self.children):
+                try:
+                    done, status = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    self.children.pop(pid)
+                elif time.monotonic() > deadline:
+                    os.kill(pid, signal.SIGKILL)
+            time.sleep(0.05)
+
+    def _terminate(self, signum, frame):
+        raise KeyboardInterrupt
+
+def enable_reuse_port(sock):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise ValueError('SO_REUSEPORT is not supported on this platform.')
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+def listen_reuse_port(httpd):
+    '''Replace the socket of a server by a new SO_REUSEPORT listening one.'''
+    sock = socket.socket(httpd.address_family, httpd.socket_type)
+    if httpd.allow_reuse_address:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    enable_reuse_port(sock)
+    sock.bind(httpd.server_address)
+    sock.listen(httpd.request_queue_size)
+    httpd.socket.close()
+    httpd.socket = sock
+
 @contextlib.contextmanager
-def run_server(address, server_class, handler_class):
-    httpd = server_class(address, handler_class)
+def run_server(address, server_class, handler_class, backend=None,
+               workers=None, reuse_port=True):
+    '''Create a server, let the caller configure it, then serve forever.
+    With workers, the configured server is run by a PreforkSupervisor.
+    '''
+    if backend is not None:
+        server_class = with_backend(server_class, backend)
+    httpd = server_class(address, handler_class, False)
+    try:
+        if workers and reuse_port:
+            # only bind: the supervisor must not get any connection itself
+            enable_reuse_port(httpd.socket)
+            httpd.server_bind()
+        else:
+            httpd.server_bind()
+            httpd.server_activate()
+    except:
+        httpd.server_close()
+        raise
     print('Serving HTTP on address ({}:{})'.format(*address))
     yield httpd
+    if workers:
+        PreforkSupervisor(httpd, workers, reuse_port).run()
+        return
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print('Keyboard interrupt received, exiting.')
         httpd.shutdown()
-
@@ -0,0 +1,166 @@
+'''
+Relay of a tunnel between two sockets, as opened by CONNECT.
+
+Both sockets are watched with a selector, the relay sleeps until one of
+them is ready. Data is moved with splice through a pipe where os.splice
+exists, so it is never copied to user space, otherwise with large
+buffers. An end of stream is passed on as a half-close, the tunnel ends
+when both directions are closed, on error or after idle_timeout.
+
+>>> import socket
+>>> client, proxy_end = socket.socketpair()
+>>> upstream_end, upstream = socket.socketpair()
+>>> client.sendall(b'ping')
+>>> client.shutdown(socket.SHUT_WR)
+>>> upstream.sendall(b'pong!')
+>>> upstream.shutdown(socket.SHUT_WR)
+>>> tunnel = Tunnel(proxy_end, upstream_end, idle_timeout=5)
+>>> tunnel.run()
+>>> upstream.recv(100), client.recv(100)
+(b'ping', b'pong!')
+>>> tunnel.sent, tunnel.received
+(4, 5)
+'''
+
+import os
+import selectors
+import socket
+import time
+
+class Flow(object):
+    '''One direction of a tunnel, from src to dst.'''
+    def __init__(self, src, dst, buffer_size, use_splice):
+        self.src = src
+        self.dst = dst
+        self.buffer_size = buffer_size
+        self.pipe = os.pipe() if use_splice else None
+        self.data = b''
+        self.pending = 0
+        self.eof = False
+        self.count = 0
+
+    @property
+    def done(self):
+        return self.eof and not self.pending
+
+    def read(self):
+        '''Read from src what is available, return False if it would block.'''
+        try:
+            if self.pipe:
+                n = os.splice(self.src.fileno(), self.pipe[1], self.buffer_size,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                self.data = memoryview(self.src.recv(self.buffer_size))
+                n = len(self.data)
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not n:
+            self.eof = True
+            # pass the end of stream on, the other direction may go on
+            self.dst.shutdown(socket.SHUT_WR)
+        self.pending = n
+        return True
+
+    def write(self):
+        '''Write pending data to dst, return False if it would block.'''
+        try:
+            if self.pipe:
+                n = os.splice(self.pipe[0], self.dst.fileno(), self.pending,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            else:
+                n = self.dst.send(self.data)
+                self.data = self.data[n:]
+        except (BlockingIOError, InterruptedError):
+            return False
+        self.pending -= n
+        self.count += n
+        return True
+
+    def pump(self):
+        '''Move data until either socket would block.'''
+        while not self.done:
+            if self.pending:
+                if not self.write():
+                    return
+            elif not self.read():
+                return
+
+    def close(self):
+        if self.pipe:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+            self.pipe = None
+
+class Tunnel(object):
+    '''Relay between a client and an upstream socket.
+    sent and received count the bytes sent upstream and received from it,
+    sent including the early bytes sent upstream before the relay started.
+    '''
+
+    buffer_size = 256 << 10
+    use_splice = hasattr(os, 'splice')
+
+    def __init__(self, client, upstream, idle_timeout=300):
+        self.client = client
+        self.upstream = upstream
+        self.idle_timeout = idle_timeout
+        self.started = time.monotonic()
+        self.outbound = self.inbound = None
+        self.early = 0
+
+    @property
+    def sent(self):
+        return self.early + (self.outbound.count if self.outbound else 0)
+
+    @property
+    def received(self):
+        return self.inbound.count if self.inbound else 0
+
+    def run(self):
+        '''Relay until the tunnel ends, then close the upstream socket.'''
+        self.outbound = Flow(self.client, self.upstream, self.buffer_size,
+                             self.use_splice)
+        self.inbound = Flow(self.upstream, self.client, self.buffer_size,
+                            self.use_splice)
+        flows = self.outbound, self.inbound
+        timeout = self.client.gettimeout()
+        self.client.setblocking(False)
+        self.upstream.setblocking(False)
+        selector = selectors.DefaultSelector()
+        registered = {}
+        try:
+            while True:
+                wanted = {self.client: 0, self.upstream: 0}
+                for flow in flows:
+                    if flow.pending:
+                        wanted[flow.dst] |= selectors.EVENT_WRITE
+                    elif not flow.eof:
+                        wanted[flow.src] |= selectors.EVENT_READ
+                if not any(wanted.values()):
+                    break
+                for sock, events in wanted.items():
+                    if events == registered.get(sock, 0):
+                        continue
+                    if not events:
+                        selector.unregister(sock)
+                    elif sock in registered and registered[sock]:
+                        selector.modify(sock, events)
+                    else:
+                        selector.register(sock, events)
+                    registered[sock] = events
+                if not selector.select(self.idle_timeout):
+                    break
+                for flow in flows:
+                    flow.pump()
+        except OSError:
+            pass
+        finally:
+            selector.close()
+            for flow in flows:
+                flow.close()
+            self.client.settimeout(timeout)
+            self.upstream.close()
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()